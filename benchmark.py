@@ -0,0 +1,112 @@
+# Simulates all-bot tables with the headless rules engine and reports how fast the game logic runs.
+# Usage: python benchmark.py [--games N] [--seed S] [--players 2 3 4 5 6 7]
+#        python benchmark.py --decisions [--budget SECONDS]
+import argparse
+import random
+import time
+from utils.engine import Game, Seat
+from utils.strategy import STRATEGIES
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def playGame(players, seed, maxTurns):
+    """Play one seeded all-bot game. Returns the per-turn latencies and whether the game finished."""
+    game = Game([Seat(i, f'Bot {i}', isBot=True) for i in range(players)], seed)
+    game.deal(False)
+    game.begin()
+    game.apply({'type': 'start'})
+    latencies = []
+    while game.status == 'started' and len(latencies) < maxTurns:
+        start = time.perf_counter()
+        game.step()
+        latencies.append(time.perf_counter() - start)
+    return latencies, game.status == 'ended'
+
+
+def benchmark(players, games, seed, maxTurns):
+    latencies = []
+    finished = 0
+    start = time.perf_counter()
+    for i in range(games):
+        turns, ended = playGame(players, seed + i, maxTurns)
+        latencies.extend(turns)
+        finished += ended
+    elapsed = time.perf_counter() - start
+    return {'players': players,
+            'games': games,
+            'finished': finished,
+            'ticks': len(latencies),
+            'games/s': games / elapsed,
+            'ticks/s': len(latencies) / elapsed,
+            'p50': percentile(latencies, 50) * 1e6,
+            'p90': percentile(latencies, 90) * 1e6,
+            'p99': percentile(latencies, 99) * 1e6,
+            'max': max(latencies, default=0) * 1e6}
+
+
+def decisions(level, games, seed, budget):
+    """Time every decision one bot with the given strategy makes against normal bots at a 4 player table."""
+    latencies = []
+    wins = 0
+    for i in range(games):
+        strategy = STRATEGIES[level](random.Random(seed + i))
+        if strategy.budgeted:
+            strategy.budget = budget
+        me = Seat(0, 'Bot 0', isBot=True, strategy=strategy)
+        game = Game([me] + [Seat(n, f'Bot {n}', isBot=True) for n in range(1, 4)], seed + i)
+        game.deal(False)
+        game.begin()
+        game.apply({'type': 'start'})
+        while game.status == 'started':
+            if game.currentPlayer is me:
+                start = time.perf_counter()
+                action = game.botAction()
+                latencies.append(time.perf_counter() - start)
+                game.apply(action)
+            else:
+                game.step()
+        wins += game.winner is me
+    return {'level': level,
+            'decisions': len(latencies),
+            'decisions/s': len(latencies) / sum(latencies),
+            'win rate': wins / games,
+            'p50': percentile(latencies, 50) * 1e3,
+            'p99': percentile(latencies, 99) * 1e3}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Uno rules engine with all-bot tables')
+    parser.add_argument('--games', type=int, default=200, help='games to play per table size')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game, later games use seed + n')
+    parser.add_argument('--players', type=int, nargs='+', default=[2, 3, 4, 5, 6, 7], help='table sizes to run')
+    parser.add_argument('--max-turns', type=int, default=5000, help='give up on a game after this many turns')
+    parser.add_argument('--decisions', action='store_true', help='benchmark the bot strategies instead')
+    parser.add_argument('--budget', type=float, default=0.02, help='think time per decision for budgeted strategies')
+    args = parser.parse_args()
+
+    if args.decisions:
+        print(f"{'level':>7} {'decisions':>9} {'decisions/s':>11} {'win rate':>8} {'p50 ms':>8} {'p99 ms':>8}")
+        for level in STRATEGIES:
+            r = decisions(level, args.games if not STRATEGIES[level].budgeted else max(1, args.games // 20),
+                          args.seed, args.budget)
+            print(f"{r['level']:>7} {r['decisions']:>9} {r['decisions/s']:>11.0f} {r['win rate']:>8.2f} "
+                  f"{r['p50']:>8.3f} {r['p99']:>8.3f}")
+        return
+
+    print(f"{'players':>7} {'games':>6} {'done':>6} {'ticks':>8} {'games/s':>9} {'ticks/s':>10} "
+          f"{'p50 us':>8} {'p90 us':>8} {'p99 us':>8} {'max us':>8}")
+    for players in args.players:
+        r = benchmark(players, args.games, args.seed, args.max_turns)
+        print(f"{r['players']:>7} {r['games']:>6} {r['finished']:>6} {r['ticks']:>8} {r['games/s']:>9.1f} "
+              f"{r['ticks/s']:>10.0f} {r['p50']:>8.1f} {r['p90']:>8.1f} {r['p99']:>8.1f} {r['max']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
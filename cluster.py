@@ -0,0 +1,75 @@
+# Runs the bot as a cluster: the coordinator in this process and one worker process (main.py) per share of the shards,
+# so the games are spread over every core instead of all running on one.
+# Usage: python cluster.py [--workers N] [--shards N] [--socket PATH]
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+from dotenv import load_dotenv
+from utils.cluster import Coordinator
+from utils.database import Database
+from utils import logs
+
+logger = logging.getLogger('uno.cluster')
+
+
+def shardRanges(shards, workers):
+    """Split shard ids 0..shards-1 into ``workers`` contiguous, near-equal ranges."""
+    ranges = []
+    start = 0
+    for worker in range(workers):
+        end = start + shards // workers + (1 if worker < shards % workers else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return [shardIds for shardIds in ranges if shardIds]
+
+
+async def runWorker(worker, shardIds, shards, socket, stopping):
+    """Run one worker, restarting it if it exits while the cluster is still up."""
+    env = dict(os.environ, CLUSTER_WORKER=str(worker), CLUSTER_SOCKET=socket,
+               SHARD_IDS=','.join(map(str, shardIds)), SHARD_COUNT=str(shards))
+    while not stopping.is_set():
+        process = await asyncio.create_subprocess_exec(sys.executable, 'main.py', env=env)
+        logger.info(f'Started worker {worker} (pid {process.pid}) with shards {shardIds[0]}-{shardIds[-1]}')
+        waiter = asyncio.ensure_future(process.wait())
+        stopper = asyncio.ensure_future(stopping.wait())
+        await asyncio.wait((waiter, stopper), return_when=asyncio.FIRST_COMPLETED)
+        if stopping.is_set():
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+            waiter.cancel()
+            return
+        stopper.cancel()
+        logger.warning(f'Worker {worker} exited with {process.returncode}, restarting in 5 seconds')
+        await asyncio.sleep(5)
+
+
+async def main(workers, shards, socket):
+    db = Database('data/database.db')
+    db.setup()
+    coordinator = Coordinator(socket, db)
+    await coordinator.start()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    ranges = shardRanges(shards, workers)
+    await asyncio.gather(*[runWorker(worker, shardIds, shards, socket, stopping)
+                           for worker, shardIds in enumerate(ranges)])
+    await coordinator.close()
+    logger.info(f'Cluster stopped: {coordinator.counts}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the bot as a coordinator and a worker process per share '
+                                                 'of the shards')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--shards', type=int, default=None, help='total shards, defaults to one per worker')
+    parser.add_argument('--socket', default='data/cluster.sock')
+    args = parser.parse_args()
+    load_dotenv()
+    logs.setup('cluster.log')
+    asyncio.run(main(args.workers, args.shards or args.workers, args.socket))
@@ -1,18 +1,109 @@
+import io
 import logging
+import tracemalloc
 import discord
+from discord import option
 from discord.ext import commands
-import sqlite3 as sql
+from utils.metrics import registry as metrics
+from utils.profiling import Sampler, memoryTop, tableSizes
 
 
 class development(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.logger = logging.getLogger('discord')
+        self.logger = logging.getLogger('uno.dev')
+        self.sampler = Sampler()
+        self.memorySnapshot = None
 
     @commands.Cog.listener()
     async def on_ready(self):
         self.logger.info(f'Loaded {self.__class__.__name__}!')
 
+    @commands.Cog.listener()
+    async def on_application_command(self, ctx):
+        metrics.inc('commands_total', command=ctx.command.qualified_name)
+
+    @commands.Cog.listener()
+    async def on_application_command_error(self, ctx, error):
+        metrics.inc('command_errors_total', command=ctx.command.qualified_name, error=type(error).__name__)
+
+    @commands.slash_command(name='dbstats', description='Show database query timings')
+    @commands.is_owner()
+    async def dbstats(self, ctx):
+        """display the slowest queries by total time"""
+        embed = discord.Embed(title='Database', description='Query timings since startup', color=discord.Color.random())
+        for query, calls, total, slowest in self.bot.db.stats()[:10]:
+            embed.add_field(name=query[:250],
+                            value=f'{calls} calls, {total:.1f}ms total, {total / calls:.2f}ms avg, {slowest:.2f}ms max',
+                            inline=False)
+        await ctx.respond(embed=embed, ephemeral=True)
+
+    @commands.slash_command(name='metrics', description='Show the bot\'s metrics')
+    @commands.is_owner()
+    async def showMetrics(self, ctx):
+        """the same text the metrics endpoint serves, as a file when it won't fit in a message"""
+        await self.respondText(ctx, metrics.render(), 'metrics.txt')
+
+    @commands.slash_command(name='profile', description='Sample what the event loop is doing for a while')
+    @option(name='seconds', description='How long to sample for', required=False, type=int, min_value=1,
+            max_value=300)
+    @commands.is_owner()
+    async def profile(self, ctx, seconds: int = 10):
+        """sample the running bot's stack and show the hottest functions"""
+        if self.sampler.running:
+            await ctx.respond('The profiler is already running.', ephemeral=True)
+            return
+        await ctx.defer(ephemeral=True)
+        self.sampler.reset()
+        self.logger.info(f'Profiling for {seconds} seconds')
+        await self.bot.loop.run_in_executor(None, self.sampler.run, seconds)
+        await self.respondText(ctx, self.sampler.report(), 'profile.txt')
+
+    @commands.slash_command(name='profilestop', description='Stop the profiler early')
+    @commands.is_owner()
+    async def profilestop(self, ctx):
+        self.sampler.stop()
+        await ctx.respond('Stopped.' if self.sampler.running else 'The profiler is not running.', ephemeral=True)
+
+    @commands.slash_command(name='memory', description='Trace memory allocations')
+    @option(name='action', description='What to do', required=True, type=str,
+            choices=['start', 'top', 'diff', 'tables', 'stop'])
+    @commands.is_owner()
+    async def memory(self, ctx, action: str):
+        """start/stop tracemalloc, show where memory was allocated (or what grew since last time) and what each
+        table holds"""
+        if action == 'start':
+            tracemalloc.start(5)
+            await ctx.respond('Tracing memory allocations.', ephemeral=True)
+        elif action == 'stop':
+            tracemalloc.stop()
+            self.memorySnapshot = None
+            await ctx.respond('Stopped tracing memory allocations.', ephemeral=True)
+        elif action == 'tables':
+            lines = [f'{len(self.bot.games)} tables']
+            for table, size in tableSizes(self.bot.games, shared=(self.bot,))[:25]:
+                lines.append(f'{size / 1024:8.1f}KiB  {table.id} {table.status}, {len(table.players)} players, '
+                             f'{table.turns} turns')
+            await self.respondText(ctx, '\n'.join(lines), 'tables.txt')
+        elif not tracemalloc.is_tracing():
+            await ctx.respond('Start tracing first with `/memory start`.', ephemeral=True)
+        else:
+            await ctx.defer(ephemeral=True)
+            previous = self.memorySnapshot if action == 'diff' else None
+            report, self.memorySnapshot = await self.bot.loop.run_in_executor(None, memoryTop, previous)
+            await self.respondText(ctx, report, 'memory.txt')
+
+    async def respondText(self, ctx, text, filename):
+        """reply with text in a code block, or as a file when it won't fit in a message"""
+        if len(text) < 1900:
+            await ctx.respond(f'```\n{text}```', ephemeral=True)
+        else:
+            await ctx.respond(file=discord.File(io.BytesIO(text.encode()), filename=filename), ephemeral=True)
+
+
+metrics.describe('commands_total', 'counter', 'Slash commands used, by command')
+metrics.describe('command_errors_total', 'counter', 'Slash commands that raised, by command and error')
+
 
 def setup(bot):
     bot.add_cog(development(bot))
@@ -1,142 +1,198 @@
-from pprint import pprint
+import asyncio
 import discord
 from discord.ext import commands, tasks
-import random
-import sqlite3 as sql
 import logging
+import os
 from utils.game import Table
+from utils.interactions import decode
+from utils.metrics import registry as metrics
+from utils.rating import DEFAULT_RATING
+from utils.strategy import STRATEGIES
 import datetime
 
 
 class UnoGame(commands.Cog):
     def __init__(self, bot: commands.AutoShardedBot):
         self.bot = bot
-        self.logger = logging.getLogger('discord')
-        self.games = []
-        self.TableSize = 2
+        self.logger = logging.getLogger('uno.game')
+        self.bot.games.listeners.append(self.gameEnded)
+        self.TableSize = int(os.getenv('TABLE_SIZE', 4))  # players per table, bots fill any seats left empty
+        self.BotLevel = os.getenv('BOT_LEVEL', 'normal')  # which strategy the bots play, see utils.strategy
+        if self.BotLevel not in STRATEGIES:
+            raise ValueError(f'BOT_LEVEL must be one of {", ".join(STRATEGIES)}, not {self.BotLevel!r}')
+        self.matchmakerTask = None
+        self.started = False  # on_ready fires again on every reconnect
+
+    def cog_unload(self):
+        self.bot.games.listeners.remove(self.gameEnded)
 
     @commands.Cog.listener()
     async def on_ready(self):
         self.logger.info(f'Loaded {self.__class__.__name__}!')
-        self.logger.debug(f'Starting matchmaking controller')
+        self.logger.debug('Starting matchmaking controller')
+        if self.started:
+            return
+        self.started = True
+        for table in await self.bot.journal.recover(lambda snapshot: Table.restore(self.bot, snapshot)):
+            self.bot.games.add(table)
+            table.resume()
+        if self.bot.cluster is not None:
+            # the coordinator runs matchmaking and tells this worker which games to host
+            self.bot.cluster.handlers.update(create=self.hostGame, expired=self.queueExpired,
+                                             click=self.forwardedClick, rated=self.ratedElsewhere)
+            self.bot.cluster.hello = self.clusterHello
+            self.bot.cluster.start()
+            return
+        await self.bot.matchmaking.load()
+        self.matchmakerTask = self.bot.loop.create_task(self.matchmaker())
         self.matchmaking_controller.start()
 
-    @tasks.loop(seconds=5)
-    async def monitorActiveGames(self):
-        for i, game in enumerate(self.games):
-            if game.status == 'ended':
-                if game.winner is not None:
-                    # update the database with the winner's stats
-                    with sql.connect('data/database.db') as con:
-                        cur = con.cursor()
-                        if not game.winner.isBot:
-                            cur.execute('SELECT wins,losses FROM playerData WHERE playerID = ?', (game.winner.id,))
-                            fa = cur.fetchall()
-                            if not fa:
-                                cur.execute('INSERT INTO playerData VALUES (?,?,?)', (game.winner.id, 1, 0))
-                            else:
-                                cur.execute('UPDATE playerData SET wins = ? WHERE playerID = ?',
-                                            (fa[0][0] + 1, game.winner.id))
-                                await self.bot.get_user(game.winner.id).send(
-                                    f'You won the game against {", ".join([str(player.name) for player in game.players])}!',
-                                    delete_after=60)
-                        # update the database with the loser's stats
-                        for player in game.players:
-                            if not player.isBot and player != game.winner:
-                                cur.execute('SELECT wins,losses FROM playerData WHERE playerID = ?', (player.id,))
-                                fa = cur.fetchall()
-                                if not fa:
-                                    cur.execute('INSERT INTO playerData VALUES (?,?,?)', (player.id, 0, 1))
-                                else:
-                                    cur.execute('UPDATE playerData SET losses = ? WHERE playerID = ?',
-                                                (fa[0][1] + 1, player.id))
-                                    await self.bot.get_user(player.id).send(
-                                        f'You lost the game against {", ".join([str(p.name) for p in game.players])}!',
-                                        delete_after=60)
-
-                    con.commit()
-                self.games.remove(game)
-                self.logger.info(f'Removed game {i} from the active games list as it has ended')
-            elif game.status == 'cancelled':
-                self.games.remove(game)
-                self.logger.info(f'Removed game {i} from the active games list as it was cancelled')
+    @commands.Cog.listener()
+    async def on_interaction(self, interaction: discord.Interaction):
+        """The one handler for every game button; the custom_id says which table, seat and move it's for."""
+        if interaction.type != discord.InteractionType.component:
+            return
+        route = decode(interaction.data.get('custom_id', ''))
+        if route is None:
+            return
+        tableId, seat, action, arg, version = route
+        table = self.bot.games.get(tableId)
+        if table is None and self.bot.cluster is not None:
+            # DMs all arrive on shard 0, so clicks for games hosted by other workers are passed on to them
+            await interaction.response.defer()
+            self.bot.cluster.send('click', game=tableId, user=interaction.user.id, action=action, seat=seat, arg=arg,
+                                  version=version)
+        elif table is None:
+            await interaction.response.send_message("This game has already ended!", delete_after=5)
+        else:
+            await table.interact(interaction, action, seat, arg, version)
+
+    def clusterHello(self):
+        """What this worker tells the coordinator whenever it connects."""
+        return {'games': [[table.id, [player.id for player in table.players if not player.isBot]]
+                          for table in self.bot.games],
+                'owner': self.bot.owner_id, 'tableSize': self.TableSize, 'botLevel': self.BotLevel}
+
+    async def hostGame(self, players, bots, botLevel=None):
+        self.createGame(players, bots, botLevel)
+
+    async def queueExpired(self, user):
+        self.bot.resolver.dm(user, 'You were removed from the queue because you were inactive for too long!',
+                             delete_after=60)
+
+    async def forwardedClick(self, game, user, action, seat, arg, version):
+        table = self.bot.games.get(game)
+        error = "This game has already ended!" if table is None else table.click(user, action, seat, arg, version)
+        if error is not None:
+            self.bot.resolver.dm(user, error, delete_after=5)
+
+    async def gameEnded(self, game):
+        """Called by the game registry as soon as a table ends or is cancelled."""
+        if game.status == 'ended' and game.winner is not None:
+            await self.recordGame(game)
+
+    async def recordGame(self, game):
+        """Write a finished game's results and history in one transaction, then tell the players how they did."""
+        humans = [player for player in game.players if not player.isBot]
+        # the winner first, then everyone else by how few cards they were left holding
+        placings = sorted(game.players, key=lambda player: (player is not game.winner, len(player.hand)))
+        start = self.bot.loop.time()
+        results = await self.bot.ratings.results([(player.id, player.isBot) for player in placings])
+        statements = [('INSERT INTO matches (matchID, startedAt, endedAt, winnerID, turns) VALUES (?, ?, ?, ?, ?)',
+                       (game.id, game.startedAt, int(datetime.datetime.now().timestamp()), game.winner.id,
+                        game.turns))]
+        statements += [('INSERT INTO match_players (matchID, playerID, isBot, cardsLeft, won, ratingChange) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (game.id, player.id, player.isBot, len(player.hand), player is game.winner,
+                          results[player.id][1] if player.id in results else 0))
+                       for player in game.players]
+        # stored as changes rather than new ratings, so games recorded at the same time by other cluster workers
+        # aren't overwritten
+        changes = {playerID: change for playerID, (_, change) in results.items()}
+        for player in humans:
+            if player is game.winner:
+                statements.append(('INSERT INTO playerData (playerID, wins, losses, rating) VALUES (?, 1, 0, ?) '
+                                   'ON CONFLICT (playerID) DO UPDATE SET wins = wins + 1, rating = rating + ?',
+                                   (player.id, DEFAULT_RATING + changes[player.id], changes[player.id])))
+            else:
+                statements.append(('INSERT INTO playerData (playerID, wins, losses, rating) VALUES (?, 0, 1, ?) '
+                                   'ON CONFLICT (playerID) DO UPDATE SET losses = losses + 1, rating = rating + ?',
+                                   (player.id, DEFAULT_RATING + changes[player.id], changes[player.id])))
+        try:
+            await self.bot.db.transaction(statements)
+        except Exception as e:
+            # the players still hear how the game went, just without a rating change that was never saved
+            self.logger.error(f'Failed to record the results of game {game.id}: {e!r}')
+            saved = False
+        else:
+            await self.bot.ratings.apply(changes, game.winner.id)
+            if self.bot.cluster is not None:
+                # the other workers cache these players' ratings too
+                self.bot.cluster.send('rated', changes=list(changes.items()), winner=game.winner.id)
+            metrics.observe('record_game_seconds', self.bot.loop.time() - start)
+            saved = True
+        names = ", ".join([str(player.name) for player in game.players])
+        await asyncio.gather(*[self.bot.resolver.dm(player.id,
+            f'You {"won" if player is game.winner else "lost"} the game against {names}! ' + (
+                f'Your rating is now {self.bot.ratings.players[player.id].rating:.0f} '
+                f'({changes[player.id]:+.0f}).' if saved else
+                'Your rating could not be updated this time.'), delete_after=60)
+            for player in humans], return_exceptions=True)
+
+    async def ratedElsewhere(self, changes, winner):
+        """Another cluster worker recorded a game."""
+        await self.bot.ratings.apply(dict(changes), winner)
+
+    def inGame(self, userId):
+        return userId in self.bot.games
+
+    async def matchmaker(self):
+        """Form tables as soon as someone joins the queue instead of waiting for the next timer tick."""
+        queue = self.bot.matchmaking
+        while True:
+            await queue.changed.wait()
+            queue.changed.clear()
+            self.matchmake()
 
     @tasks.loop(seconds=10)
     async def matchmaking_controller(self):
-        with sql.connect('data/database.db') as con:
-            cur = con.cursor()
-            cur.execute('SELECT * FROM queue')
-            # row 0 = user_id, row 1 = bots, row 2 = timestamp
-            queue = [(row[0], row[1], row[2]) for row in cur.fetchall()]
-            # if timestamp is more than 5 minutes ago, remove the user from the queue and send them a DM
-            for row in queue:
-                if datetime.datetime.now().timestamp() - row[2] > 500:
-                    cur.execute('DELETE FROM queue WHERE user_id=?', (row[0],))
-                    await self.bot.get_user(row[0]).send(
-                        'You were removed from the queue because you were inactive for too long!', delete_after=60)
-                    self.logger.info(f'Removed user {row[0]} from the queue because they were inactive for too long')
-            # remove the users who are already in a game from the queue
-            for game in self.games:
-                for player in game.players:
-                    if not player.isBot and (player.id,) in queue:
-                        cur.execute('DELETE FROM queue WHERE user_id=?', (player.id,))
-                        self.logger.info(f'Removed user {player.id} from the queue because they are already in a game')
-            playerData = {}
-            # sort the queue by the number of games they've played
-            for player in queue:
-                cur.execute('SELECT wins,losses,playerID FROM playerData WHERE playerID = ?', (player[0],))
-                fa = cur.fetchall()
-                if not fa:
-                    playerData[player[0]] = (0, 0)
-                else:
-                    playerData[player[0]] = (fa[0][0], fa[0][1])
-            # organise into two lists, one with players who want to play with bots and one with players who don't
-            playersWithBots = []
-            playersWithoutBots = []
-            for player in queue:
-                if player[1] == 1:
-                    playersWithBots.append((player[0], playerData[player[0]]))
-                else:
-                    playersWithoutBots.append((player[0], playerData[player[0]]))
-            # sort the lists by the win/loss ratio
-            playersWithBots.sort(key=lambda x: x[1][0] / x[1][1] if x[1][1] != 0 else x[1][0])
-            playersWithoutBots.sort(key=lambda x: x[1][0] / x[1][1] if x[1][1] != 0 else x[1][0])
-            players = []
-            for i in range(min(len(playersWithBots), self.TableSize)):
-                players.append(playersWithBots[i][0])
-            if len(players) > 2 or (len(players) == 1 and players[0] == 234248229426823168):
-                # create a game with the players and bots
-                self.games.append(Table(players, self.bot))
-                for player in players:
-                    cur.execute('DELETE FROM queue WHERE user_id=?', (player,))
-                    players[players.index(player)] = self.bot.get_user(player)
-                con.commit()
-                self.bot.loop.create_task(self.games[-1].setup(True))
-                self.logger.info(f'Created a game with players {", ".join([str(player) for player in players])}')
-                try:
-                    self.monitorActiveGames.start()
-                except RuntimeError:
-                    self.logger.debug(f'Active game monitor already running')
-                return True
-            # take the top players from the list of players who don't want to play with bots (upto the table size)
-            players = []
-            for i in range(min(len(playersWithoutBots), self.TableSize)):
-                players.append(playersWithoutBots[i][0])
-            if len(players) > 1:  # there has to be at least 2 players to start a game
-                # create a game with the players and no bots
-                self.games.append(Table(players, self.bot))
-                for player in players:
-                    cur.execute('DELETE FROM queue WHERE user_id=?', (player,))
-                    players[players.index(player)] = self.bot.get_user(player)
-                con.commit()
-                self.bot.loop.create_task(self.games[-1].setup(False))
-                self.logger.info(f'Created a game with players {", ".join([str(player) for player in players])}')
-                try:
-                    self.monitorActiveGames.start()
-                except RuntimeError:
-                    self.logger.debug(f'Active game monitor already running')
-                con.commit()
-                return True
+        queue = self.bot.matchmaking
+        # if timestamp is more than 5 minutes ago, remove the user from the queue and send them a DM
+        for ticket in queue.expired(datetime.datetime.now().timestamp() - 500):
+            queue.dequeue(ticket.userId)
+            self.bot.resolver.dm(ticket.userId,
+                                 'You were removed from the queue because you were inactive for too long!',
+                                 delete_after=60)
+            self.logger.info(f'Removed user {ticket.userId} from the queue because they were inactive for too long')
+        # also picks up anyone who has now waited long enough to be given bots
+        self.matchmake()
+
+    def matchmake(self):
+        """Split the queue into as many tables as it can make. Returns how many games were created."""
+        queue = self.bot.matchmaking
+        # remove the users who are already in a game from the queue
+        inGame = [userId for userId in queue.tickets if userId in self.bot.games]
+        if inGame:
+            queue.dequeue(*inGame)
+            self.logger.info(f'Removed users {inGame} from the queue because they are already in a game')
+        tables = queue.partition(self.TableSize, datetime.datetime.now().timestamp(), solo=(self.bot.owner_id,))
+        for players, bots in tables:
+            self.createGame(players, bots)
+        return len(tables)
+
+    def createGame(self, players, bots, botLevel=None):
+        self.bot.matchmaking.matched(players, datetime.datetime.now().timestamp())
+        table = Table(players, self.bot, botLevel=botLevel or self.BotLevel)
+        table.settings['seats'] = self.TableSize
+        self.bot.games.add(table)
+        metrics.inc('tables_created_total', bots=str(bool(bots)).lower())
+        self.bot.loop.create_task(table.setup(bots))
+        self.logger.info(f'Created a game with players {", ".join([self.bot.resolver.name(player) for player in players])}')
+
+
+metrics.describe('record_game_seconds', 'histogram', 'Time to write a finished game and its rating changes')
+metrics.describe('tables_created_total', 'counter',
+                 'Tables created by matchmaking, by whether bots fill the empty seats')
 
 
 def setup(bot):
@@ -1,69 +1,119 @@
 # A Cog for handling the queue system for multiplayer games in the bot.
+import asyncio
 import datetime
 import discord
 from discord import option
 from discord.ext import commands, tasks
-import sqlite3 as sql
 import logging
+from utils.metrics import registry as metrics
 
 
 class Multiplayer(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.logger = logging.getLogger('discord')
+        self.logger = logging.getLogger('uno.matchmaking')
+        self.presence = None  # the text last shown, so presence is only sent when it changes
 
     # event listeners
     @commands.Cog.listener()
     async def on_ready(self):
         self.logger.info(f'Loaded {self.__class__.__name__}!')
-        self.update_presence.start()
+        if not self.update_presence.is_running():
+            self.update_presence.start()
+
+    async def queueStats(self):
+        """Players queued, games running, players in them and the median recent wait, from memory."""
+        if self.bot.cluster is not None:
+            # the coordinator has the whole cluster's queue and games
+            return await self.bot.cluster.request('stats')
+        return {'queue': len(self.bot.matchmaking), 'games': len(self.bot.games),
+                'players': len(self.bot.games.players),
+                'wait': self.bot.matchmaking.waits.estimate(datetime.datetime.now().timestamp())}
+
+    @staticmethod
+    def approximate(seconds):
+        """A wait rounded coarsely enough that the presence doesn't change with every match."""
+        if seconds is None:
+            return 'no recent matches'
+        if seconds < 60:
+            return f'~{max(10, round(seconds, -1)):.0f}s wait'
+        if seconds < 600:
+            return f'~{round(seconds / 60):.0f}m wait'
+        return f'~{round(seconds / 600) * 10:.0f}m wait'
 
     @tasks.loop(seconds=10)
     async def update_presence(self):
-        with sql.connect('data/database.db') as con:
-            cur = con.cursor()
-            cur.execute('SELECT * FROM queue')
-            queue = len(cur.fetchall())
-            # update presence with the number of players in the queue and an average wait time
-            await self.bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching,
-                                                                     name=f'{queue} players in queue |'
-                                                                          f' {queue * 5} seconds average wait time'))
+        try:
+            stats = await self.queueStats()
+        except (ConnectionError, asyncio.TimeoutError):
+            return
+        presence = (f'{stats["queue"]} players in queue | {stats["players"]} playing in {stats["games"]} games | '
+                    f'{self.approximate(stats["wait"])}')
+        if presence == self.presence:
+            return
+        self.presence = presence
+        await self.bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name=presence))
 
     async def test_DM(self, user: discord.User):
         # This function will check weather it is possible to DM a user.
+        # Users the bot has DMed recently are known to be reachable, so only unknown users get a test message.
+        if await self.bot.reachability.reachable(user.id):
+            metrics.inc('dm_checks_total', result='cached')
+            return True
         try:
-            message = await self.bot.get_user(user.id).send("This is a test message to check if I can DM you.",
-                                                            delete_after=1,
-                                                            silent=True)
+            message = await user.send("This is a test message to check if I can DM you.", silent=True)
             await message.delete()
-        except discord.errors.Forbidden:
-            self.logger.error(f"Failed to DM User {user.id}")
-            return False
-        except discord.errors.HTTPException:
+        except discord.errors.HTTPException as e:
             self.logger.error(f"Failed to DM User {user.id}")
+            metrics.inc('dm_checks_total', result='unreachable')
+            if isinstance(e, discord.errors.Forbidden):
+                self.bot.reachability.clear(user.id)
             return False
         else:
+            metrics.inc('dm_checks_total', result='probed')
+            self.bot.reachability.mark(user.id)
             return True
 
+    async def join(self, userId, bots):
+        """Join the queue, or leave it if already in it. Returns ``joined``, ``left`` or ``ingame``."""
+        rating = await self.bot.ratings.get(userId)
+        if self.bot.cluster is not None:
+            # the coordinator owns the queue in cluster mode
+            return await self.bot.cluster.request('search', user=userId, bots=bots, skill=rating.rating)
+        game = self.bot.get_cog('UnoGame')
+        if game is not None and game.inGame(userId):
+            return 'ingame'
+        if userId in self.bot.matchmaking:
+            self.bot.matchmaking.dequeue(userId)
+            return 'left'
+        # get unix epoch timestamp
+        self.bot.matchmaking.enqueue(userId, bots, datetime.datetime.now().timestamp(), rating.rating)
+        return 'joined'
+
     @commands.slash_command(name='search', description='Search for a game')
     @option(name='bots', description='Whether to include bots in the game', required=False, type=bool)
     async def search(self, ctx: discord.ApplicationContext, bots: bool = True):
         if await self.test_DM(ctx.author):
-            with sql.connect('data/database.db') as con:
-                cur = con.cursor()
-                cur.execute('SELECT * FROM queue WHERE user_id=?', (ctx.author.id,))
-                if cur.fetchone() is None:
-                    # get unix epoch timestamp
-                    cur.execute('INSERT INTO queue VALUES (?, ?, ?)', (ctx.author.id, bots, datetime.datetime.now().timestamp()))
-                    await ctx.respond(f'{ctx.author.mention} has joined the queue!', ephemeral=True, delete_after=5)
-                else:
-                    cur.execute('DELETE FROM queue WHERE user_id=?', (ctx.author.id, ))
-                    await ctx.respond(f'{ctx.author.mention} has left the queue!', ephemeral=True, delete_after=5)
-                con.commit()
+            try:
+                result = await self.join(ctx.author.id, bots)
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                self.logger.error(f'Could not reach the coordinator for {ctx.author.id}: {e!r}')
+                await ctx.respond('Matchmaking is unavailable right now, please try again shortly.', ephemeral=True,
+                                  delete_after=10)
+                return
+            metrics.inc('searches_total', result=result)
+            if result == 'ingame':
+                await ctx.respond('You are already in a game!', ephemeral=True, delete_after=5)
+            elif result == 'joined':
+                await ctx.respond(f'{ctx.author.mention} has joined the queue!', ephemeral=True, delete_after=5)
+            else:
+                await ctx.respond(f'{ctx.author.mention} has left the queue!', ephemeral=True, delete_after=5)
         else:
             await ctx.respond('I was unable to DM you! Please allow me to send you DMs and try again.', ephemeral=True,
                               delete_after=10)
 
+metrics.describe('searches_total', 'counter', 'Uses of /search, by whether they joined or left the queue')
+
 
 def setup(bot):
     bot.add_cog(Multiplayer(bot))
@@ -2,14 +2,70 @@ import logging
 import discord
 from discord import option
 from discord.ext import commands
-from discord.ext.pages import Paginator, Page
-import sqlite3 as sql
+
+
+class LeaderboardView(discord.ui.View):
+    """Pages through every rated player, reading each page from the database only when it's asked for."""
+
+    def __init__(self, bot, authorId, pageSize=10):
+        super().__init__(timeout=180)
+        self.bot = bot
+        self.authorId = authorId
+        self.pageSize = pageSize
+        self.cursors = [None]  # the (rating, player id) each page starts after
+        self.page = 0
+        self.rows = []
+        self.ranks = []  # each row's rank, from the same index /stats uses so ties agree
+        self.more = False
+
+    async def load(self):
+        ratings = self.bot.ratings
+        if self.page == 0 and self.pageSize == ratings.leaderboardSize:
+            rows = await ratings.leaderboard()
+        else:
+            rows = await ratings.page(self.cursors[self.page], self.pageSize + 1)
+        # both hold one row past the page, if there is one
+        self.more = len(rows) > self.pageSize
+        rows = rows[:self.pageSize]
+        self.rows = rows
+        ranks = await ratings.rankIndex()
+        self.ranks = [ranks.rank(row.rating) for row in rows]
+        if self.more and len(self.cursors) == self.page + 1:
+            self.cursors.append((rows[-1].rating, rows[-1].playerID))
+        self.previous.disabled = self.page == 0
+        self.next.disabled = not self.more
+
+    def embed(self):
+        embed = discord.Embed(title='Leaderboard', color=discord.Color.random())
+        for rank, rating in zip(self.ranks, self.rows):
+            embed.add_field(name=f'{rank}. {self.bot.resolver.name(rating.playerID)}'
+                                 f' ({rating.rating:.0f} rating, {rating.wins} wins, {rating.losses} losses)',
+                            value="",
+                            inline=False)
+        embed.set_footer(text=f'Page {self.page + 1}')
+        return embed
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.authorId
+
+    async def turn(self, interaction, page):
+        self.page = page
+        await self.load()
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.blurple, disabled=True)
+    async def previous(self, button, interaction):
+        await self.turn(interaction, max(self.page - 1, 0))
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.blurple)
+    async def next(self, button, interaction):
+        await self.turn(interaction, self.page + 1)
 
 
 class Stats(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.logger = logging.getLogger('discord')
+        self.logger = logging.getLogger('uno.stats')
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -21,47 +77,32 @@ class Stats(commands.Cog):
         """This command will get the stats of a user. If no user is specified, it will get the stats of the user who ran the command."""
         if user is None:
             user = ctx.author
-        with sql.connect('data/database.db') as con:
-            cur = con.cursor()
-            cur.execute('SELECT wins,losses FROM playerData WHERE playerID = ?', (user.id,))
-            fa = cur.fetchall()
-            if not fa:
-                await ctx.respond(f'{user.name} has not played any games yet!', ephemeral=True, delete_after=10)
-            else:
-                embed = discord.Embed(title=f'{user.name} has won {fa[0][0]} games and lost {fa[0][1]} games!',
-                                      description='',
-                                      color=discord.Color.random())
-                embed.add_field(name='Win/Loss Ratio', value=f'{round(fa[0][0] / fa[0][1], 2) if fa[0][1] != 0 else "N/A"}')
-                embed.add_field(name='Win Percentage', value=f'{round(fa[0][0] / (fa[0][0] + fa[0][1]), 2)*100 if fa[0][0] + fa[0][1] != 0 else 0}%')
-                embed.add_field(name='Total Games Played', value=f'{fa[0][0] + fa[0][1]}')
-                embed.add_field(name='Total Games Won', value=f'{fa[0][0]}')
-                embed.add_field(name='Total Games Lost', value=f'{fa[0][1]}')
-                embed.set_author(name=f"{user.name}'s stats", icon_url=user.avatar.url)
-                await ctx.respond(embed=embed, delete_after=120)
+        rating = await self.bot.ratings.get(user.id)
+        if not rating.played:
+            await ctx.respond(f'{user.name} has not played any games yet!', ephemeral=True, delete_after=10)
+        else:
+            wins, losses = rating.wins, rating.losses
+            embed = discord.Embed(title=f'{user.name} has won {wins} games and lost {losses} games!',
+                                  description='',
+                                  color=discord.Color.random())
+            embed.add_field(name='Rating', value=f'{rating.rating:.0f}')
+            rank, ranked = await self.bot.ratings.rank(user.id)
+            embed.add_field(name='Rank', value=f'#{rank:,} of {ranked:,}')
+            embed.add_field(name='Win/Loss Ratio', value=f'{round(wins / losses, 2) if losses != 0 else "N/A"}')
+            embed.add_field(name='Win Percentage', value=f'{round(wins / (wins + losses), 2)*100 if wins + losses != 0 else 0}%')
+            embed.add_field(name='Total Games Played', value=f'{wins + losses}')
+            embed.add_field(name='Total Games Won', value=f'{wins}')
+            embed.add_field(name='Total Games Lost', value=f'{losses}')
+            embed.set_author(name=f"{user.name}'s stats", icon_url=user.avatar.url)
+            await ctx.respond(embed=embed, delete_after=120)
 
     @commands.slash_command(name='leaderboard', description='Get the leaderboard')
     async def leaderboard(self, ctx):
-        """display top 10 players"""
+        """display every player, 10 per page"""
         await ctx.defer()
-        with sql.connect('data/database.db') as con:
-            cur = con.cursor()
-            cur.execute('SELECT playerID,wins,losses FROM playerData ORDER BY wins DESC LIMIT 10')
-            fa = cur.fetchall()
-            pages = []
-            # display 10 users per page
-            for i in range(0, len(fa), 10):
-                embed = discord.Embed(title='Leaderboard', color=discord.Color.random())
-                for j in range(i, i + 10):
-                    if j < len(fa):
-                        embed.add_field(name=f'{j + 1}. '
-                                             f'{self.bot.get_user(fa[j][0]).name if self.bot.get_user(fa[j][0]) else "Unknown User"}'
-                                             f'({fa[j][1]} wins, {fa[j][2]} losses)',
-                                        value="",
-                                        inline=False)
-                pages.append(embed)
-            paginator = Paginator(pages=pages)
-            await paginator.respond(ctx.interaction)
-
+        view = LeaderboardView(self.bot, ctx.author.id)
+        await view.load()
+        await ctx.respond(embed=view.embed(), view=view)
 
     @commands.slash_command(name='info', description='Get info about the bot')
     async def info(self, ctx):
@@ -0,0 +1,470 @@
+# Runs the real cogs against an in-process stand-in for Discord's gateway and REST API, with simulated users
+# searching, playing and going AFK, and reports how the bot holds up. Needs no network or token.
+# Usage: python loadtest.py [--users N] [--duration SECONDS] [--afk FRACTION] [--think SECONDS] [--latency SECONDS]
+import argparse
+import asyncio
+import logging
+import random
+import tempfile
+import time
+from collections import Counter
+import discord
+from benchmark import percentile
+from cogs.game import UnoGame
+from cogs.queue import Multiplayer
+from cogs.stats import Stats
+from utils.database import Database
+from utils.interactions import PLAY, DRAW, CHOOSE, decode
+from utils.journal import Journal
+from utils.matchmaking import MatchmakingIndex
+from utils.metrics import registry as metrics
+from utils.outbound import Outbound
+from utils.rating import Ratings
+from utils.reachability import Reachability
+from utils.registry import GameRegistry
+from utils.resolver import Resolver
+from utils.timers import Timers
+
+
+class FakeResponse:
+    """The parts of an aiohttp response discord.HTTPException reads."""
+
+    def __init__(self, status, reason, headers=None):
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+
+
+class FakeRest:
+    """Discord's REST API as the bot uses it: a delay per request, the per-channel and global rate limits, counts.
+
+    Like py-cord's HTTP client, a request that gets a 429 sleeps for its Retry-After and tries again, and only after
+    ``tries`` attempts does the bot see the HTTPException.
+    """
+
+    def __init__(self, rng, latency=0.05, channelRate=1, channelBurst=5, globalRate=50, tries=5):
+        self.rng = rng
+        self.latency = latency
+        self.channelRate = channelRate
+        self.channelBurst = channelBurst
+        self.globalRate = globalRate
+        self.tries = tries
+        self.buckets = {}  # channel id -> [tokens, updated]
+        self.calls = Counter()  # kind of request -> count, retries included
+        self.ratelimited = Counter()  # kind of request -> 429s, retried or not
+        self.lost = Counter()  # kind of request -> requests that failed with a 429 after every try
+
+    def take(self, key, rate, burst):
+        """Take a token, returning 0, or how many seconds until there is one if the bucket is empty."""
+        now = time.monotonic()
+        bucket = self.buckets.setdefault(key, [burst, now])
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return (1 - bucket[0]) / rate
+        bucket[0] -= 1
+        return 0
+
+    async def request(self, kind, channelId=None, limited=True):
+        """One request. Interaction responses aren't ``limited`` by the global rate limit, just as on Discord."""
+        for attempt in range(self.tries):
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+            self.calls[kind] += 1
+            retryAfter = limited and self.take('global', self.globalRate, self.globalRate) or (
+                channelId is not None and self.take(channelId, self.channelRate, self.channelBurst))
+            if not retryAfter:
+                return
+            self.ratelimited[kind] += 1
+            if attempt < self.tries - 1:
+                await asyncio.sleep(retryAfter)
+        self.lost[kind] += 1
+        raise discord.HTTPException(FakeResponse(429, 'Too Many Requests', {'Retry-After': str(retryAfter)}),
+                                    'You are being rate limited.')
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None, view=None):
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.view = view
+        self.deleted = False
+
+    async def edit(self, content=None, embed=None, view=None):
+        await self.channel.rest.request('edit', self.channel.id)
+        self.content = content
+        self.embed = embed
+        self.view = view
+        self.channel.user.client.received(self)
+        return self
+
+    async def delete(self, delay=None):
+        """Like discord.Message.delete: with a ``delay`` it returns at once and a failed delete is ignored."""
+        if delay is None:
+            return await self.remove('delete')
+
+        async def later():
+            await asyncio.sleep(delay)
+            try:
+                await self.remove('delayed_delete')
+            except discord.HTTPException:
+                pass
+        asyncio.get_running_loop().create_task(later())
+
+    async def remove(self, kind):
+        if self.deleted:
+            return
+        await self.channel.rest.request(kind, self.channel.id)
+        self.deleted = True
+
+
+class FakeChannel:
+    def __init__(self, user, rest):
+        self.id = user.id + 1
+        self.user = user
+        self.rest = rest
+
+    async def send(self, content=None, embed=None, view=None, delete_after=None, silent=False):
+        await self.rest.request('send', self.id)
+        if not self.user.dmsOpen:
+            raise discord.Forbidden(FakeResponse(403, 'Forbidden'), 'Cannot send messages to this user')
+        message = FakeMessage(self, content, embed, view)
+        if delete_after is not None:
+            await message.delete(delay=delete_after)
+        self.user.client.received(message)
+        return message
+
+
+class FakeAvatar:
+    url = 'https://cdn.discordapp.com/embed/avatars/0.png'
+
+
+class FakeUser:
+    def __init__(self, userId, rest, client, dmsOpen=True):
+        self.id = userId
+        self.name = f'user{userId}'
+        self.mention = f'<@{userId}>'
+        self.avatar = FakeAvatar()
+        self.rest = rest
+        self.client = client
+        self.dmsOpen = dmsOpen
+        self.dm_channel = None
+
+    async def create_dm(self):
+        await self.rest.request('create_dm')
+        self.dm_channel = FakeChannel(self, self.rest)
+        return self.dm_channel
+
+    async def send(self, content=None, **kwargs):
+        return await (self.dm_channel or await self.create_dm()).send(content, **kwargs)
+
+
+class FakeInteractionResponse:
+    def __init__(self, rest, interaction):
+        self.rest = rest
+        self.interaction = interaction
+
+    async def defer(self, ephemeral=False):
+        await self.rest.request('interaction', limited=False)
+
+    async def send_message(self, content=None, delete_after=None, ephemeral=False, **kwargs):
+        await self.rest.request('interaction', limited=False)
+        self.interaction.rejected = True
+
+    async def edit_message(self, **kwargs):
+        await self.rest.request('interaction', limited=False)
+
+
+class FakeInteraction:
+    """A button click, or the interaction behind a slash command."""
+    type = discord.InteractionType.component
+
+    def __init__(self, user, customId=None):
+        self.user = user
+        self.data = {'custom_id': customId} if customId is not None else {}
+        self.response = FakeInteractionResponse(user.rest, self)
+        self.rejected = False
+
+
+class FakeContext:
+    """The ApplicationContext a slash command callback gets."""
+
+    def __init__(self, user):
+        self.author = user
+        self.interaction = FakeInteraction(user)
+        self.responded = False
+
+    async def defer(self, ephemeral=False):
+        self.responded = True
+        await self.author.rest.request('interaction', limited=False)
+
+    async def respond(self, content=None, ephemeral=False, delete_after=None, **kwargs):
+        await self.author.rest.request('followup' if self.responded else 'interaction', limited=False)
+        self.responded = True
+        self.content = content
+
+
+class LoadTestRegistry(GameRegistry):
+    """The game registry, shortening every new table's AFK timeouts so AFK players are dealt with within the test."""
+
+    def __init__(self, afkTimeout):
+        super().__init__()
+        self.afkTimeout = afkTimeout
+
+    def add(self, table):
+        table.settings['afkTimeout'] = self.afkTimeout
+        table.settings['afkGrace'] = self.afkTimeout / 2
+        table.settings['choiceTimeout'] = self.afkTimeout
+        super().add(table)
+
+
+class FakeBot:
+    """What the cogs use of the bot: the shared objects main.py sets up, a user cache and presence."""
+
+    def __init__(self, rest, directory, loop, afkTimeout):
+        self.rest = rest
+        self.loop = loop
+        self.owner_id = 0
+        self.cluster = None
+        self.users = {}  # user id -> FakeUser
+        self.cogs = {}
+        self.presenceUpdates = 0
+        self.db = Database(f'{directory}/database.db')
+        self.matchmaking = MatchmakingIndex(self.db)
+        self.ratings = Ratings(self.db)
+        self.outbound = Outbound()
+        self.reachability = Reachability(self.db)
+        self.outbound.observers.append(self.reachability.observe)
+        self.resolver = Resolver(self)
+        self.games = LoadTestRegistry(afkTimeout)
+        self.timers = Timers()
+        self.journal = Journal(f'{directory}/games')
+        self.metrics = metrics
+
+    def get_user(self, userId):
+        return self.users.get(userId)
+
+    async def fetch_user(self, userId):
+        await self.rest.request('fetch_user')
+        return self.users[userId]
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    async def change_presence(self, activity=None):
+        self.presenceUpdates += 1
+
+
+class Results:
+    def __init__(self):
+        self.searches = Counter()  # how /search answered
+        self.waits = []  # seconds from /search to the first game message
+        self.renders = []  # seconds from a click to the clicker's game message changing
+        self.clicks = 0
+        self.rejected = 0  # clicks the table refused, e.g. stale buttons
+        self.afk = 0  # players who stopped clicking mid game
+        self.unmatched = 0  # searches that never got a game before the test ended
+        self.games = Counter()  # how tables ended
+
+
+class SimulatedUser:
+    """One person using the bot: searches, plays their turns after a think time, sometimes goes AFK, repeats."""
+
+    def __init__(self, harness, userId, dmsOpen):
+        self.harness = harness
+        self.rng = random.Random(harness.rng.random())
+        self.user = FakeUser(userId, harness.rest, self, dmsOpen)
+        self.gameMessage = None
+        self.searchedAt = None
+        self.clickedAt = None
+        self.matched = asyncio.Event()
+        self.acting = None
+        self.actions = 0
+        self.afkAfter = None  # actions before going AFK in the current game, None to play it out
+
+    def buttons(self, message):
+        if message.view is None:
+            return []
+        routes = ((decode(item.custom_id), item) for item in message.view.children
+                  if getattr(item, 'custom_id', None))
+        return [(route, item) for route, item in routes if route is not None]
+
+    def received(self, message):
+        """A message in this user's DMs was sent or edited."""
+        buttons = self.buttons(message)
+        now = time.monotonic()
+        if any(route[2] == CHOOSE for route, _ in buttons):
+            # answered even while the click that asked for it is still being handled
+            asyncio.get_running_loop().create_task(
+                self.click(message, self.rng.uniform(0.2, 1) * self.harness.think))
+            return
+        if not buttons:
+            return
+        self.gameMessage = message
+        if self.searchedAt is not None:
+            self.harness.results.waits.append(now - self.searchedAt)
+            self.searchedAt = None
+            self.actions = 0
+            self.afkAfter = self.rng.randint(1, 10) if self.rng.random() < self.harness.afk else None
+            self.matched.set()
+        if self.clickedAt is not None:
+            self.harness.results.renders.append(now - self.clickedAt)
+            self.clickedAt = None
+        if any(not item.disabled for _, item in buttons):
+            self.act(message, delay=self.rng.uniform(0.5, 1.5) * self.harness.think)
+
+    def act(self, message, delay):
+        if self.acting is not None and not self.acting.done():
+            return
+        if self.afkAfter is not None and self.actions >= self.afkAfter:
+            if self.actions == self.afkAfter:
+                self.harness.results.afk += 1
+                self.actions += 1
+            return
+        self.acting = asyncio.get_running_loop().create_task(self.click(message, delay))
+
+    async def click(self, message, delay):
+        await asyncio.sleep(delay)
+        enabled = [(route, item) for route, item in self.buttons(message) if not item.disabled]
+        if not enabled:
+            return
+        chooses = [item for route, item in enabled if route[2] == CHOOSE]
+        plays = [item for route, item in enabled if route[2] == PLAY]
+        draws = [item for route, item in enabled if route[2] == DRAW]
+        item = self.rng.choice(chooses or plays or draws)
+        interaction = FakeInteraction(self.user, item.custom_id)
+        self.actions += 1
+        self.harness.results.clicks += 1
+        if not chooses:
+            self.clickedAt = time.monotonic()
+        await self.harness.game.on_interaction(interaction)
+        if interaction.rejected:
+            self.harness.results.rejected += 1
+            self.clickedAt = None
+
+    async def run(self, until):
+        harness = self.harness
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(self.rng.uniform(0, harness.rampUp))
+        while loop.time() < until:
+            self.matched.clear()
+            self.searchedAt = time.monotonic()
+            ctx = FakeContext(self.user)
+            await harness.queue.search.callback(harness.queue, ctx, harness.bots)
+            result = 'joined' if 'joined' in (ctx.content or '') else 'unreachable' if 'DM' in (ctx.content or '') \
+                else 'other'
+            harness.results.searches[result] += 1
+            if result != 'joined':
+                self.searchedAt = None
+                await asyncio.sleep(self.rng.uniform(5, 15))
+                continue
+            try:
+                await asyncio.wait_for(self.matched.wait(), max(0.0, until - loop.time()))
+            except asyncio.TimeoutError:
+                harness.results.unmatched += 1
+                # search again to leave the queue
+                await harness.queue.search.callback(harness.queue, FakeContext(self.user), harness.bots)
+                return
+            # games still running at the end are left to the harness's drain
+            while self.user.id in harness.bot.games and loop.time() < until:
+                await asyncio.sleep(0.5)
+            await asyncio.sleep(self.rng.uniform(1, 5))
+            if self.rng.random() < 0.2:
+                await harness.checkStats(self)
+
+
+class Harness:
+    def __init__(self, args, directory):
+        self.rng = random.Random(args.seed)
+        self.think = args.think
+        self.afk = args.afk
+        self.bots = args.bots
+        self.rampUp = args.ramp_up
+        self.rest = FakeRest(self.rng, args.latency)
+        self.bot = FakeBot(self.rest, directory, asyncio.get_running_loop(), args.afk_timeout)
+        self.bot.db.setup()
+        self.results = Results()
+        self.queue = Multiplayer(self.bot)
+        self.game = UnoGame(self.bot)
+        self.stats = Stats(self.bot)
+        self.bot.cogs = {'Multiplayer': self.queue, 'UnoGame': self.game, 'Stats': self.stats}
+        self.bot.games.listeners.append(self.ended)
+        self.users = [SimulatedUser(self, 10 ** 17 + i * 10, self.rng.random() >= args.closed_dms)
+                      for i in range(args.users)]
+        for simulated in self.users:
+            self.bot.users[simulated.user.id] = simulated.user
+
+    async def ended(self, table):
+        self.results.games[table.status] += 1
+
+    async def checkStats(self, simulated):
+        ctx = FakeContext(simulated.user)
+        if self.rng.random() < 0.5:
+            await self.stats.stats.callback(self.stats, ctx, None)
+        else:
+            await self.stats.leaderboard.callback(self.stats, ctx)
+
+    async def run(self, duration, drain):
+        loop = asyncio.get_running_loop()
+        await metrics.start()
+        await self.queue.on_ready()
+        await self.game.on_ready()
+        start = loop.time()
+        await asyncio.gather(*[simulated.run(start + duration) for simulated in self.users])
+        # let the games still running finish, or be kicked down by the AFK timer
+        end = loop.time() + drain
+        while len(self.bot.games) and loop.time() < end:
+            await asyncio.sleep(0.5)
+        elapsed = loop.time() - start
+        self.game.matchmaking_controller.cancel()
+        self.queue.update_presence.cancel()
+        await self.bot.db.close()
+        self.bot.journal.executor.shutdown(wait=True)
+        return elapsed
+
+    def report(self, elapsed):
+        r = self.results
+        finished = r.games['ended']
+        calls = sum(self.rest.calls.values())
+        print(f'{len(self.users)} users for {elapsed:.0f}s, {len(self.bot.games)} games still running')
+        print(f"searches        {dict(r.searches)}, {r.unmatched} never matched")
+        print(f"games           {dict(r.games)}, {r.afk} players went AFK")
+        print(f"match wait      p50 {percentile(r.waits, 50):.2f}s  p95 {percentile(r.waits, 95):.2f}s  "
+              f"p99 {percentile(r.waits, 99):.2f}s  ({len(r.waits)} matches)")
+        print(f"click to render p50 {percentile(r.renders, 50) * 1000:.0f}ms  p95 {percentile(r.renders, 95) * 1000:.0f}ms  "
+              f"p99 {percentile(r.renders, 99) * 1000:.0f}ms  ({r.clicks} clicks, {r.rejected} rejected)")
+        print(f"rest calls      {calls} ({calls / max(finished, 1):.1f} per finished game), "
+              f"{dict(self.rest.calls)}")
+        # most 429s are retried inside py-cord and only cost time, the lost ones are requests the bot saw fail.
+        # py-cord drops failed delete_after cleanups without the bot ever seeing them, so they're reported apart
+        lost = {kind: count for kind, count in self.rest.lost.items() if kind != 'delayed_delete'}
+        print(f"429s            {sum(self.rest.ratelimited.values())} {dict(self.rest.ratelimited)}, "
+              f"lost {sum(lost.values())} {lost} plus {self.rest.lost['delayed_delete']} delete_after cleanups")
+        print(f"presence        {self.bot.presenceUpdates} updates")
+        lag = metrics.quantile('loop_lag_seconds', 0.99)
+        print(f"loop lag p99    {'n/a' if lag is None else f'<= {lag * 1000:.1f}ms'}")
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        harness = Harness(args, directory)
+        elapsed = await harness.run(args.duration, args.drain)
+        harness.report(elapsed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the bot against a local stand-in for Discord')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=120, help='seconds users keep searching for games')
+    parser.add_argument('--drain', type=float, default=60, help='seconds to let running games finish afterwards')
+    parser.add_argument('--ramp-up', type=float, default=10, help='seconds over which users make their first search')
+    parser.add_argument('--think', type=float, default=1.0, help='average seconds a user takes to click')
+    parser.add_argument('--afk', type=float, default=0.05, help='fraction of games in which a user goes AFK')
+    parser.add_argument('--afk-timeout', type=float, default=10, help='seconds before an AFK player is warned')
+    parser.add_argument('--closed-dms', type=float, default=0.02, help='fraction of users who block DMs')
+    parser.add_argument('--latency', type=float, default=0.05, help='average seconds per REST request')
+    parser.add_argument('--bots', action='store_true', help='search for games with bots')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+    asyncio.run(main(args))
@@ -3,28 +3,59 @@ from discord.ext import commands
 from dotenv import load_dotenv
 import logging
 import os
-import sqlite3 as sql
-
-logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler()
-handler.setLevel(logging.INFO)
-file_handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-file_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s')
-handler.setFormatter(formatter)
-file_handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.addHandler(file_handler)
+from utils.database import Database
+from utils.matchmaking import MatchmakingIndex
+from utils.rating import Ratings
+from utils.outbound import Outbound
+from utils.reachability import Reachability
+from utils.resolver import Resolver
+from utils.registry import GameRegistry
+from utils.timers import Timers
+from utils.journal import Journal
+from utils.cluster import Cluster
+from utils.metrics import registry as metrics
+from utils import logs
 
+# before anything reads the environment, so settings in .env (LOG_LEVELS, LOG_JSON, ...) apply
 load_dotenv()
 
+# cluster.py starts one of these per worker with its share of the shards, see utils/cluster.py
+worker = os.getenv('CLUSTER_WORKER')
+
+logs.setup('discord.log' if worker is None else f'discord-{worker}.log', worker)
+logger = logging.getLogger('uno')
+
 intents = discord.Intents.default()
 intents.members = True
 intents.messages = True
 
 logger.debug("Starting bot")
-bot = commands.AutoShardedBot(owner_id=234248229426823168, intents=intents)
+if worker is not None:
+    bot = commands.AutoShardedBot(owner_id=234248229426823168, intents=intents,
+                                  shard_ids=[int(shard) for shard in os.getenv('SHARD_IDS').split(',')],
+                                  shard_count=int(os.getenv('SHARD_COUNT')))
+    bot.cluster = Cluster(os.getenv('CLUSTER_SOCKET', 'data/cluster.sock'), int(worker))
+else:
+    bot = commands.AutoShardedBot(owner_id=234248229426823168, intents=intents)
+    bot.cluster = None
+bot.db = Database('data/database.db')
+bot.matchmaking = MatchmakingIndex(bot.db)
+bot.ratings = Ratings(bot.db)
+bot.outbound = Outbound()
+bot.reachability = Reachability(bot.db)
+bot.outbound.observers.append(bot.reachability.observe)
+bot.resolver = Resolver(bot)
+bot.games = GameRegistry(None if worker is None else int(worker))
+bot.games.cluster = bot.cluster
+bot.timers = Timers()
+# each worker recovers only the games it was hosting
+bot.journal = Journal('data/games' if worker is None else f'data/games/{worker}')
+bot.metrics = metrics
+bot.metrics.gauge('games_active', lambda: len(bot.games), 'Tables running in this process')
+bot.metrics.gauge('queue_players', lambda: len(bot.matchmaking), 'Players waiting in the local queue')
+bot.metrics.gauge('players_in_game', lambda: len(bot.games.players), 'Humans seated at tables in this process')
+bot.metrics.gauge('outbound_queued', bot.outbound.queued, 'Discord requests waiting to be sent')
+bot.metrics.gauge('timers_pending', lambda: len(bot.timers), 'Deadlines waiting in the timer heap')
 # Load cogs
 for filename in os.listdir('./cogs'):
     if filename.endswith('.py'):
@@ -40,17 +71,13 @@ for filename in os.listdir('./cogs'):
 async def on_ready():
     logger.info(f'Logged in as {bot.user.name}#{bot.user.discriminator} ({bot.user.id})')
     logger.info(f'Connected to {len(bot.guilds)} guilds')
+    # METRICS_PORT turns on the Prometheus endpoint, each cluster worker serving on the next port up
+    port = os.getenv('METRICS_PORT')
+    await bot.metrics.start(None if port is None else int(port) + int(worker or 0))
 
 
 if __name__ == '__main__':
     logger.info("Connecting to database")
-    with sql.connect('data/database.db') as con:
-        cur = con.cursor()
-        cur.execute('CREATE TABLE IF NOT EXISTS queue (user_id INTEGER PRIMARY KEY, bots INTEGER DEFAULT 0, '
-                    'timestamp INTEGER NOT NULL)')
-        cur.execute('CREATE TABLE IF NOT EXISTS playerData (playerID INTEGER PRIMARY KEY UNIQUE NOT NULL, '
-                    'wins INTEGER DEFAULT 0, '
-                    'losses INTEGER DEFAULT 0)')
-        con.commit()
+    bot.db.setup()
     logger.debug("Starting bot")
     bot.run(os.getenv('DISCORD_TOKEN'))
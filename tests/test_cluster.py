@@ -0,0 +1,85 @@
+import asyncio
+from utils.cluster import Coordinator, Cluster
+from utils.registry import GameRegistry
+
+
+async def until(condition, timeout=2):
+    end = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < end, 'timed out'
+        await asyncio.sleep(0.01)
+
+
+class Worker:
+    """A worker's side of the cluster without Discord: hosts whatever the coordinator asks it to."""
+
+    def __init__(self, path, worker):
+        self.games = GameRegistry(worker)
+        self.hosted = {}  # game id -> players
+        self.clicks = []
+        self.rated = []
+        self.cluster = Cluster(path, worker)
+        self.cluster.handlers.update(create=self.create, click=self.click, rated=self.ratedElsewhere)
+        self.cluster.hello = lambda: {'games': [], 'owner': None, 'tableSize': 2}
+
+    async def create(self, players, bots, botLevel=None):
+        gameId = self.games.newId()
+        self.hosted[gameId] = players
+        self.cluster.send('started', game=gameId, users=players)
+
+    async def click(self, game, **click):
+        self.clicks.append((game, click['user']))
+
+    async def ratedElsewhere(self, changes, winner):
+        self.rated.append((changes, winner))
+
+
+def test_workers_never_share_table_ids():
+    first, second = GameRegistry(0), GameRegistry(1)
+    ids = [first.newId() for _ in range(1000)]
+    assert not set(ids) & {second.newId() for _ in range(1000)}
+    assert len(set(ids)) == len(ids)
+
+
+def test_games_stay_pinned_to_their_worker(tmp_path):
+    async def run():
+        path = str(tmp_path / 'cluster.sock')
+        coordinator = Coordinator(path)
+        await coordinator.start()
+        workers = [Worker(path, 0), Worker(path, 1)]
+        try:
+            for worker in workers:
+                worker.cluster.start()
+            await until(lambda: len(coordinator.workers) == 2)
+            for worker, users in zip(workers, ((1, 2), (3, 4))):
+                for user in users:
+                    assert await worker.cluster.request('search', user=user, bots=False, skill=1000) == 'joined'
+            await until(lambda: len(coordinator.games) == 2 and None not in coordinator.players.values())
+            (game0, players0), = workers[0].hosted.items()
+            (game1, players1), = workers[1].hosted.items()
+            assert sorted(players0) == [1, 2] and sorted(players1) == [3, 4]
+            assert coordinator.games == {game0: 0, game1: 1}
+
+            # a click that reached the wrong worker is passed on to the one hosting the game
+            assert await workers[1].cluster.request('click', game=game0, user=1, action=0, seat=0, arg=0, version=0)
+            await until(lambda: workers[0].clicks)
+            assert workers[0].clicks == [(game0, 1)]
+
+            # rating changes recorded by one worker reach the others' caches
+            workers[1].cluster.send('rated', changes=[[3, 16.0], [4, -16.0]], winner=3)
+            await until(lambda: workers[0].rated)
+            assert workers[0].rated == [([[3, 16.0], [4, -16.0]], 3)] and not workers[1].rated
+
+            # one worker's game ending leaves the other's players where they are
+            workers[1].cluster.send('ended', game=game1)
+            await until(lambda: game1 not in coordinator.games)
+            assert coordinator.games == {game0: 0}
+            assert coordinator.players == {1: game0, 2: game0}
+            assert await workers[1].cluster.request('search', user=1, bots=False, skill=1000) == 'ingame'
+            assert await workers[1].cluster.request('search', user=3, bots=False, skill=1000) == 'joined'
+        finally:
+            for worker in workers:
+                worker.cluster.task.cancel()
+            await coordinator.close()
+
+    asyncio.run(run())
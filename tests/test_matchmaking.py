@@ -0,0 +1,47 @@
+from utils.matchmaking import MatchmakingIndex
+
+
+def matchmaker(index, size, joins, bots=False, skill=lambda userId: 1000):
+    """Players join one second apart and the queue is partitioned after each, like the matchmaker does."""
+    tables = []
+    for now, userId in enumerate(joins):
+        index.enqueue(userId, bots, now, skill(userId))
+        for players, _ in index.partition(size, now):
+            index.matched(players, now)
+            tables.append(sorted(players))
+    return tables
+
+
+def test_tables_fill_up_as_players_join_one_at_a_time():
+    index = MatchmakingIndex()
+    assert matchmaker(index, 4, range(8)) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert len(index) == 0
+
+
+def test_short_table_without_bots_waits_for_backfill():
+    index = MatchmakingIndex()
+    assert matchmaker(index, 4, range(3)) == []
+    assert index.partition(4, 29, backfillAfter=30) == []
+    assert index.partition(4, 30, backfillAfter=30) == [([0, 1, 2], False)]
+
+
+def test_lone_player_without_bots_never_starts():
+    index = MatchmakingIndex()
+    index.enqueue(0, False, 0, 1000)
+    assert index.partition(4, 600) == []
+
+
+def test_bots_fill_a_short_table_after_backfill_or_for_solo_players():
+    index = MatchmakingIndex()
+    assert matchmaker(index, 4, [0], bots=True) == []
+    assert index.partition(4, 30, backfillAfter=30) == [([0], True)]
+    assert index.partition(4, 0, solo={0}) == [([0], True)]
+
+
+def test_tables_group_players_by_skill():
+    index = MatchmakingIndex()
+    ratings = {0: 1000, 1: 2000, 2: 1010, 3: 2010}
+    for userId, rating in ratings.items():
+        index.enqueue(userId, False, 0, rating)
+    tables = sorted(sorted(players) for players, _ in index.partition(2, 0))
+    assert tables == [[0, 2], [1, 3]]
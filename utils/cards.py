@@ -0,0 +1,149 @@
+# Cards are small ints. Every physical card in the deck has an id (0-95) and the hands are bitmasks over those ids, so
+# adding, removing and membership are O(1) and "which cards in this hand can be played" is one AND with a row of the
+# precomputed PLAYABLE table.
+COLORS = ['red', 'yellow', 'green', 'blue', 'black']
+TYPES = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'skip', 'reverse', '+2', 'wild', 'wild+4']
+BLACK = 4
+SKIP, REVERSE, DRAW2, WILD, WILD4 = 10, 11, 12, 13, 14
+
+# The deck, one entry per card id: 0 once, 1-9 twice and one skip, reverse and +2 per colour, then 4 of each wild.
+_DECK = []
+for _color in range(4):
+    for _type in range(10):
+        _DECK.append((_color, _type))
+        if _type != 0:
+            _DECK.append((_color, _type))
+    for _type in (SKIP, REVERSE, DRAW2):
+        _DECK.append((_color, _type))
+for _i in range(4):
+    _DECK.append((BLACK, WILD))
+    _DECK.append((BLACK, WILD4))
+
+DECK_SIZE = len(_DECK)
+COLOR = bytes(color for color, _ in _DECK)  # card id -> colour index
+TYPE = bytes(type for _, type in _DECK)  # card id -> type index
+NAME = tuple(f'{COLORS[color]} {TYPES[type]}' for color, type in _DECK)  # card id -> "red 5"
+LABEL = tuple(name.title() for name in NAME)  # card id -> button label
+
+_EMOJI = {"black wild": "<:blackwild:1144942824836571167>",
+          "black wild+4": "<:blackplusfour:1144942822248685679>",
+          "red 0": "<:red0:1144943495610650715>",
+          "red 1": "<:red1:1144943497338699788>",
+          "red 2": "<:red2:1144943499167412264>",
+          "red 3": "<:red3:1144943501444915201>",
+          "red 4": "<:red4:1144943503042957334>",
+          "red 5": "<:red5:1144943505622450206>",
+          "red 6": "<:red6:1151938864429154455>",
+          "red 7": "<:red7:1144942889105899540>",
+          "red 8": "<:red8:1144943508340359199>",
+          "red 9": "<:red9:1144942892163551232>",
+          "red skip": "<:redskip:1144943512270405662>",
+          "red reverse": "<:redswap:1144943515063824424>",
+          "red +2": "<:redplustwo:1151938865720983558>",
+          "yellow 0": "<:yellow0:1151938869118373908>",
+          "yellow 1": "<:yellow1:1151938871702081607>",
+          "yellow 2": "<:yellow2:1144957924163198997>",
+          "yellow 3": "<:yellow3:1144957927766097960>",
+          "yellow 4": "<:yellow4:1144957928642719825>",
+          "yellow 5": "<:yellow5:1144957930907639868>",
+          "yellow 6": "<:yellow6:1144957932195299439>",
+          "yellow 7": "<:yellow7:1144957934212755527>",
+          "yellow 8": "<:yellow8:1144957936607703161>",
+          "yellow 9": "<:yellow9:1144957938478370846>",
+          "yellow skip": "<:yellowskip:1144957942379065364>",
+          "yellow reverse": "<:yellowswap:1144957943738020013>",
+          "yellow +2": "<:yellowplustwo:1144957941099794452>",
+          "green 0": "<:green0:1144943483531046932>",
+          "green 1": "<:green1:1144942854267994122>",
+          "green 2": "<:green2:1144943484801912862>",
+          "green 3": "<:green3:1144942857875095592>",
+          "green 4": "<:green4:1144943487410765855>",
+          "green 5": "<:green5:1144942862786637884>",
+          "green 6": "<:green6:1144942865429045328>",
+          "green 7": "<:green7:1144943488992034866>",
+          "green 8": "<:green8:1144942868331495445>",
+          "green 9": "<:green9:1144943490355179602>",
+          "green skip": "<:greenskip:1144943493534449684>",
+          "green reverse": "<:greenswap:1144942876418113546>",
+          "green +2": "<:greenplustwo:1144942871779221554>",
+          "blue 0": "<:blue0:1144942826396852266>",
+          "blue 1": "<:blue1:1144942827965526037>",
+          "blue 2": "<:blue2:1144942830641500180>",
+          "blue 3": "<:blue3:1144942832344383508>",
+          "blue 4": "<:blue4:1144942835691425903>",
+          "blue 5": "<:blue5:1144942837134270574>",
+          "blue 6": "<:blue6:1144942839436955761>",
+          "blue 7": "<:blue7:1144942841160798248>",
+          "blue 8": "<:blue8:1144942843564134481>",
+          "blue 9": "<:blue9:1144942844881154098>",
+          "blue skip": "<:blueskip:1144942849322909718>",
+          "blue reverse": "<:blueswap:1144942851550097478>",
+          "blue +2": "<:blueplustwo:1144943480393711677>"}
+EMOJI = tuple(_EMOJI[name] for name in NAME)  # card id -> custom emoji
+
+
+def topState(card, wildColor=None):
+    """The row of PLAYABLE that applies when ``card`` is on top of the discard pile.
+
+    Coloured cards are their own state. A wild whose colour has been chosen plays as that colour, so it gets one of
+    8 extra states after the card ids; a wild with no colour yet keeps its card id.
+    """
+    if COLOR[card] == BLACK and wildColor is not None:
+        return DECK_SIZE + (TYPE[card] - WILD) * 4 + wildColor
+    return card
+
+
+def _playable(color, type):
+    mask = 0
+    for card in range(DECK_SIZE):
+        if COLOR[card] == BLACK or COLOR[card] == color or TYPE[card] == type:
+            mask |= 1 << card
+    return mask
+
+
+# top state -> bitmask of the card ids that can be played on it
+PLAYABLE = tuple([_playable(COLOR[card], TYPE[card]) for card in range(DECK_SIZE)] +
+                 [_playable(color, type) for type in (WILD, WILD4) for color in range(4)])
+
+
+class Hand:
+    """A set of card ids stored as one int. Iterates in card id order, which groups the cards by colour."""
+    __slots__ = ('mask',)
+
+    def __init__(self, mask=0):
+        self.mask = mask
+
+    def append(self, card):
+        self.mask |= 1 << card
+
+    def remove(self, card):
+        if not self.mask >> card & 1:
+            raise ValueError(f'{NAME[card]} is not in the hand')
+        self.mask &= ~(1 << card)
+
+    def index(self, card):
+        return (self.mask & ((1 << card) - 1)).bit_count()
+
+    def clear(self):
+        self.mask = 0
+
+    def __len__(self):
+        return self.mask.bit_count()
+
+    def __contains__(self, card):
+        return self.mask >> card & 1 == 1
+
+    def __iter__(self):
+        mask = self.mask
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def __getitem__(self, item):
+        return list(self)[item]
+
+
+def lowest(mask):
+    """The smallest card id in a mask, or None if it is empty."""
+    return (mask & -mask).bit_length() - 1 if mask else None
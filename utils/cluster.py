@@ -0,0 +1,300 @@
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import os
+from collections import Counter
+from utils.matchmaking import MatchmakingIndex
+
+# Cluster mode runs the bot as several worker processes, each connected to its own range of shards, plus the
+# coordinator started by cluster.py. Workers and the coordinator talk over a unix socket in newline separated JSON:
+# {"op": ..., "id": ..., ...}. A message with an id expects {"op": "reply", "id": ..., "result": ...} back.
+#
+# worker -> coordinator: hello, search, started, left, ended, click, stats, rated
+# coordinator -> worker: create, expired, click, rated
+OPS = ('hello', 'search', 'started', 'left', 'ended', 'click', 'stats', 'rated')
+
+
+async def readMessages(reader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        yield json.loads(line)
+
+
+def writeMessage(writer, message):
+    writer.write(json.dumps(message, separators=(',', ':')).encode() + b'\n')
+
+
+class Coordinator:
+    """The cluster's one matchmaking queue and its record of which worker is hosting which game.
+
+    Players queue through whichever worker received their /search, tables are formed here and each game is created
+    on (and stays pinned to) a single worker, normally the one the longest waiting player queued through since it
+    has them cached. Button clicks that reach a worker that isn't hosting the game are forwarded to the one that is.
+    """
+
+    def __init__(self, path, db=None, queueTimeout=500):
+        self.path = path
+        self.db = db
+        self.queueTimeout = queueTimeout
+        self.logger = logging.getLogger('uno.cluster')
+        self.queue = MatchmakingIndex(db)
+        self.workers = {}  # worker id -> StreamWriter
+        self.tickets = {}  # user id -> worker they queued through
+        self.games = {}  # game id -> worker hosting it
+        self.players = {}  # user id -> game id, or None while their game is being created
+        self.creating = {}  # user id -> worker asked to create their game
+        self.tableSize = 2
+        self.botLevel = 'normal'
+        self.solo = set()  # users allowed a bots table on their own, reported by the workers
+        self.server = None
+        self.tasks = []
+        self.counts = {'messages': 0, 'created': 0, 'forwarded': 0}
+
+    async def start(self):
+        if self.db is not None:
+            await self.queue.load()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self.connected, self.path)
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self.matchmaker()), loop.create_task(self.expire())]
+        self.logger.info(f'Coordinator listening on {self.path}')
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for writer in list(self.workers.values()):
+            writer.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.db is not None:
+            await self.db.close()
+
+    async def connected(self, reader, writer):
+        worker = None
+        try:
+            async for message in readMessages(reader):
+                self.counts['messages'] += 1
+                op = message.pop('op')
+                messageId = message.pop('id', None)
+                if op not in OPS:
+                    self.logger.warning(f'Unknown message from worker {worker}: {op}')
+                    continue
+                if op == 'hello':
+                    worker = message.pop('worker')
+                    self.workers[worker] = writer
+                try:
+                    result = getattr(self, op)(worker, **message)
+                except Exception as e:
+                    self.logger.error(f'Worker {worker} sent a bad {op}: {e!r}')
+                    result = None
+                if messageId is not None:
+                    writeMessage(writer, {'op': 'reply', 'id': messageId, 'result': result})
+        except (ConnectionError, json.JSONDecodeError) as e:
+            self.logger.warning(f'Lost worker {worker}: {e!r}')
+        finally:
+            if worker is not None and self.workers.get(worker) is writer:
+                del self.workers[worker]
+                # games it hadn't got round to creating never will be, so let those players queue again
+                for user in [user for user, host in self.creating.items() if host == worker]:
+                    del self.creating[user]
+                    if self.players.get(user, 0) is None:
+                        del self.players[user]
+                self.logger.info(f'Worker {worker} disconnected')
+            writer.close()
+
+    def send(self, worker, op, **data):
+        writer = self.workers.get(worker)
+        if writer is None:
+            return False
+        writeMessage(writer, {'op': op, **data})
+        return True
+
+    # worker -> coordinator
+    def hello(self, worker, games=(), owner=None, tableSize=None, botLevel=None):
+        """A worker connected, with the games it's already hosting (e.g. ones it recovered after a restart)."""
+        hosting = {gameId for gameId, _ in games}
+        # anything it stopped hosting while it was disconnected has ended
+        for gameId in [gameId for gameId, host in self.games.items() if host == worker and gameId not in hosting]:
+            self.ended(worker, gameId)
+        for gameId, users in games:
+            self.started(worker, gameId, users)
+        if owner is not None:
+            self.solo.add(owner)
+        if tableSize is not None:
+            self.tableSize = tableSize
+        if botLevel is not None:
+            self.botLevel = botLevel
+        self.logger.info(f'Worker {worker} connected with {len(games)} games')
+        self.queue.changed.set()
+        return True
+
+    def search(self, worker, user, bots, skill):
+        """Join or leave the queue. Returns ``joined``, ``left`` or ``ingame``."""
+        if user in self.players:
+            return 'ingame'
+        if user in self.queue:
+            self.queue.dequeue(user)
+            self.tickets.pop(user, None)
+            return 'left'
+        self.queue.enqueue(user, bots, datetime.datetime.now().timestamp(), skill)
+        self.tickets[user] = worker
+        return 'joined'
+
+    def started(self, worker, game, users):
+        self.games[game] = worker
+        for user in users:
+            self.players[user] = game
+            self.creating.pop(user, None)
+
+    def left(self, worker, game, user):
+        if self.players.get(user) == game:
+            del self.players[user]
+
+    def ended(self, worker, game):
+        self.games.pop(game, None)
+        for user in [user for user, gameId in self.players.items() if gameId == game]:
+            del self.players[user]
+
+    def click(self, worker, game, **click):
+        host = self.games.get(game)
+        if host is None or not self.send(host, 'click', game=game, **click):
+            return False
+        self.counts['forwarded'] += 1
+        return True
+
+    def rated(self, worker, changes, winner):
+        """A worker recorded a game's rating changes, which every other worker's cache needs too."""
+        for other in self.workers:
+            if other != worker:
+                self.send(other, 'rated', changes=changes, winner=winner)
+
+    def stats(self, worker):
+        """The whole cluster's queue and game counts for the workers' presence."""
+        return {'queue': len(self.queue), 'games': len(self.games),
+                'players': sum(game is not None for game in self.players.values()),
+                'wait': self.queue.waits.estimate(datetime.datetime.now().timestamp())}
+
+    # matchmaking
+    async def matchmaker(self):
+        while True:
+            await self.queue.changed.wait()
+            self.queue.changed.clear()
+            self.matchmake()
+
+    async def expire(self):
+        while True:
+            await asyncio.sleep(10)
+            for ticket in self.queue.expired(datetime.datetime.now().timestamp() - self.queueTimeout):
+                self.queue.dequeue(ticket.userId)
+                self.send(self.tickets.pop(ticket.userId, None), 'expired', user=ticket.userId)
+            self.matchmake()
+
+    def matchmake(self):
+        """Split the queue into tables and ask workers to host them. Returns how many games were created."""
+        if not self.workers:
+            return 0
+        inGame = [userId for userId in self.queue.tickets if userId in self.players]
+        if inGame:
+            self.queue.dequeue(*inGame)
+        now = datetime.datetime.now().timestamp()
+        tables = self.queue.partition(self.tableSize, now, solo=self.solo)
+        hosted = {worker: 0 for worker in self.workers}
+        for host in self.games.values():
+            if host in hosted:
+                hosted[host] += 1
+        for players, bots in tables:
+            # the worker most of them queued through has them cached, otherwise (e.g. they queued before a restart)
+            # whoever is hosting the fewest games
+            queuedThrough = Counter(self.tickets[user] for user in players if self.tickets.get(user) in self.workers)
+            worker = queuedThrough.most_common(1)[0][0] if queuedThrough else min(hosted, key=hosted.get)
+            hosted[worker] += 1
+            self.queue.matched(players, now)
+            for user in players:
+                self.tickets.pop(user, None)
+                self.players[user] = None
+                self.creating[user] = worker
+            self.send(worker, 'create', players=players, bots=bots, botLevel=self.botLevel)
+            self.counts['created'] += 1
+            self.logger.info(f'Asked worker {worker} to host a game for {players}')
+        return len(tables)
+
+
+class Cluster:
+    """A worker's connection to the coordinator, kept as ``bot.cluster`` in cluster mode (None otherwise).
+
+    ``handlers`` maps the ops the coordinator sends to coroutine functions taking the message's fields, and
+    ``hello()`` returns what the worker reports each time it (re)connects. The connection is retried for as long as
+    the worker runs; messages sent while it's down are dropped and requests fail with ConnectionError.
+    """
+
+    def __init__(self, path, worker):
+        self.path = path
+        self.worker = worker
+        self.logger = logging.getLogger('uno.cluster')
+        self.handlers = {}
+        self.hello = dict
+        self.writer = None
+        self.pending = {}  # message id -> future for the reply
+        self.ids = itertools.count()
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        delay = 0.5
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+            except (ConnectionError, FileNotFoundError) as e:
+                self.logger.warning(f'Could not reach the coordinator, retrying in {delay}s: {e!r}')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            delay = 0.5
+            writeMessage(self.writer, {'op': 'hello', 'worker': self.worker, **self.hello()})
+            try:
+                async for message in readMessages(reader):
+                    op = message.pop('op')
+                    if op == 'reply':
+                        future = self.pending.pop(message['id'], None)
+                        if future is not None and not future.done():
+                            future.set_result(message['result'])
+                    elif op in self.handlers:
+                        asyncio.get_running_loop().create_task(self.handlers[op](**message))
+                    else:
+                        self.logger.warning(f'Unknown message from the coordinator: {op}')
+            except ConnectionError as e:
+                self.logger.warning(f'Lost the coordinator: {e!r}')
+            self.writer = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Lost the coordinator'))
+            self.pending.clear()
+
+    def send(self, op, **data):
+        if self.writer is None:
+            # the next hello brings the coordinator up to date
+            self.logger.debug(f'Dropped {op} for the coordinator, not connected')
+            return False
+        writeMessage(self.writer, {'op': op, **data})
+        return True
+
+    async def request(self, op, timeout=5, **data):
+        if self.writer is None:
+            raise ConnectionError('Not connected to the coordinator')
+        messageId = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[messageId] = future
+        writeMessage(self.writer, {'op': op, 'id': messageId, **data})
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(messageId, None)
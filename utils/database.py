@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import sqlite3 as sql
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.metrics import registry as metrics
+
+
+class Database:
+    """The bot's SQLite database, shared by every cog as ``bot.db``.
+
+    There is one long-lived connection for reads and one for writes, each owned by its own thread so nothing blocks
+    the event loop. The file is in WAL mode so reads carry on while a write is committing. Writes are queued to a
+    single writer task that runs everything waiting in one transaction and one commit. sqlite3 keeps each
+    connection's statements prepared, keyed on the SQL text, so the queries here are fixed strings with parameters.
+    """
+
+    def __init__(self, path='data/database.db', batchSize=100, busyTimeout=5000):
+        self.path = path
+        self.batchSize = batchSize
+        self.busyTimeout = busyTimeout  # ms to wait for another process's write lock, e.g. other cluster workers
+        self.logger = logging.getLogger('uno.db')
+        self.reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-read')
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+        self.readCon = None
+        self.writeCon = None
+        self.writes = None
+        self.writerTask = None
+        self.timings = {}  # SQL text -> [calls, total seconds, slowest seconds], updated by both threads
+        self.timingsLock = threading.Lock()
+
+    def connect(self):
+        con = sql.connect(self.path, check_same_thread=False, cached_statements=256, isolation_level=None)
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('PRAGMA synchronous=NORMAL')
+        con.execute(f'PRAGMA busy_timeout={int(self.busyTimeout)}')
+        return con
+
+    def setup(self):
+        """Create the tables. Runs once, synchronously, before the bot connects."""
+        con = self.connect()
+        con.execute('CREATE TABLE IF NOT EXISTS queue (user_id INTEGER PRIMARY KEY, bots INTEGER DEFAULT 0, '
+                    'timestamp INTEGER NOT NULL)')
+        con.execute('CREATE TABLE IF NOT EXISTS playerData (playerID INTEGER PRIMARY KEY UNIQUE NOT NULL, '
+                    'wins INTEGER DEFAULT 0, '
+                    'losses INTEGER DEFAULT 0)')
+        # one row per finished game and one per seat at it
+        con.execute('CREATE TABLE IF NOT EXISTS matches (matchID INTEGER PRIMARY KEY NOT NULL, '
+                    'startedAt INTEGER, '
+                    'endedAt INTEGER NOT NULL, '
+                    'winnerID INTEGER, '
+                    'turns INTEGER DEFAULT 0)')
+        con.execute('CREATE TABLE IF NOT EXISTS match_players (matchID INTEGER NOT NULL REFERENCES matches(matchID), '
+                    'playerID INTEGER NOT NULL, '
+                    'isBot INTEGER DEFAULT 0, '
+                    'cardsLeft INTEGER DEFAULT 0, '
+                    'won INTEGER DEFAULT 0, '
+                    'PRIMARY KEY (matchID, playerID)) WITHOUT ROWID')
+        con.execute('CREATE INDEX IF NOT EXISTS match_players_playerID ON match_players (playerID)')
+        self.addColumn(con, 'playerData', 'rating', 'REAL DEFAULT 1000')
+        self.addColumn(con, 'match_players', 'ratingChange', 'REAL DEFAULT 0')
+        # the leaderboard's order, so pages can seek to a (rating, playerID) cursor
+        con.execute('DROP INDEX IF EXISTS playerData_rating')
+        con.execute('CREATE INDEX IF NOT EXISTS playerData_leaderboard ON playerData (rating DESC, playerID DESC)')
+        # users a DM has recently reached, see utils/reachability.py
+        con.execute('CREATE TABLE IF NOT EXISTS dmReachable (userID INTEGER PRIMARY KEY NOT NULL, '
+                    'checkedAt INTEGER NOT NULL)')
+        con.close()
+
+    @staticmethod
+    def addColumn(con, table, column, definition):
+        """Add a column to a table created by an older version of the bot."""
+        if column not in [row[1] for row in con.execute(f'PRAGMA table_info({table})')]:
+            con.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def time(self, query, elapsed):
+        with self.timingsLock:
+            timing = self.timings.setdefault(query, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+        metrics.observe('db_query_seconds', elapsed, op=query.split(None, 1)[0].upper())
+
+    def _read(self, query, params, one):
+        if self.readCon is None:
+            self.readCon = self.connect()
+        start = time.perf_counter()
+        cur = self.readCon.execute(query, params)
+        result = cur.fetchone() if one else cur.fetchall()
+        self.time(query, time.perf_counter() - start)
+        return result
+
+    async def fetchone(self, query, params=()):
+        return await asyncio.get_running_loop().run_in_executor(self.reader, self._read, query, params, True)
+
+    async def fetchall(self, query, params=()):
+        return await asyncio.get_running_loop().run_in_executor(self.reader, self._read, query, params, False)
+
+    def _write(self, batch):
+        """Run a batch of transactions in a single commit. Returns an exception (or None) for each transaction."""
+        if self.writeCon is None:
+            self.writeCon = self.connect()
+        con = self.writeCon
+        # take the write lock up front, so waiting for another process happens here under busy_timeout instead of
+        # failing halfway through the batch
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            results = self._writeBatch(con, batch)
+            start = time.perf_counter()
+            con.execute('COMMIT')
+            self.time('COMMIT', time.perf_counter() - start)
+        finally:
+            # whatever failed, don't leave the connection inside a transaction or every later BEGIN fails too
+            if con.in_transaction:
+                con.execute('ROLLBACK')
+        return results
+
+    def _writeBatch(self, con, batch):
+        results = []
+        for statements in batch:
+            con.execute('SAVEPOINT tx')
+            try:
+                for query, params in statements:
+                    start = time.perf_counter()
+                    con.execute(query, params)
+                    self.time(query, time.perf_counter() - start)
+            except sql.Error as e:
+                # only this transaction is undone, the rest of the batch still commits
+                con.execute('ROLLBACK TO tx')
+                results.append(e)
+            else:
+                results.append(None)
+            con.execute('RELEASE tx')
+        return results
+
+    async def runWriter(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.writes.get()]
+            while len(batch) < self.batchSize and not self.writes.empty():
+                batch.append(self.writes.get_nowait())
+            metrics.inc('db_write_batches_total')
+            metrics.inc('db_transactions_total', len(batch))
+            try:
+                results = await loop.run_in_executor(self.writer, self._write, [statements for statements, _ in batch])
+            except sql.Error as e:
+                self.logger.error(f'Database write failed: {e}')
+                results = [e] * len(batch)
+            for (_, future), error in zip(batch, results):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(True)
+                else:
+                    future.set_exception(error)
+
+    def transaction(self, statements):
+        """Queue ``[(sql, params), ...]`` to be written atomically. Returns a future that resolves once committed."""
+        if self.writerTask is None or self.writerTask.done():
+            self.writes = asyncio.Queue()
+            self.writerTask = asyncio.get_running_loop().create_task(self.runWriter())
+        future = asyncio.get_running_loop().create_future()
+        self.writes.put_nowait((list(statements), future))
+        return future
+
+    async def execute(self, query, params=()):
+        return await self.transaction([(query, params)])
+
+    def stats(self):
+        """Per-query call counts and timings in milliseconds, slowest total first."""
+        with self.timingsLock:
+            rows = [(query, calls, total * 1000, slowest * 1000)
+                    for query, (calls, total, slowest) in self.timings.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    async def close(self):
+        """Wait for queued writes to commit and close both connections."""
+        if self.writerTask is not None:
+            while not self.writes.empty():
+                await asyncio.sleep(0.05)
+            await self.transaction([])
+            self.writerTask.cancel()
+        for con, executor in ((self.readCon, self.reader), (self.writeCon, self.writer)):
+            if con is not None:
+                await asyncio.get_running_loop().run_in_executor(executor, con.close)
@@ -0,0 +1,308 @@
+import random
+from array import array
+from utils.cards import (COLORS, TYPES, COLOR, TYPE, BLACK, SKIP, REVERSE, DRAW2, WILD4, DECK_SIZE, PLAYABLE, Hand,
+                         topState, lowest)
+
+# Turn phases. A table sits in AWAITING_INPUT (or AWAITING_COLOR after a human plays a wild card) until an action
+# arrives, then runs RESOLVING -> ADVANCE without waiting on anything and settles in AWAITING_INPUT or ENDED again.
+AWAITING_INPUT = 'awaiting_input'
+AWAITING_COLOR = 'awaiting_color'
+RESOLVING = 'resolving'
+ADVANCE = 'advance'
+ENDED = 'ended'
+
+
+class Seat:
+    """A player as far as the rules are concerned: an id, a name and a hand."""
+
+    def __init__(self, id, name='NAME_NOT_SET', isBot=False, strategy=None):
+        self.id = id
+        self.name = name
+        self.hand = Hand()
+        self.score = 0
+        self.isBot = isBot
+        self.strategy = strategy  # how a bot picks its moves, see utils.strategy
+
+    def __str__(self):
+        return f'{self.id}'
+
+
+class Game:
+    """The Uno rules with no Discord I/O, so tables can be simulated and benchmarked in-process.
+
+    All randomness comes from ``self.rng`` so a game with the same seed and the same moves always plays out the same
+    way. Subclasses hook into ``announce``/``notify`` to surface what happened and override ``newBot`` to create their
+    own bot players.
+    """
+
+    def __init__(self, players: list, seed=None):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.deck = array('B')
+        self.discard = array('B')
+        self.wildColor = None  # the colour chosen for the wild card on top of the discard pile
+        self.players = players
+        self.settings = {'maxStackSize': 7,
+                         'startCards': 7,
+                         'drawUntilPlayable': True,
+                         'seats': 7}  # how many seats bots fill the table up to
+        self.status = 'waiting'
+        self.currentPlayerIndex = -1
+        self.processed_topCard = False  # whether the current player has played a card or not
+        self.hasSkipped = False  # whether the current player has been skipped
+        self.force_pickup = 0  # how many cards the next player has to pick up
+        self.timer = 60  # how long the current player has to play a card before they are skipped
+        # and kicked from the game
+        self.winner = None
+        self.turns = 0
+        self.phase = None
+        self.skips = 0  # players to skip on the next advance
+        self.version = 0  # bumped every time an action changes the table
+
+    # hooks
+    def announce(self, message=None, embed=None, delete_after=None):
+        pass
+
+    def notify(self, player, message):
+        pass
+
+    def newBot(self):
+        return Seat(self.rng.randint(0, 1000000000), f'Bot {len(self.players) + 1}', isBot=True)
+
+    @property
+    def currentPlayer(self):
+        return self.players[self.currentPlayerIndex]
+
+    def deal(self, bots):
+        """Build and shuffle the deck, fill empty seats with bots and deal the starting hands."""
+        self.status = 'setup'
+        self.deck = array('B', range(DECK_SIZE))
+        self.rng.shuffle(self.deck)
+        if bots:
+            for i in range(self.settings['seats'] - len(self.players)):
+                self.players.append(self.newBot())
+        self.rng.shuffle(self.players)
+        for player in self.players:
+            for i in range(self.settings['startCards']):
+                player.hand.append(self.deck.pop())
+        self.discard.append(self.deck.pop())
+        self.status = 'ready'
+
+    def begin(self):
+        """Pick the seating order and turn over a coloured starting card."""
+        if self.status != 'ready':
+            return False
+        self.status = 'started'
+        self.rng.shuffle(self.players)
+        while COLOR[self.discard[-1]] == BLACK:
+            self.discard.append(self.deck.pop())
+        return True
+
+    @property
+    def topState(self):
+        return topState(self.discard[-1], self.wildColor)
+
+    def playable(self, player):
+        """Bitmask of the cards in the player's hand they may play right now."""
+        if player != self.players[self.currentPlayerIndex]:
+            return 0
+        return player.hand.mask & PLAYABLE[self.topState]
+
+    def canPlay(self, card, player):
+        # A card is allowed to be played if it is the same color or type as the top card in the discard pile
+        # if the player is the current player
+        return self.playable(player) >> card & 1 == 1
+
+    def play(self, player, card):
+        if self.canPlay(card, player):
+            self.discard.append(card)
+            self.wildColor = None
+            self.announce(f'{player.name} has played a {COLORS[COLOR[card]].title()} {TYPES[TYPE[card]]}!',
+                          delete_after=10)
+            player.hand.remove(card)
+            return True
+        else:
+            return False
+
+    def take(self):
+        """Take the top card of the deck, reshuffling the discard pile into it if it has run out."""
+        if len(self.deck) <= 0:
+            if len(self.discard) <= 1:
+                return None
+            # reshuffle the discard pile into the deck, except for the top card
+            self.deck = self.discard[:-1]
+            self.rng.shuffle(self.deck)
+            self.discard = self.discard[-1:]
+            self.announce("The deck has been reshuffled!", delete_after=10)
+        return self.deck.pop()
+
+    def draw(self, player):
+        if self.status == 'started':
+            card = self.take()
+            if card is None:
+                return False
+            player.hand.append(card)
+            self.announce(f'{player.name} has drawn a card!', delete_after=10)
+            return True
+        else:
+            return False
+
+    def chooseColor(self, player):
+        if player.strategy is not None:
+            return player.strategy.chooseColor(self, player)
+        return self.rng.randrange(4)
+
+    def chooseCard(self, player):
+        """The card a bot plays this turn, or None if it has to draw."""
+        if player.strategy is not None:
+            return player.strategy.chooseCard(self, player, self.playable(player))
+        return lowest(self.playable(player))
+
+    def advance(self, steps=1):
+        self.currentPlayerIndex = (self.currentPlayerIndex + steps) % len(self.players)
+
+    def getPlayer(self, id):
+        for player in self.players:
+            if player.id == id:
+                return player
+        return None
+
+    def apply(self, action):
+        """Feed one action into the turn state machine and run it until it needs input again.
+
+        ``action`` is ``{'type': ..., 'data': {...}}`` with a type of ``start``, ``play_card`` (``card`` is a card
+        id), ``draw_card``, ``wild_choice`` (``color`` is a colour index) or ``kick``. Returns False if the action is
+        not allowed right now, in which case nothing changes.
+        """
+        if self.status != 'started':
+            return False
+        kind = action['type']
+        data = action.get('data', {})
+        player = self.getPlayer(data.get('player'))
+        if kind == 'start':
+            if self.phase is not None:
+                return False
+            self.phase = RESOLVING
+        elif kind == 'play_card':
+            if self.phase != AWAITING_INPUT or not self.play(player, data['card']):
+                return False
+            self.phase = AWAITING_COLOR if COLOR[data['card']] == BLACK and not player.isBot else RESOLVING
+            if self.phase == RESOLVING and data.get('color') is not None and COLOR[data['card']] == BLACK:
+                # the bot already decided which colour to name
+                self.wildColor = data['color']
+                self.announce(f'{player.name} has chosen the color {COLORS[self.wildColor]}!', delete_after=10)
+        elif kind == 'draw_card':
+            if self.phase != AWAITING_INPUT or player is not self.currentPlayer:
+                return False
+            self.draw(player)
+            self.phase = ADVANCE
+        elif kind == 'wild_choice':
+            if self.phase != AWAITING_COLOR or player is not self.currentPlayer:
+                return False
+            self.wildColor = data['color']
+            self.announce(f'{player.name} has chosen the color {COLORS[self.wildColor]}!', delete_after=10)
+            self.phase = RESOLVING
+        elif kind == 'kick':
+            if player is None:
+                return False
+            self.removePlayer(player)
+        else:
+            return False
+        self.version += 1
+        while True:
+            if self.phase == RESOLVING:
+                self.resolveEffects()
+                self.phase = ADVANCE
+            elif self.phase == ADVANCE:
+                self.advanceTurn()
+                self.phase = ENDED if self.status == 'ended' else AWAITING_INPUT
+            else:
+                return True
+
+    def resolveEffects(self):
+        """Apply the card that was just played (or turned over at the start) to the table."""
+        topCard = self.discard[-1]
+        if COLOR[topCard] == BLACK:
+            if TYPE[topCard] == WILD4:
+                self.force_pickup += 4
+            if self.wildColor is None:
+                self.wildColor = self.chooseColor(self.currentPlayer)
+                self.announce(f'{self.currentPlayer.name} has chosen the color {COLORS[self.wildColor]}!',
+                              delete_after=10)
+        if TYPE[topCard] == REVERSE:
+            # the player before the one who reversed goes next
+            self.players.reverse()
+            self.currentPlayerIndex = (len(self.players) - 1 - self.currentPlayerIndex) % len(self.players)
+            self.announce(f'{self.currentPlayer.name} has reversed the order of play!', delete_after=10)
+        elif TYPE[topCard] == SKIP:
+            self.skips += 1
+        elif TYPE[topCard] == DRAW2:
+            self.force_pickup += 2
+        else:
+            self.timer = 60
+
+    def advanceTurn(self):
+        """Pass the turn on, handing out any cards the next player has to pick up, and check for a winner."""
+        self.processed_topCard = False
+        self.turns += 1
+        self.advance()
+        while self.skips > 0:
+            self.announce(f'{self.currentPlayer.name} has been skipped!', delete_after=10)
+            self.advance()
+            self.skips -= 1
+        # check if the player has to pick up cards
+        if self.force_pickup > 0:
+            self.announce(f'{self.currentPlayer.name} has to pick up {self.force_pickup} cards!', delete_after=10)
+            self.notify(self.currentPlayer, f"You have to pick up {self.force_pickup} cards!")
+            for i in range(self.force_pickup):
+                card = self.take()
+                if card is not None:
+                    self.currentPlayer.hand.append(card)
+            self.force_pickup = 0
+        for player in self.players:
+            if len(player.hand) == 0 or player.score >= 500:
+                self.end()
+                return
+
+    def end(self, winner=None):
+        self.status = 'ended'
+        self.phase = ENDED
+        if winner is None:
+            # sort players by hand size, lowest to highest
+            self.players.sort(key=lambda x: len(x.hand))
+            winner = self.players[0]
+        self.winner = winner
+        self.announce(f'{self.winner.name} has won the game!\nThanks for playing!', delete_after=10)
+
+    def botAction(self):
+        """The action the current bot takes: play the first card it can, otherwise draw."""
+        player = self.currentPlayer
+        card = self.chooseCard(player)
+        if card is not None:
+            # the colour for a wild is part of the move, so replaying the action always names the same one
+            color = self.chooseColor(player) if COLOR[card] == BLACK else None
+            return {'type': 'play_card', 'data': {'card': card, 'player': player.id, 'color': color}}
+        return {'type': 'draw_card', 'data': {'player': player.id}}
+
+    def step(self):
+        """Play one bot turn. Returns False once the game is over or it is a human's turn."""
+        if self.phase != AWAITING_INPUT or not self.currentPlayer.isBot:
+            return False
+        self.apply(self.botAction())
+        return self.status == 'started'
+
+    def removePlayer(self, player):
+        """Take a player out of the game. If it was their turn it passes to whoever was next."""
+        index = self.players.index(player)
+        current = index == self.currentPlayerIndex
+        self.players.remove(player)
+        if index <= self.currentPlayerIndex:
+            self.currentPlayerIndex -= 1
+        if len(self.players) == 1 or (not player.isBot and all(p.isBot for p in self.players)):
+            self.end(self.players[0])
+        elif current and self.phase == AWAITING_COLOR:
+            # they played a wild card and never chose a colour, so pick one for them and carry on
+            self.wildColor = self.chooseColor(player)
+            self.phase = RESOLVING
+        elif current:
+            self.phase = ADVANCE
@@ -1,437 +1,516 @@
 import asyncio
 import logging
 import random
-from pprint import pprint
-import json
 import discord
-from discord.ext import commands, tasks
-from datetime import timedelta, datetime
-
-
-class CardCollection:
-    def __init__(self):
-        self.cards = []
-
-    def append(self, card):
-        self.cards.append(card)
-
-    def pop(self):
-        return self.cards.pop()
-
-    def shuffle(self):
-        random.shuffle(self.cards)
-
-    def remove(self, card):
-        self.cards.remove(card)
-
-    def __len__(self):
-        return len(self.cards)
-
-    def __iter__(self):
-        return iter(self.cards)
-
-    def __contains__(self, item):
-        return item in self.cards
-
-    def __getitem__(self, item):
-        return self.cards[item]
-
-    def __setitem__(self, key, value):
-        self.cards[key] = value
-
-    def __delitem__(self, key):
-        del self.cards[key]
-
-    def clear(self):
-        self.cards.clear()
-
-
-class Card:
-    def __init__(self, color, type):
-        self.color = color
-        self.overridenColor = None
-        self.type = type
-
-    def __str__(self):
-        return f'{self.color} {self.type}' if self.overridenColor is None else f'{self.overridenColor} {self.type}'
-
-
-class Player:
+from discord.ext import commands
+from datetime import datetime
+from array import array
+from utils.outbound import TURN, STATUS, ANNOUNCE
+from utils.metrics import registry as metrics
+from utils.logs import TableLogger
+from utils.interactions import PLAY, DRAW, CHOOSE, encode, components
+from utils import journal
+from utils.cards import COLORS, NAME, LABEL, EMOJI
+from utils.engine import Seat, Game, AWAITING_INPUT, AWAITING_COLOR
+from utils.strategy import STRATEGIES, Strategy, Greedy, search, pool
+from concurrent.futures.process import BrokenProcessPool
+
+
+# parsed once here rather than for every button of every render
+CARD_EMOJI = tuple(discord.PartialEmoji.from_str(emoji) for emoji in EMOJI)
+# a message holds at most 25 components and one of them is the draw button
+MAX_CARD_BUTTONS = 24
+
+
+class Player(Seat):
     def __init__(self, bot, id):
+        super().__init__(id)
         self.bot = bot
-        self.id = id
         if self.id is not None:
-            self.name = self.bot.get_user(self.id).name
-        else:
-            self.name = 'NAME_NOT_SET'
-        self.hand = CardCollection()
-        self.score = 0
+            self.name = self.bot.resolver.name(self.id)
         self.gameMSG = None
-        self.isBot = False
+        self.renderKey = None  # Table.renderKey of the game message as Discord last accepted it
+        self.renderVersion = None  # table version that message was rendered at
+        self.seat = None  # stable index into Table.seats, used by the buttons to find this player
+        self.shownVersion = None  # table version of the newest message with buttons sent to this player
+        self.statusMSG = None
+        self.statusContent = None
         # get time since epoch
         self.lastSeen = int(datetime.now().timestamp())
 
-    async def send(self, message=None, embed=None, view=None):
-        if self.gameMSG is None:
-            self.gameMSG = await self.bot.get_user(self.id).send(message, embed=embed, view=view)
-        else:
-            await self.gameMSG.edit(message, embed=embed, view=view)
-        return self.gameMSG
+    def send(self, message=None, embed=None, view=None):
+        """Queue the game message to be sent, or edited once it exists. A newer call replaces one still queued."""
+        async def write():
+            if self.gameMSG is None:
+                self.gameMSG = await (await self.bot.resolver.channel(self.id)).send(message, embed=embed, view=view)
+            else:
+                await self.gameMSG.edit(message, embed=embed, view=view)
+            return self.gameMSG
+        return self.bot.outbound.submit(self.id, write, TURN, key='game')
 
-    async def delete(self):
-        await self.gameMSG.delete()
-        self.gameMSG = None
+    def sendStatus(self, content):
+        """Queue the player's copy of the table's announcements, if it changed."""
+        if content == self.statusContent:
+            return None
+        self.statusContent = content
+
+        async def write():
+            if self.statusMSG is None:
+                self.statusMSG = await (await self.bot.resolver.channel(self.id)).send(content)
+            else:
+                await self.statusMSG.edit(content=content)
+            return self.statusMSG
+        return self.bot.outbound.submit(self.id, write, STATUS, key='status')
 
-    def __str__(self):
-        return f'{self.id}'
+    def delete(self):
+        """Queue the game message's deletion, dropping any edit of it that hasn't been sent yet."""
+        async def remove():
+            if self.gameMSG is not None:
+                await self.gameMSG.delete()
+                self.gameMSG = None
+        self.renderKey = None
+        return self.bot.outbound.submit(self.id, remove, TURN, key='game')
 
 
 class Bot(Player):
-    def __init__(self, bot, id=None):
+    def __init__(self, bot, id=None, rng=random, strategy=None):
         with open('data/firstnames.txt', 'r') as f:
             NAMES = f.read().splitlines()
         super().__init__(bot, id)
         if id is None:
-            self.id = random.randint(0, 1000000000)
-        self.name = 'Bot ' + random.choice(NAMES).strip()
+            self.id = rng.randint(0, 1000000000)
+        self.name = 'Bot ' + rng.choice(NAMES).strip()
         self.isBot = True
+        self.strategy = strategy if strategy is not None else Strategy(rng)
 
     async def send(self, message=None, embed=None, view=None):
         return True
 
+    def sendStatus(self, content):
+        return None
+
     async def delete(self):
         return True
 
 
-class Table:
-    def __init__(self, players: list[int], bot: commands.AutoShardedBot):
+class Table(Game):
+    def __init__(self, players: list[int], bot: commands.AutoShardedBot, seed=None, botLevel='normal'):
         self.bot = bot
-        self.logger = logging.getLogger('discord')
-        self.deck = CardCollection()
-        self.discard = CardCollection()
-        self.players = [Player(self.bot, player) for player in players]
-        self.settings = {'maxStackSize': 7,
-                         'startCards': 7,
-                         'drawUntilPlayable': True}
-        self.status = 'waiting'
-        self.currentPlayerIndex = -1
-        self.processed_topCard = False  # whether the current player has played a card or not
-        self.hasSkipped = False  # whether the current player has been skipped
-        self.force_pickup = 0  # how many cards the next player has to pick up
-        self.timer = 60  # how long the current player has to play a card before they are skipped
-        # and kicked from the game
-        self.winner = None
+        self.logger = TableLogger(logging.getLogger('uno.game'), self)
+        super().__init__([Player(self.bot, player) for player in players], seed)
+        self.id = bot.games.newId()
+        self.startedAt = None
+        self.settings['botLevel'] = botLevel  # which strategy bots at this table use, see utils.strategy
+        self.settings['botBudget'] = 0.25  # seconds a budgeted strategy may think per turn
+        self.settings['choiceTimeout'] = 30  # seconds a player has to answer a prompt before the default is used
+        self.settings['afkTimeout'] = 60  # seconds the current player has to move before they're warned
+        self.settings['afkGrace'] = 30  # seconds between warning an inactive player and kicking them
         self.isBotGame = True if len([player for player in self.players if not player.isBot]) == 0 else False
-        self.status_msg = None
         self.annoucements = []
-
-    @tasks.loop(seconds=10)
-    async def update_gameMsg(self):
-        if self.status == 'started':
-            for player in self.players:
-                embed, view = await self.createGameEmbedMessage(player)
-                await player.send(embed=embed, view=view)
-
-    @tasks.loop(seconds=5)
-    async def update_statusMsg(self):
+        self.actions = asyncio.Queue()
+        self.driver = None
+        self.renderedVersion = None
+        self.seats = []  # players by seat, which unlike self.players never gets reordered
+        self.statusTimer = None  # pending update of the announcements
+        self.rerenderTimer = None  # pending retry of game messages Discord didn't accept
+        self.deadline = None  # pending warning or kick of the current player, see updateDeadline
+        self.deadlineFor = None  # (player id, turn) the deadline is running for
+        self.decisions = {}  # (player id, kind) -> (future, Timer) for choices players have been asked to make
+        self.requests = 0  # Discord requests queued for this table, reported when it finishes
+        self.replaying = False  # whether actions are being replayed from the journal
+
+    def scheduleStatus(self):
+        """Update everyone's copy of the announcements shortly, so a burst of them costs one edit."""
+        if self.statusTimer is None:
+            self.statusTimer = self.bot.timers.call_later(1, self.flushStatus)
+
+    def flushStatus(self):
+        self.statusTimer = None
+        content = '\n'.join(self.annoucements[-15:])
         for player in self.players:
-            if not player.isBot:
-                if self.status_msg is not None:
-                    await self.status_msg.edit(content='\n'.join(self.annoucements[-15:]))
-                else:
-                    self.status_msg = await self.bot.get_user(player.id).send('\n'.join(self.annoucements[-15:]))
-
-    @tasks.loop(seconds=10)
-    async def check_players(self):
-        """If player is inactive for 1 minute 30 seconds, kick them from the game."""
-        if self.status == 'started':
-            for player in self.players:
-                now = int(datetime.now().timestamp())
-                self.logger.info(
-                    f'Player {player.name} was last seen at {now - player.lastSeen}' if not player.isBot else None)
-                if now - player.lastSeen > 60 and not player.isBot:
-                    await self.bot.get_user(player.id).send(f"You will be kicked from the game in "
-                                                            f"{90 - (now - player.lastSeen)} seconds for being "
-                                                            "inactive.", delete_after=30)
-                if now - player.lastSeen > 90 and not player.isBot:
-                    self.players.remove(player)
-                    await player.delete()
-                    self.logger.info(f'Removed player {player.name} from game. (AFK)')
-                    self.currentPlayerIndex -= 1
-                    await self.tick({'type': 'kick', 'data': {'player': player.id}})
-                    if len(self.players) == 1 or len([player for player in self.players if not player.isBot]) == 0:
-                        self.status = 'ended'
-                        self.winner = self.players[0]
-                        self.logger.info(f'Game {self} has ended')
-                        self.announce(f'{self.winner.name} has won the game!\nThanks for playing!', delete_after=10)
-                        for player in self.players:
-                            await player.delete()
-                        self.update_gameMsg.stop()
-                        self.update_statusMsg.stop()
-                        return True
+            if not player.isBot and content and player.sendStatus(content) is not None:
+                self.requests += 1
+
+    def updateDeadline(self):
+        """Start the clock on the human whose turn it is, if it isn't already running for this turn."""
+        player = self.currentPlayer
+        key = None if player.isBot or self.status != 'started' else (player.id, self.turns)
+        if key == self.deadlineFor:
+            return
+        self.cancelDeadline()
+        self.deadlineFor = key
+        if key is not None:
+            self.deadline = self.bot.timers.call_later(self.settings['afkTimeout'], self.warnInactive, player)
+
+    def cancelDeadline(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+        self.deadline = None
+        self.deadlineFor = None
+
+    def warnInactive(self, player):
+        grace = self.settings['afkGrace']
+        self.dm(player, f"You will be kicked from the game in {grace} seconds for being inactive.", delete_after=grace)
+        self.deadline = self.bot.timers.call_later(grace, self.kickInactive, player)
+
+    def kickInactive(self, player):
+        self.deadline = None
+        if self.status != 'started' or player not in self.players:
+            return
+        player.delete()
+        self.logger.info(f'Removed player {player.name} from game. (AFK)')
+        self.submit({'type': 'kick', 'data': {'player': player.id}})
+
+    def newBot(self):
+        # bots get their own rng so that only the rules draw from the table's, which keeps the journal replayable
+        rng = random.Random(self.rng.random())
+        strategy = STRATEGIES[self.settings['botLevel']](rng)
+        if strategy.budgeted:
+            strategy.budget = self.settings['botBudget']
+        return Bot(self.bot, rng=rng, strategy=strategy)
+
+    async def botDecision(self):
+        """Ask the current bot for its move. Budgeted strategies think in the worker pool so the loop never blocks."""
+        player = self.currentPlayer
+        strategy = player.strategy
+        playable = self.playable(player)
+        if not strategy.budgeted or not playable:
+            with metrics.time('bot_decision_seconds', level=self.settings['botLevel']):
+                return self.botAction()
+        start = self.bot.loop.time()
+        try:
+            card, color = await asyncio.wait_for(
+                self.bot.loop.run_in_executor(pool(), search, strategy.snapshot(self, player), strategy.budget,
+                                              strategy.rng.random()),
+                timeout=strategy.budget * 2)
+        except (asyncio.TimeoutError, BrokenProcessPool) as e:
+            # the search stops itself at the budget, so this only happens when the pool is overloaded or broken
+            self.logger.warning(f'Bot {player.name} fell back to the greedy strategy: {e!r}')
+            card = Greedy.chooseCard(strategy, self, player, playable)
+            color = Greedy.chooseColor(strategy, self, player)
+        metrics.observe('bot_decision_seconds', self.bot.loop.time() - start, level=self.settings['botLevel'])
+        if card is None:
+            return {'type': 'draw_card', 'data': {'player': player.id}}
+        return {'type': 'play_card', 'data': {'card': card, 'player': player.id, 'color': color}}
 
     async def setup(self, bots):
-        self.status = 'setup'
-        for color in ['red', 'yellow', 'green', 'blue']:
-            for i in range(10):
-                self.deck.append(Card(color, i))
-                if i != 0:
-                    self.deck.append(Card(color, i))
-            self.deck.append(Card(color, 'skip'))
-            self.deck.append(Card(color, 'reverse'))
-            self.deck.append(Card(color, '+2'))
-        for i in range(4):
-            self.deck.append(Card('black', 'wild'))
-            self.deck.append(Card('black', 'wild+4'))
-        self.deck.shuffle()
-        if bots:
-            if len(self.players) < 7:
-                for i in range(7 - len(self.players)):
-                    self.players.append(Bot(self.bot))
-        random.shuffle(self.players)
-        for player in self.players:
-            for i in range(self.settings['startCards']):
-                player.hand.append(self.deck.pop())
-        self.discard.append(self.deck.pop())
-        self.status = 'ready'
+        # open everyone's DM channel together now rather than one by one on the first turn
+        humans = [player for player in self.players if not player.isBot]
+        await self.bot.resolver.prewarm([player.id for player in humans])
+        for player in humans:
+            player.name = self.bot.resolver.name(player.id, player.name)
+        self.deal(bots)
+        self.seats = list(self.players)
+        for seat, player in enumerate(self.seats):
+            player.seat = seat
         self.announce(
             f"Welcome to Uno! You are playing with {', '.join([str(player.name) for player in self.players])}!\nThe "
             f"game is setting up and will start soon.", delete_after=15)
-        self.update_gameMsg.start()
-        self.check_players.start()
         await asyncio.sleep(3)
         await self.start()
 
     async def start(self):
-        if self.status == 'ready':
-            self.update_statusMsg.start()
-            self.status = 'started'
-            random.shuffle(self.players)
-            while self.discard[-1].color == 'black':
-                self.discard.append(self.deck.pop())
-            await self.tick({'type': 'start'})
+        if self.begin():
+            self.startedAt = int(datetime.now().timestamp())
+            self.bot.journal.open(self)
+            self.apply({'type': 'start'})
+            self.driver = self.bot.loop.create_task(self.run())
             return True
         else:
+            self.status = 'cancelled'
+            metrics.inc('games_finished_total', result='cancelled')
+            self.cancelTimers()
+            self.bot.games.ended(self)
             return False
 
+    @classmethod
+    def restore(cls, bot, snapshot):
+        """Rebuild a table from a journal snapshot. Returns the table and how many log records the snapshot covers."""
+        table = cls([], bot)
+
+        def makeSeat(id, name, isBot):
+            seat = table.newBot() if isBot else Player(bot, None)
+            seat.id = id
+            seat.name = name
+            return seat
+
+        records = journal.load(table, snapshot, makeSeat)
+        table.isBotGame = all(player.isBot for player in table.players)
+        return table, records
+
+    def replay(self, action):
+        """Apply an action from the journal without writing it again or telling anyone about it."""
+        self.replaying = True
+        try:
+            return super().apply(action)
+        finally:
+            self.replaying = False
+
+    def resume(self):
+        """Carry on with a table recovered from the journal after a restart."""
+        self.announce('The bot restarted, carrying on where the game left off!')
+        if self.phase is None:
+            self.apply({'type': 'start'})
+        self.driver = self.bot.loop.create_task(self.run())
+
+    def apply(self, action):
+        """Apply an action and, if the table accepted it, append it to the journal."""
+        record = journal.encode(self, action)
+        with metrics.time('game_apply_seconds'):
+            accepted = super().apply(action)
+        metrics.inc('game_actions_total', type=action['type'], result='accepted' if accepted else 'rejected')
+        if not accepted:
+            return False
+        self.bot.journal.record(self, record)
+        return True
+
+    def dm(self, player, message=None, priority=ANNOUNCE, **kwargs):
+        """Queue a message to a player's DMs."""
+        self.requests += 1
+        return self.bot.resolver.dm(player.id, message, priority, **kwargs)
+
     def announce(self, message=None, embed=None, delete_after=None):
+        if self.replaying:
+            return
         if message is not None and embed is None:
             self.annoucements.append(message)
+            self.scheduleStatus()
         else:
             for player in self.players:
                 if not player.isBot:
-                    self.bot.loop.create_task(self.bot.get_user(player.id).send(message, embed=embed,
-                                                                                delete_after=delete_after))
+                    self.dm(player, message, embed=embed, delete_after=delete_after)
 
-    def canPlay(self, card, player):
-        # A card is allowed to be played if it is the same color or type as the top card in the discard pile
-        # if the player is the current player
-        if player != self.players[self.currentPlayerIndex]:
-            return False
-        topCard = self.discard[-1]
-        try:
-            topCard.overridenColor
-        except AttributeError:
-            pass
-        else:
-            if topCard.overridenColor is not None and topCard.color == 'black':
-                if topCard.overridenColor == card.color or topCard.type == card.type:
-                    return True
-                else:
-                    return False
-        if card.color != 'black':
-            if topCard.color == card.color or topCard.type == card.type:
-                return True
-        elif card.color == 'black':
-            return True
-        else:
-            return False
+    def notify(self, player, message):
+        if not player.isBot and not self.replaying:
+            self.dm(player, message, delete_after=10)
 
     def play(self, player, card):
-        if self.canPlay(card, player):
-            self.discard.append(card)
-            self.announce(f'{player.name} has played a {card.color.title()} {card.type}!', delete_after=10)
-            player.hand.remove(card)
+        if super().play(player, card):
             if player.isBot:
-                self.logger.info(f'Bot {player.name} played a {card.color} {card.type}')
+                self.logger.debug(f'Bot {player.name} played a {NAME[card]}')
             return True
-        else:
-            return False
-
-    async def tick(self, data):
-        """Every time a player plays a card or draws a card, this function is called to check if the game has ended."""
-
-        async def WildChoice(interaction: discord.Interaction):
-            await interaction.response.defer()
-            await interaction.delete_original_response()
-            data = json.loads(interaction.data['custom_id'])
-            color = data['data']['color']
-            self.discard[-1].overridenColor = color
-            self.announce(f'{self.players[self.currentPlayerIndex].name} has chosen the color {color}!',
-                          delete_after=10)
+        return False
 
-        if self.status == 'started':
-            # Next player
-            self.processed_topCard = False
-            topCard = self.discard[-1]
-            if topCard.color == 'black' and data['type'] != 'draw_card':
-                if topCard.type == 'wild+4':
-                    self.force_pickup += 4
-                # if a wild card is played, send a message to the player asking them to choose a color
-                if self.players[self.currentPlayerIndex].isBot:
-                    # if the player is a bot, choose a random color
-                    self.discard[-1].overridenColor = random.choice(['red', 'yellow', 'green', 'blue'])
-                    self.announce(f'{self.players[self.currentPlayerIndex].name} has chosen the color '
-                                  f'{self.discard[-1].overridenColor}!', delete_after=10)
-                else:
-                    view = discord.ui.View()
-                    for color in ['red', 'yellow', 'green', 'blue']:
-                        button = discord.ui.Button(label=color.title(), style=discord.ButtonStyle.blurple,
-                                                   custom_id=json.dumps({'type': 'wild_choice', 'data': {
-                                                       'color': color,
-                                                       'player': self.players[self.currentPlayerIndex].id}}))
-                        button.callback = WildChoice
-                        view.add_item(button)
-                    await self.bot.get_user(self.players[self.currentPlayerIndex].id).send("Choose a color", view=view)
-                    while self.discard[-1].overridenColor is None:
-                        await asyncio.sleep(1)
-            # Main Tick Logic
-            self.currentPlayerIndex += 1
-            if self.currentPlayerIndex >= len(self.players):
-                self.currentPlayerIndex -= len(self.players)
-            if not data['type'] == 'draw_card':
-                # check top card for special cards
-                if topCard.type == 'skip':
-                    # skip the next player by adding 2 to the current player index
-                    self.currentPlayerIndex += 1
-                    if self.currentPlayerIndex >= len(self.players):
-                        self.currentPlayerIndex -= len(self.players)
-                    self.announce(f'{self.players[self.currentPlayerIndex - 1].name} has been skipped!',
-                                  delete_after=10)
-                elif topCard.type == 'reverse':
-                    self.players.reverse()
-                    self.currentPlayerIndex = self.players.index(self.players[self.currentPlayerIndex])
-                    # PLAYERNAME has reversed the order of play!
-                    self.announce(f'{self.players[self.currentPlayerIndex + 1].name} has reversed the order of play!',
-                                  delete_after=10)
-                    self.currentPlayerIndex += 1
-                    if self.currentPlayerIndex >= len(self.players):
-                        self.currentPlayerIndex -= len(self.players) + 1
-                elif topCard.type == '+2':
-                    self.force_pickup += 2
-                else:
-                    self.timer = 60
-                # check if the player has to pick up cards
-                if self.force_pickup > 0:
-                    print(f"Giving {self.force_pickup} cards to {self.players[self.currentPlayerIndex].name}")
-                    self.announce(
-                        f'{self.players[self.currentPlayerIndex].name} has to pick up {self.force_pickup} cards!',
-                        delete_after=10)
-                    if not self.players[self.currentPlayerIndex].isBot:
-                        await self.bot.get_user(self.players[self.currentPlayerIndex].id).send(
-                            f"You have to pick up {self.force_pickup} cards!", delete_after=10)
-                    for i in range(self.force_pickup):
-                        self.players[self.currentPlayerIndex].hand.append(self.deck.pop())
-                    self.force_pickup = 0
-            for player in self.players:
-                if len(player.hand) == 0 or player.score >= 500:
-                    self.status = 'ended'
-                    # sort players by hand size, lowest to highest
-                    self.players.sort(key=lambda x: len(x.hand))
-                    self.winner = self.players[0]
-                    print("Game ended")
-                    self.announce(f'{self.winner.name} has won the game!\nThanks for playing!', delete_after=10)
-                    for player in self.players:
-                        await player.delete()
-                    self.update_gameMsg.stop()
-                    return True
-            if self.players[self.currentPlayerIndex].isBot:
-                # Bot accounts will automatically play a card if they can, otherwise they will draw a card
-                for i, card in enumerate(self.players[self.currentPlayerIndex].hand):
-                    if self.canPlay(card, self.players[self.currentPlayerIndex]):
-                        self.play(self.players[self.currentPlayerIndex], card)
-                        # sleep for a random float time between 0.5 and 3 seconds to simulate thinking
-                        await asyncio.sleep(random.uniform(0.01, 1.5))
-                        await self.tick({'type': 'play_card', 'data': {'card': {'index': i},
-                                                                       'player': self.players[
-                                                                           self.currentPlayerIndex].id}})
-                        return True
-                self.draw(self.players[self.currentPlayerIndex])
-                await self.tick({'type': 'draw_card', 'data': {'player': self.players[self.currentPlayerIndex].id}})
-            return True
-        else:
+    async def finish(self):
+        """Tear down the Discord side of the table once the rules say the game is over."""
+        if self.status != 'ended':
             return False
+        self.logger.info(f'Game {self} has ended')
+        self.requests += sum(not player.isBot for player in self.players)
+        await asyncio.gather(*[player.delete() for player in self.players], return_exceptions=True)
+        metrics.inc('games_finished_total', result='finished')
+        metrics.observe('game_discord_requests', self.requests)
+        self.cancelTimers()
+        self.bot.journal.close(self)
+        self.bot.games.ended(self)
+        return True
 
-    def draw(self, player):
-        if self.status == 'started':
-            print(len(self.deck))
-            if len(self.deck) <= 0:
-                # reshuffle the discard pile into the deck, except for the top card
-                topCard = self.discard[-1]
-                self.deck = self.discard
-                self.deck.shuffle()
-                self.discard = CardCollection()
-                self.discard.append(topCard)
-                self.announce("The deck has been reshuffled!", delete_after=10)
-            player.hand.append(self.deck.pop())
-            self.announce(f'{player.name} has drawn a card!', delete_after=10)
-            return True
-        else:
+    def removePlayer(self, player):
+        super().removePlayer(player)
+        self.bot.games.leave(self, player.id)
+
+    def cancelTimers(self):
+        self.cancelDeadline()
+        for playerId, kind in list(self.decisions):
+            self.cancelDecision(playerId, kind)
+        if self.statusTimer is not None:
+            self.statusTimer.cancel()
+            self.statusTimer = None
+        if self.rerenderTimer is not None:
+            self.rerenderTimer.cancel()
+            self.rerenderTimer = None
+
+    def decide(self, player, kind, timeout, default):
+        """A future for a choice ``player`` has been asked to make, such as a wild card's colour.
+
+        ``answer`` resolves it with what they picked. If they haven't answered after ``timeout`` seconds it resolves
+        to ``default()`` instead, and a table that ends while it's pending cancels it.
+        """
+        self.cancelDecision(player.id, kind)
+        future = self.bot.loop.create_future()
+        timer = self.bot.timers.call_later(timeout, self.expireDecision, player, kind, default)
+        self.decisions[(player.id, kind)] = (future, timer)
+        return future
+
+    def answer(self, player, kind, value):
+        """Resolve a pending decision. Returns False if there isn't one, e.g. because it already timed out."""
+        pending = self.decisions.pop((player.id, kind), None)
+        if pending is None:
             return False
+        future, timer = pending
+        timer.cancel()
+        if future.done():
+            return False
+        player.lastSeen = int(datetime.now().timestamp())
+        future.set_result(value)
+        return True
 
-    async def createGameEmbedMessage(self, player) -> tuple[discord.Embed, discord.ui.View]:
-        # Create an embed to display the game state to the player including their hand using discord emojis
-        async def callback(interaction: discord.Interaction):
-            await interaction.response.defer()
-            player_to_play = json.loads(interaction.data['custom_id'])['data']['player']
-            card_to_play = json.loads(interaction.data['custom_id'])['data']['card']['index']
-            # Get more info about the player and card
-            for player in self.players:
-                if player.id == player_to_play:
-                    player_to_play = player
-                    break
-            # if it is the players turn
-            if not player_to_play == self.players[self.currentPlayerIndex]:
-                await interaction.followup.send("It is not your turn!", delete_after=5)
-                return False
-            if self.canPlay(player_to_play.hand[card_to_play], player_to_play):
-                self.play(player_to_play, player_to_play.hand[card_to_play])
-                await self.tick(json.loads(interaction.data['custom_id']))
-                player_to_play.lastSeen = int(datetime.now().timestamp())
-                for player in self.players:
-                    embed, view = await self.createGameEmbedMessage(player)
-                    if player == player_to_play:
-                        try:
-                            await interaction.edit_original_response(embed=embed, view=view)
-                        except discord.errors.NotFound:
-                            self.logger.error(f'Failed to edit original response for {player.name}')
-                    else:
-                        await player.send(embed=embed, view=view)
-            else:
+    def expireDecision(self, player, kind, default):
+        pending = self.decisions.pop((player.id, kind), None)
+        if pending is not None and not pending[0].done():
+            self.logger.info(f'Player {player.name} took too long to decide, using the default')
+            pending[0].set_result(default())
 
-                await interaction.followup.send("You can't play this card!", delete_after=5)
+    def cancelDecision(self, playerId, kind):
+        pending = self.decisions.pop((playerId, kind), None)
+        if pending is not None:
+            pending[1].cancel()
+            pending[0].cancel()
 
-        async def notYourTurn(interaction: discord.Interaction):
-            await interaction.response.send_message("It's not your turn!", delete_after=5)
-            return True
+    def submit(self, action):
+        """Queue a player's action for the turn loop. Interaction callbacks return as soon as this is done."""
+        self.actions.put_nowait(action)
 
-        async def drawcallback(interaction: discord.Interaction):
+    async def run(self):
+        """Drive the table until it ends. If the turn loop fails the table is cancelled rather than left running."""
+        try:
+            await self.turnLoop()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.error(f'Game {self.id} crashed, cancelling it: {e!r}', exc_info=True)
+            await self.abort()
+
+    async def abort(self):
+        """Cancel a table that can't carry on, freeing its players and dropping it from the journal."""
+        self.status = 'cancelled'
+        metrics.inc('games_finished_total', result='crashed')
+        self.cancelTimers()
+        for player in self.players:
+            if not player.isBot:
+                self.dm(player, 'Sorry, something went wrong and this game had to be cancelled.', delete_after=60)
+        await asyncio.gather(*[player.delete() for player in self.players], return_exceptions=True)
+        self.bot.journal.close(self)
+        self.bot.games.ended(self)
+
+    async def turnLoop(self):
+        """The turn loop: let bots move, wait for the next human action and apply it, until the game ends.
+
+        Only this task changes the game state once it has started, so every action is applied in order and a
+        streak of bot turns is a loop rather than a chain of nested calls.
+        """
+        while self.status == 'started':
+            self.updateDeadline()
+            if self.phase == AWAITING_INPUT and self.currentPlayer.isBot:
+                # Bot accounts will automatically play a card if they can, otherwise they will draw a card
+                action = await self.botDecision()
+                if action['type'] == 'play_card' and not self.currentPlayer.strategy.budgeted:
+                    # sleep for a random float time between 0.5 and 3 seconds to simulate thinking
+                    await asyncio.sleep(random.uniform(0.01, 1.5))
+                self.apply(action)
+                continue
+            if self.actions.empty() and self.renderedVersion != self.version:
+                # about to wait on a human, so show everyone where the game is at
+                await self.render()
+            if self.phase == AWAITING_COLOR:
+                player = self.currentPlayer
+                prompt = await self.promptColor()
+                # if they don't answer in time the wild becomes the colour they're holding most of
+                color = await self.decide(player, CHOOSE, self.settings['choiceTimeout'],
+                                          lambda: Greedy(self.rng).chooseColor(self, player))
+                prompt.add_done_callback(lambda prompt: self.removePrompt(player, prompt))
+                self.apply({'type': 'wild_choice', 'data': {'color': color, 'player': player.id}})
+                continue
+            action = await self.actions.get()
+            if self.apply(action) and action['type'] != 'kick':
+                self.getPlayer(action['data']['player']).lastSeen = int(datetime.now().timestamp())
+        await self.finish()
+
+    def renderKey(self, player):
+        """Everything that goes into this player's game message."""
+        return (self.currentPlayerIndex, tuple((p.id, len(p.hand)) for p in self.players), len(self.deck),
+                len(self.discard), self.discard[-1], self.wildColor, player.hand.mask)
+
+    async def render(self):
+        """Edit the game message of every player whose view of the game changed since it was last sent."""
+        if self.version == self.renderedVersion:
+            return
+        self.renderedVersion = self.version
+        start = self.bot.loop.time()
+        for player in self.players:
+            if player.isBot:
+                continue
+            key = self.renderKey(player)
+            if key == player.renderKey:
+                continue
+            embed, view = await self.createGameEmbedMessage(player)
+            # queued rather than awaited, so one slow DM doesn't hold up everyone else's update
+            sent = player.send(embed=embed, view=view)
+            sent.add_done_callback(lambda sent, player=player, key=key, version=self.version:
+                                   self.rendered(player, key, version, sent))
+            self.requests += 1
+        metrics.observe('game_render_seconds', self.bot.loop.time() - start)
+
+    def rendered(self, player, key, version, sent):
+        """A game message edit finished. Its buttons only count as shown once Discord has accepted it."""
+        error = None if sent.cancelled() else sent.exception()
+        if sent.cancelled() or error is not None:
+            # try again shortly, or the player is left clicking buttons from an older message. Someone who has
+            # blocked the bot won't get it either way, the AFK timer deals with them
+            self.renderedVersion = None
+            if (self.rerenderTimer is None and self.status == 'started' and
+                    not isinstance(error, discord.errors.Forbidden)):
+                self.rerenderTimer = self.bot.timers.call_later(1, self.rerender)
+            return
+        if player.renderVersion is not None and version < player.renderVersion:
+            return
+        player.renderKey = key
+        player.renderVersion = version
+        if player.shownVersion is None or version > player.shownVersion:
+            player.shownVersion = version
+
+    def rerender(self):
+        self.rerenderTimer = None
+        if self.status == 'started':
+            self.bot.loop.create_task(self.render())
+
+    async def promptColor(self):
+        """Ask the player who just played a wild card which colour it should be."""
+        player = self.currentPlayer
+        # the prompt is now the only message of theirs that should act
+        player.shownVersion = self.version
+        view = components(discord.ui.Button(label=color.title(), style=discord.ButtonStyle.blurple,
+                                            custom_id=encode(self.id, player.seat, CHOOSE, i, self.version))
+                          for i, color in enumerate(COLORS[:4]))
+        return self.dm(player, "Choose a color", TURN, view=view)
+
+    def click(self, userId, action, seat, arg, version):
+        """Act on a click on one of this table's buttons. Returns why it was refused, or None if it was accepted."""
+        player = self.seats[seat] if seat < len(self.seats) else None
+        if player is None or player.id != userId or player not in self.players:
+            return "You're not playing in this game!"
+        if version != player.shownVersion:
+            # a click on a message that has since been replaced, don't act on what the player can no longer see
+            return "That's an old message, use the latest one!"
+        if player is not self.currentPlayer:
+            return "It's not your turn!"
+        if action == PLAY:
+            if arg not in player.hand or not self.canPlay(arg, player):
+                return "You can't play this card!"
+            self.submit({'type': 'play_card', 'data': {'card': arg, 'player': player.id}})
+        elif action == DRAW:
+            self.submit({'type': 'draw_card', 'data': {'player': player.id}})
+        elif not self.answer(player, CHOOSE, arg):
+            return "It's too late to choose now!"
+        return None
+
+    def removePrompt(self, player, prompt):
+        """Delete a colour prompt once it has been answered or timed out."""
+        if not prompt.cancelled() and prompt.exception() is None:
+            self.requests += 1
+            self.bot.outbound.submit(player.id, prompt.result().delete, TURN)
+
+    async def interact(self, interaction: discord.Interaction, action, seat, arg, version):
+        """Handle a click on one of this table's buttons, already decoded from its custom_id by the game cog."""
+        error = self.click(interaction.user.id, action, seat, arg, version)
+        if error is None:
             await interaction.response.defer()
-            player_to_play = json.loads(interaction.data['custom_id'])['data']['player']
-            for player in self.players:
-                if player.id == player_to_play:
-                    player_to_play = player
-                    break
-            self.draw(player_to_play)
-            await self.tick(json.loads(interaction.data['custom_id']))
-            for player in self.players:
-                embed, view = await self.createGameEmbedMessage(player)
-                if player == player_to_play:
-                    await interaction.edit_original_response(embed=embed, view=view)
-                else:
-                    await player.send(embed=embed, view=view)
+        else:
+            await interaction.response.send_message(error, delete_after=5)
 
-        embed = discord.Embed(title=f'Uno!', description=f'Game stats:')
+    async def createGameEmbedMessage(self, player) -> tuple[discord.Embed, discord.ui.View]:
+        # Create an embed to display the game state to the player including their hand using discord emojis
+        embed = discord.Embed(title='Uno!', description='Game stats:')
         embed.add_field(name='Players',
                         value=', '.join([f'{player.name} ({len(player.hand)})' if player != self.players[
                             self.currentPlayerIndex] else f'**{player.name} ({len(player.hand)})**' for player in
@@ -439,126 +518,64 @@ class Table:
         embed.add_field(name='Draw pile', value=f'{len(self.deck)} cards left')
         embed.add_field(name='Discard pile', value=f'{len(self.discard)} cards')
         # if the top card is a wild card, display the overriden color
-        if self.discard[-1].overridenColor is None:
-            embed.add_field(name='Top card', value=f"{self.convertCardtoName(self.discard[-1])} "
-                                                   f"({str(self.discard[-1].color).title()} "
-                                                   f"{str(self.discard[-1].type).title()})")
+        topCard = self.discard[-1]
+        if self.wildColor is None:
+            embed.add_field(name='Top card', value=f"{self.convertCardtoName(topCard)} ({NAME[topCard].title()})")
         else:
-            embed.add_field(name='Top card', value=f"{self.convertCardtoName(self.discard[-1])} "
-                                                   f"({str(self.discard[-1].overridenColor).title()} "
-                                                   f"{str(self.discard[-1].type).title()})")
-        view = discord.ui.View()
-        # if it's the current player's turn, add a button to draw a card
-        if player == self.players[self.currentPlayerIndex]:
-            for i, card in enumerate(player.hand):
-                if self.canPlay(card, player):
-                    button = discord.ui.Button(emoji=self.convertCardtoName(card),
-                                               label=f"{card.color} {card.type}".title(),
-                                               custom_id=json.dumps({'type': 'play_card', 'data': {
-                                                   'card': {'index': i},
-                                                   'player': player.id}}), style=discord.ButtonStyle.green)
-                else:
-                    button = discord.ui.Button(emoji=self.convertCardtoName(card),
-                                               label=f"{card.color} {card.type}".title(),
-                                               custom_id=json.dumps({'type': 'play_card', 'data': {
-                                                   'card': {'index': i},
-                                                   'player': player.id}}), style=discord.ButtonStyle.red,
-                                               disabled=True)
-                button.callback = callback
-                view.add_item(button)
-            button = discord.ui.Button(emoji='🃏', label='Draw a card', custom_id=json.dumps({'type': 'draw_card',
-                                                                                             'data': {
-                                                                                                 'player': player.id}}),
-                                       style=discord.ButtonStyle.blurple)
-            button.callback = drawcallback
-            view.add_item(button)
+            embed.add_field(name='Top card', value=f"{self.convertCardtoName(topCard)} "
+                                                   f"({COLORS[self.wildColor].title()} "
+                                                   f"{NAME[topCard].split()[1].title()})")
+        buttons = []
+        cards = list(player.hand)
+        current = player == self.players[self.currentPlayerIndex]
+        playable = self.playable(player) if current else 0
+        if len(cards) > MAX_CARD_BUTTONS:
+            # too many for one message, so the playable cards get buttons first
+            cards = sorted(sorted(cards, key=lambda card: not playable >> card & 1)[:MAX_CARD_BUTTONS])
+            embed.add_field(name='Your hand', value=f'{len(player.hand)} cards, {len(player.hand) - len(cards)} '
+                                                    f'not shown')
+        # only the current player's buttons are enabled, playable cards in green
+        if current:
+            for card in cards:
+                buttons.append(discord.ui.Button(emoji=CARD_EMOJI[card], label=LABEL[card],
+                                                 custom_id=encode(self.id, player.seat, PLAY, card, self.version),
+                                                 style=discord.ButtonStyle.green if playable >> card & 1
+                                                 else discord.ButtonStyle.red,
+                                                 disabled=not playable >> card & 1))
+            buttons.append(discord.ui.Button(emoji='🃏', label='Draw a card',
+                                             custom_id=encode(self.id, player.seat, DRAW, 0, self.version),
+                                             style=discord.ButtonStyle.blurple))
         else:
-            for i, card in enumerate(player.hand):
-                button = discord.ui.Button(emoji=self.convertCardtoName(card),
-                                           label=f"{card.color} {card.type}".title(),
-                                           custom_id=json.dumps({'type': 'play_card', 'data': {
-                                               'card': {'index': i},
-                                               'player': player.id}}), style=discord.ButtonStyle.gray, disabled=True)
-                button.callback = notYourTurn
-                view.add_item(button)
-            button = discord.ui.Button(emoji='🃏', label='Draw a card', custom_id=json.dumps({'type': 'draw_card',
-                                                                                             'data': {
-                                                                                                 'player': player.id}}),
-                                       style=discord.ButtonStyle.gray, disabled=True)
-            button.callback = notYourTurn
-            view.add_item(button)
-        return embed, view
+            for card in cards:
+                buttons.append(discord.ui.Button(emoji=CARD_EMOJI[card], label=LABEL[card],
+                                                 custom_id=encode(self.id, player.seat, PLAY, card, self.version),
+                                                 style=discord.ButtonStyle.gray, disabled=True))
+            buttons.append(discord.ui.Button(emoji='🃏', label='Draw a card',
+                                             custom_id=encode(self.id, player.seat, DRAW, 0, self.version),
+                                             style=discord.ButtonStyle.gray, disabled=True))
+        return embed, components(buttons)
 
     def convertCardtoName(self, card):
-        map = {"black wild": "<:blackwild:1144942824836571167>",
-               "black wild+4": "<:blackplusfour:1144942822248685679>",
-               "red 0": "<:red0:1144943495610650715>",
-               "red 1": "<:red1:1144943497338699788>",
-               "red 2": "<:red2:1144943499167412264>",
-               "red 3": "<:red3:1144943501444915201>",
-               "red 4": "<:red4:1144943503042957334>",
-               "red 5": "<:red5:1144943505622450206>",
-               "red 6": "<:red6:1151938864429154455>",
-               "red 7": "<:red7:1144942889105899540>",
-               "red 8": "<:red8:1144943508340359199>",
-               "red 9": "<:red9:1144942892163551232>",
-               "red skip": "<:redskip:1144943512270405662>",
-               "red reverse": "<:redswap:1144943515063824424>",
-               "red +2": "<:redplustwo:1151938865720983558>",
-               "yellow 0": "<:yellow0:1151938869118373908>",
-               "yellow 1": "<:yellow1:1151938871702081607>",
-               "yellow 2": "<:yellow2:1144957924163198997>",
-               "yellow 3": "<:yellow3:1144957927766097960>",
-               "yellow 4": "<:yellow4:1144957928642719825>",
-               "yellow 5": "<:yellow5:1144957930907639868>",
-               "yellow 6": "<:yellow6:1144957932195299439>",
-               "yellow 7": "<:yellow7:1144957934212755527>",
-               "yellow 8": "<:yellow8:1144957936607703161>",
-               "yellow 9": "<:yellow9:1144957938478370846>",
-               "yellow skip": "<:yellowskip:1144957942379065364> ",
-               "yellow reverse": "<:yellowswap:1144957943738020013>",
-               "yellow +2": "<:yellowplustwo:1144957941099794452>",
-               "green 0": "<:green0:1144943483531046932>",
-               "green 1": "<:green1:1144942854267994122>",
-               "green 2": "<:green2:1144943484801912862>",
-               "green 3": "<:green3:1144942857875095592>",
-               "green 4": "<:green4:1144943487410765855>",
-               "green 5": "<:green5:1144942862786637884>",
-               "green 6": "<:green6:1144942865429045328>",
-               "green 7": "<:green7:1144943488992034866>",
-               "green 8": "<:green8:1144942868331495445>",
-               "green 9": "<:green9:1144943490355179602>",
-               "green skip": "<:greenskip:1144943493534449684>",
-               "green reverse": "<:greenswap:1144942876418113546>",
-               "green +2": "<:greenplustwo:1144942871779221554>",
-               "blue 0": "<:blue0:1144942826396852266>",
-               "blue 1": "<:blue1:1144942827965526037>",
-               "blue 2": "<:blue2:1144942830641500180>",
-               "blue 3": "<:blue3:1144942832344383508>",
-               "blue 4": "<:blue4:1144942835691425903>",
-               "blue 5": "<:blue5:1144942837134270574>",
-               "blue 6": "<:blue6:1144942839436955761>",
-               "blue 7": "<:blue7:1144942841160798248>",
-               "blue 8": "<:blue8:1144942843564134481>",
-               "blue 9": "<:blue9:1144942844881154098>",
-               "blue skip": "<:blueskip:1144942849322909718>",
-               "blue reverse": "<:blueswap:1144942851550097478>",
-               "blue +2": "<:blueplustwo:1144943480393711677>"}
-        try:
-            return map[f'{card.color} {card.type}']
-        except KeyError:
-            print(f'KeyError: {card.color} {card.type}')
-            self.logger.error(f'KeyError: {card.color} {card.type}')
-            return None
+        return EMOJI[card]
 
     def cleanup(self):
         """Cleanup the game after it has ended"""
         self.status = 'ended'
         self.players = []
-        self.deck = CardCollection()
-        self.discard = CardCollection()
+        self.deck = array('B')
+        self.discard = array('B')
+        self.wildColor = None
         self.currentPlayerIndex = -1
         self.hasSkipped = False
         self.force_pickup = 0
         self.timer = 60
-        self.update_gameMsg.stop()
+        self.cancelTimers()
+
+
+metrics.describe('game_apply_seconds', 'histogram', 'Time to apply one action to a table')
+metrics.describe('game_actions_total', 'counter', 'Actions submitted to tables, by type and whether they were accepted')
+metrics.describe('game_render_seconds', 'histogram', 'Time to build the game messages after a change')
+metrics.describe('bot_decision_seconds', 'histogram', 'Time for a bot to choose its move, by level')
+metrics.describe('games_finished_total', 'counter', 'Tables that finished or were cancelled')
+metrics.describe('game_discord_requests', 'histogram', 'Discord requests queued over the whole of one game',
+                 buckets=(5, 10, 25, 50, 100, 250, 500, 1000))
@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import os
+import struct
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from utils.cards import Hand
+from utils.engine import AWAITING_INPUT, AWAITING_COLOR, RESOLVING, ADVANCE, ENDED
+
+# Every action a table accepts is appended to data/games/<table id>.log as one 4 byte record: the action, the seat
+# that took it, the card id and the colour (255 for none). Seats rather than user ids keep the records fixed size.
+# Everything random happens inside Game.apply using the table's own rng, so replaying the records from a snapshot
+# of the table (data/games/<table id>.snap) rebuilds exactly the same game, reshuffles, skips and reverses included.
+ACTIONS = ('start', 'play_card', 'draw_card', 'wild_choice', 'kick')
+RECORD = struct.Struct('<BBBB')
+NONE = 255
+
+FORMAT = 1
+PHASES = (None, AWAITING_INPUT, AWAITING_COLOR, RESOLVING, ADVANCE, ENDED)
+STATUSES = ('waiting', 'setup', 'ready', 'started', 'ended', 'cancelled')
+# format, table id, started at, records, status, phase, current player, wild colour, pickup, skips, turns, version,
+# timer, bot budget in ms, number of seats, number of players still in, deck length, discard length, bot level length
+HEADER = struct.Struct('<BQqIBBbBBBIIHHBBBBB')
+SEAT = struct.Struct('<QBH12sB')  # id, is bot, score, hand mask, name length
+RNG = struct.Struct('<625Id')
+
+
+def dump(game, records):
+    """The table as bytes, ``records`` being how many log records it already includes."""
+    level = game.settings['botLevel'].encode()
+    seatIndex = {id(seat): i for i, seat in enumerate(game.seats)}
+    parts = [HEADER.pack(FORMAT, game.id, game.startedAt or 0, records, STATUSES.index(game.status),
+                         PHASES.index(game.phase), game.currentPlayerIndex,
+                         NONE if game.wildColor is None else game.wildColor, game.force_pickup, game.skips,
+                         game.turns, game.version, game.timer, int(game.settings['botBudget'] * 1000),
+                         len(game.seats), len(game.players), len(game.deck), len(game.discard), len(level)), level]
+    for seat in game.seats:
+        name = seat.name.encode()[:255]
+        parts.append(SEAT.pack(seat.id, seat.isBot, seat.score, seat.hand.mask.to_bytes(12, 'little'), len(name)))
+        parts.append(name)
+    parts.append(bytes(seatIndex[id(player)] for player in game.players))
+    parts.append(game.deck.tobytes())
+    parts.append(game.discard.tobytes())
+    _, state, gauss = game.rng.getstate()
+    parts.append(RNG.pack(*state, float('nan') if gauss is None else gauss))
+    return b''.join(parts)
+
+
+def load(game, data, makeSeat):
+    """Restore a table written by ``dump`` into ``game``. ``makeSeat(id, name, isBot)`` creates each player.
+
+    Returns how many log records the snapshot already includes.
+    """
+    (version, game.id, startedAt, records, status, phase, game.currentPlayerIndex, wildColor, game.force_pickup,
+     game.skips, game.turns, game.version, game.timer, budget, seats, players, deck, discard,
+     levelLength) = HEADER.unpack_from(data)
+    if version != FORMAT:
+        raise ValueError(f'Unknown snapshot format {version}')
+    offset = HEADER.size
+    game.settings['botLevel'] = data[offset:offset + levelLength].decode()
+    game.settings['botBudget'] = budget / 1000
+    offset += levelLength
+    game.startedAt = startedAt or None
+    game.status = STATUSES[status]
+    game.phase = PHASES[phase]
+    game.wildColor = None if wildColor == NONE else wildColor
+    game.seats = []
+    for i in range(seats):
+        playerId, isBot, score, mask, nameLength = SEAT.unpack_from(data, offset)
+        offset += SEAT.size
+        seat = makeSeat(playerId, data[offset:offset + nameLength].decode(), bool(isBot))
+        offset += nameLength
+        seat.seat = i
+        seat.score = score
+        seat.hand = Hand(int.from_bytes(mask, 'little'))
+        game.seats.append(seat)
+    game.players = [game.seats[i] for i in data[offset:offset + players]]
+    offset += players
+    game.deck = array('B', data[offset:offset + deck])
+    offset += deck
+    game.discard = array('B', data[offset:offset + discard])
+    offset += discard
+    *state, gauss = RNG.unpack_from(data, offset)
+    game.rng.setstate((3, tuple(state), None if gauss != gauss else gauss))
+    return records
+
+
+def encode(game, action):
+    """The log record for an action, worked out before it's applied since a kick takes the player out."""
+    data = action.get('data', {})
+    player = game.getPlayer(data.get('player'))
+    card = data.get('card')
+    color = data.get('color')
+    return RECORD.pack(ACTIONS.index(action['type']), NONE if player is None else player.seat,
+                       NONE if card is None else card, NONE if color is None else color)
+
+
+def decode(game, record):
+    kind, seat, card, color = record
+    data = {}
+    if seat != NONE:
+        data['player'] = game.seats[seat].id
+    if card != NONE:
+        data['card'] = card
+    if color != NONE:
+        data['color'] = color
+    return {'type': ACTIONS[kind], 'data': data}
+
+
+class Journal:
+    """Write-ahead logs and snapshots of every running table, kept as ``bot.journal``, so games survive a restart.
+
+    Records are buffered on the event loop as soon as an action is accepted, and everything buffered by the end of
+    that pass of the loop is appended to the tables' logs on the journal's own thread, which opens each log only for
+    as long as the write takes. That keeps the number of open files flat however many tables are running. Records are
+    only written to the OS, not synced, which is enough to survive the bot crashing. Every ``snapshotEvery`` records
+    the whole table is written out on the same thread to a temporary file that replaces the last snapshot, so there
+    is always one complete snapshot and recovery only replays the records after it.
+    """
+
+    def __init__(self, directory='data/games', snapshotEvery=32):
+        self.directory = directory
+        self.snapshotEvery = snapshotEvery
+        self.logger = logging.getLogger('uno.journal')
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+        self.counts = {}  # table id -> records written
+        self.pending = {}  # table id -> records not yet handed to the journal's thread
+        self.flushScheduled = False
+
+    def path(self, tableId, suffix):
+        return os.path.join(self.directory, f'{tableId}.{suffix}')
+
+    def submit(self, function, *args):
+        """Run a file operation on the journal's thread, in order with the others."""
+        future = asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        future.add_done_callback(self.written)
+
+    def written(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error(f'Journal write failed: {future.exception()!r}')
+
+    def open(self, game):
+        """Start journaling a table that is about to start."""
+        os.makedirs(self.directory, exist_ok=True)
+        self.counts[game.id] = 0
+        self.pending[game.id] = bytearray()
+        self.submit(self.truncate, game.id, 0)
+        self.snapshot(game)
+
+    def record(self, game, record):
+        count = self.counts.get(game.id)
+        if count is None:
+            return
+        self.pending[game.id] += record
+        self.counts[game.id] = count + 1
+        if not self.flushScheduled:
+            self.flushScheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+        if (count + 1) % self.snapshotEvery == 0:
+            self.snapshot(game)
+
+    def flush(self):
+        """Hand every buffered record to the journal's thread in one batch."""
+        self.flushScheduled = False
+        batch = {tableId: bytes(records) for tableId, records in self.pending.items() if records}
+        if not batch:
+            return
+        for tableId in batch:
+            self.pending[tableId].clear()
+        self.submit(self.writeLogs, batch)
+
+    def writeLogs(self, batch):
+        for tableId, records in batch.items():
+            with open(self.path(tableId, 'log'), 'ab') as f:
+                f.write(records)
+
+    def truncate(self, tableId, size):
+        """Cut a log down to ``size`` bytes, creating it if it's missing."""
+        with open(self.path(tableId, 'log'), 'ab') as f:
+            f.truncate(size)
+
+    def snapshot(self, game):
+        # the records the snapshot counts are queued to the log ahead of it
+        self.flush()
+        data = dump(game, self.counts[game.id])
+        self.submit(self.writeSnapshot, game.id, data)
+
+    def writeSnapshot(self, tableId, data):
+        path = self.path(tableId, 'snap')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def close(self, game):
+        """Stop journaling a table that has ended and delete its files."""
+        if self.counts.pop(game.id, None) is None:
+            return
+        self.pending.pop(game.id, None)
+        self.submit(self.remove, game.id)
+
+    def remove(self, tableId):
+        for suffix in ('log', 'snap', 'snap.tmp'):
+            try:
+                os.remove(self.path(tableId, suffix))
+            except FileNotFoundError:
+                pass
+
+    def read(self):
+        """Every saved table as ``(table id, snapshot, log)``."""
+        if not os.path.isdir(self.directory):
+            return []
+        games = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.snap'):
+                continue
+            tableId = int(name[:-5])
+            with open(self.path(tableId, 'snap'), 'rb') as f:
+                snapshot = f.read()
+            try:
+                with open(self.path(tableId, 'log'), 'rb') as f:
+                    log = f.read()
+            except FileNotFoundError:
+                log = b''
+            games.append((tableId, snapshot, log))
+        return games
+
+    async def recover(self, restore):
+        """Rebuild the tables that were running when the bot stopped.
+
+        ``restore(snapshot)`` creates a table from its snapshot using ``load`` and returns it with the number of
+        records the snapshot includes. The records after that are replayed onto it and journaling carries on in the
+        same files.
+        """
+        loop = asyncio.get_running_loop()
+        games = []
+        for tableId, snapshot, log in await loop.run_in_executor(self.executor, self.read):
+            try:
+                game, records = restore(snapshot)
+                # a torn final record from a crash mid-write is dropped
+                total = len(log) // RECORD.size
+                for i in range(records, total):
+                    game.replay(decode(game, RECORD.unpack_from(log, i * RECORD.size)))
+            except Exception as e:
+                self.logger.error(f'Could not recover game {tableId}: {e!r}')
+                await loop.run_in_executor(self.executor, self.remove, tableId)
+                continue
+            if game.status != 'started':
+                await loop.run_in_executor(self.executor, self.remove, tableId)
+                continue
+            # drops the torn record, and creates the log if it's missing, e.g. if the bot stopped while removing an
+            # ended game's files
+            await loop.run_in_executor(self.executor, self.truncate, tableId, total * RECORD.size)
+            self.counts[tableId] = total
+            self.pending[tableId] = bytearray()
+            if total < records:
+                # the snapshot counts records the log no longer has, so replace it before any are added
+                self.snapshot(game)
+            games.append(game)
+        self.logger.info(f'Recovered {len(games)} games')
+        return games
@@ -0,0 +1,97 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+# Logging is set up once per process by ``setup``. Every logger only puts records on a queue; a QueueListener thread
+# does the formatting and the disk writes, so a slow disk never holds up the event loop.
+#
+# The bot's own loggers are children of ``uno`` (uno.game, uno.outbound, uno.db, ...) so each subsystem's level can be
+# set on its own with LOG_LEVELS, e.g. LOG_LEVELS=uno.game=DEBUG,uno.outbound=WARNING,discord.gateway=WARNING.
+FORMAT = '%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+# structured fields a record may carry, added to the log line when present
+FIELDS = ('game', 'turn', 'player', 'worker')
+
+
+class Formatter(logging.Formatter):
+    """The usual log line with any structured fields on the end, e.g. ``... has ended [game=12 turn=40]``."""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = ' '.join(f'{field}={getattr(record, field)}' for field in FIELDS
+                          if getattr(record, field, None) is not None)
+        return f'{line} [{fields}]' if fields else line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for shipping the logs somewhere that can search by field."""
+
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class TableLogger(logging.LoggerAdapter):
+    """A logger for one table that tags each record with the game id, the turn and whose turn it is."""
+
+    def __init__(self, logger, table):
+        super().__init__(logger, {})
+        self.table = table
+
+    def process(self, msg, kwargs):
+        table = self.table
+        extra = {'game': table.id, 'turn': table.turns}
+        if table.players and table.status == 'started':
+            extra['player'] = table.players[table.currentPlayerIndex % len(table.players)].id
+        kwargs['extra'] = {**extra, **kwargs.get('extra', {})}
+        return msg, kwargs
+
+
+def levels(spec):
+    """Parse ``name=LEVEL,name=LEVEL`` into a dict."""
+    result = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, level = item.partition('=')
+        result[name.strip()] = level.strip().upper()
+    return result
+
+
+def setup(filename, worker=None, console=logging.INFO, maxBytes=10 * 1024 * 1024, backupCount=5):
+    """Send the ``discord`` and ``uno`` loggers through a queue to a rotating file and the console.
+
+    The file is appended to and rotated at ``maxBytes``, keeping ``backupCount`` old files, so the logs from before a
+    restart are still there afterwards. Set LOG_JSON=1 to write the file as JSON lines. Returns the listener.
+    """
+    fileHandler = logging.handlers.RotatingFileHandler(filename, maxBytes=maxBytes, backupCount=backupCount,
+                                                       encoding='utf-8')
+    fileHandler.setLevel(logging.DEBUG)
+    fileHandler.setFormatter(JsonFormatter() if os.getenv('LOG_JSON') else Formatter(FORMAT))
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setLevel(console)
+    consoleHandler.setFormatter(Formatter(FORMAT))
+
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    if worker is not None:
+        handler.addFilter(lambda record: setattr(record, 'worker', worker) or True)
+    for name in ('discord', 'uno'):
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+    for name, level in levels(os.getenv('LOG_LEVELS', '')).items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, consoleHandler, fileHandler, respect_handler_level=True)
+    listener.start()
+    # flush whatever is still queued when the process exits
+    atexit.register(listener.stop)
+    return listener
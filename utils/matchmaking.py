@@ -0,0 +1,206 @@
+import asyncio
+import heapq
+import logging
+from collections import deque
+from utils.metrics import registry as metrics
+from utils.rating import DEFAULT_RATING
+
+
+class Ticket:
+    __slots__ = ('userId', 'bots', 'timestamp', 'skill')
+
+    def __init__(self, userId, bots, timestamp, skill):
+        self.userId = userId
+        self.bots = bots
+        self.timestamp = timestamp
+        self.skill = skill
+
+    def __repr__(self):
+        return f'Ticket({self.userId}, bots={self.bots}, skill={self.skill})'
+
+
+class WaitTimes:
+    """How long recently matched players waited between joining the queue and their game being created."""
+
+    def __init__(self, size=200, window=3600):
+        self.waits = deque(maxlen=size)  # (matched at, seconds waited)
+        self.window = window
+
+    def add(self, matchedAt, wait):
+        self.waits.append((matchedAt, wait))
+        metrics.observe('matchmaking_wait_seconds', wait)
+
+    def estimate(self, now):
+        """The median wait of the matches in the last ``window`` seconds, or None if there weren't any."""
+        recent = sorted(wait for matchedAt, wait in self.waits if matchedAt >= now - self.window)
+        if not recent:
+            return None
+        return recent[len(recent) // 2]
+
+
+class MatchmakingIndex:
+    """Everyone searching for a game, kept in memory as ``bot.matchmaking``.
+
+    Tickets are kept in a heap per bots preference by the time they joined, so the longest waiting players are
+    found without looking at the whole queue, and ``partition`` splits the queue into tables.
+    ``changed`` is set whenever someone joins so the matchmaker runs straight away. The ``queue`` table is only a
+    write-behind copy so the queue survives a restart.
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self.logger = logging.getLogger('uno.matchmaking')
+        self.tickets = {}  # user id -> Ticket
+        self.waiting = {True: [], False: []}  # bots -> heap of (timestamp, user id), stale entries skipped lazily
+        self.changed = asyncio.Event()
+        self.waits = WaitTimes()
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def __contains__(self, userId):
+        return userId in self.tickets
+
+    def add(self, userId, bots, timestamp, playerSkill):
+        bots = bool(bots)
+        ticket = Ticket(userId, bots, timestamp, playerSkill)
+        self.tickets[userId] = ticket
+        heapq.heappush(self.waiting[bots], (timestamp, userId))
+        return ticket
+
+    def enqueue(self, userId, bots, timestamp, playerSkill):
+        """Add a player to the queue and wake the matchmaker."""
+        if userId in self.tickets:
+            self.remove(userId)
+        ticket = self.add(userId, bots, timestamp, playerSkill)
+        self.persist([('INSERT OR REPLACE INTO queue VALUES (?, ?, ?)', (userId, ticket.bots, timestamp))])
+        self.changed.set()
+        return ticket
+
+    def remove(self, userId):
+        return self.tickets.pop(userId, None)
+
+    def dequeue(self, *userIds):
+        """Take players out of the queue, e.g. because they left it or were matched."""
+        tickets = [ticket for ticket in (self.remove(userId) for userId in userIds) if ticket is not None]
+        if tickets:
+            self.persist([('DELETE FROM queue WHERE user_id=?', (ticket.userId,)) for ticket in tickets])
+        return tickets
+
+    def matched(self, userIds, now):
+        """Take players out of the queue because their game is being created, recording how long they waited."""
+        tickets = self.dequeue(*userIds)
+        for ticket in tickets:
+            self.waits.add(now, max(0.0, now - ticket.timestamp))
+        return tickets
+
+    def oldest(self, bots):
+        """The ticket that has waited longest with this bots preference, or None."""
+        heap = self.waiting[bots]
+        while heap:
+            timestamp, userId = heap[0]
+            ticket = self.tickets.get(userId)
+            if ticket is not None and ticket.timestamp == timestamp and ticket.bots == bots:
+                return ticket
+            heapq.heappop(heap)
+        return None
+
+    @staticmethod
+    def nearest(pool, index, size, taken):
+        """The ticket at ``pool[index]`` and up to ``size - 1`` untaken tickets nearest it in skill.
+
+        ``pool`` is sorted by skill, so they're found by walking outwards from the anchor.
+        """
+        anchor = pool[index]
+        group = [anchor]
+        below, above = index - 1, index + 1
+        while len(group) < size:
+            while below >= 0 and pool[below].userId in taken:
+                below -= 1
+            while above < len(pool) and pool[above].userId in taken:
+                above += 1
+            if below < 0 and above >= len(pool):
+                break
+            if above >= len(pool) or (below >= 0 and
+                                      anchor.skill - pool[below].skill <= pool[above].skill - anchor.skill):
+                group.append(pool[below])
+                below -= 1
+            else:
+                group.append(pool[above])
+                above += 1
+        return sorted(group, key=lambda ticket: ticket.skill)
+
+    @staticmethod
+    def viable(group, size, now, solo, backfillAfter):
+        """Whether a group can start: a full table always can, and a short one once someone in it has waited
+        ``backfillAfter``, so it isn't started while more players could still join it. A short table of players who
+        don't want bots needs 2, and one that wants bots has them fill the empty seats."""
+        if len(group) >= size:
+            return True
+        if not group[0].bots:
+            return len(group) > 1 and any(now - ticket.timestamp >= backfillAfter for ticket in group)
+        return any(ticket.userId in solo or now - ticket.timestamp >= backfillAfter for ticket in group)
+
+    def partition(self, size, now, solo=(), maxWait=60, backfillAfter=30):
+        """Split the whole queue into as many tables as it can make, as ``[(user ids, bots), ...]``.
+
+        Players who have waited ``maxWait`` seconds go first, oldest first, each with whoever is nearest them in skill.
+        The rest are sorted by skill and cut into runs of ``size``, which keeps the rating spread at each table as
+        small as it can be. Short tables wait for ``backfillAfter`` (see ``viable``), then any with bots get them in
+        the empty seats. Nobody is taken out of the queue here.
+        """
+        tables = []
+        for bots in (True, False):
+            pool = sorted((ticket for ticket in self.tickets.values() if ticket.bots == bots),
+                          key=lambda ticket: ticket.skill)
+            positions = {ticket.userId: i for i, ticket in enumerate(pool)}
+            taken = set()
+            groups = []
+            for anchor in sorted((ticket for ticket in pool if now - ticket.timestamp >= maxWait),
+                                 key=lambda ticket: ticket.timestamp):
+                if anchor.userId not in taken:
+                    group = self.nearest(pool, positions[anchor.userId], size, taken)
+                    taken.update(ticket.userId for ticket in group)
+                    groups.append(group)
+            rest = [ticket for ticket in pool if ticket.userId not in taken]
+            groups += [rest[i:i + size] for i in range(0, len(rest), size)]
+            for group in groups:
+                if self.viable(group, size, now, solo, backfillAfter):
+                    metrics.observe('matchmaking_table_spread', group[-1].skill - group[0].skill)
+                    tables.append(([ticket.userId for ticket in group], bots))
+        return tables
+
+    def expired(self, before):
+        """Tickets that joined before the given timestamp, oldest first."""
+        tickets = []
+        for bots in (True, False):
+            heap = self.waiting[bots]
+            while self.oldest(bots) is not None and heap[0][0] < before:
+                tickets.append(self.tickets[heapq.heappop(heap)[1]])
+        return tickets
+
+    def persist(self, statements):
+        if self.db is None:
+            return
+        future = self.db.transaction(statements)
+        future.add_done_callback(self.persisted)
+
+    def persisted(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error(f'Failed to save the matchmaking queue: {future.exception()}')
+
+    async def load(self):
+        """Rebuild the index from the persisted queue after a restart."""
+        rows = await self.db.fetchall('SELECT queue.user_id, queue.bots, queue.timestamp, playerData.rating FROM queue '
+                                      'LEFT JOIN playerData ON playerData.playerID = queue.user_id')
+        for userId, bots, timestamp, rating in rows:
+            self.add(userId, bots, timestamp, rating if rating is not None else DEFAULT_RATING)
+        if rows:
+            self.changed.set()
+        self.logger.info(f'Loaded {len(rows)} players into the matchmaking queue')
+
+
+metrics.describe('matchmaking_wait_seconds', 'histogram', 'Time from joining the queue to a game being created',
+                 buckets=(5, 10, 30, 60, 120, 300, 600))
+metrics.describe('matchmaking_table_spread', 'histogram', 'Rating gap between the best and worst player at a new table',
+                 buckets=(25, 50, 100, 200, 400, 800))
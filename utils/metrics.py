@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+
+# upper bounds in seconds, from a fast in-memory step up to a slow Discord request
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Timer:
+    """``with metrics.time('name'):`` observes how long the block took."""
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Metrics:
+    """Counters, histograms and gauges for the whole process, shared as ``utils.metrics.registry`` / ``bot.metrics``.
+
+    Updating a metric is a dict lookup and an add, so it's cheap enough for the turn loop. ``render`` formats
+    everything in the Prometheus text format for the HTTP endpoint and the ``/metrics`` command. Gauges are functions
+    called at render time, so things like the number of running games never need updating. Metrics are also updated
+    from the database's threads, so updates and reads of the counters and histograms hold ``lock``.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.logger = logging.getLogger('uno.metrics')
+        self.help = {}  # name -> (type, help text)
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}  # name -> function returning a value or {labels: value}
+        self.bucketsFor = {}  # name -> bucket bounds for histograms that don't measure seconds
+        self.lock = threading.Lock()
+        self.server = None
+        self.lagTask = None
+
+    def describe(self, name, kind, text, buckets=None):
+        self.help[name] = (kind, text)
+        if buckets is not None:
+            self.bucketsFor[name] = buckets
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.bucketsFor.get(name, self.buckets))
+            histogram.observe(value)
+
+    def time(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def gauge(self, name, function, text=''):
+        self.gauges[name] = function
+        self.describe(name, 'gauge', text)
+
+    @staticmethod
+    def labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{str(value)}"' for key, value in pairs) + '}'
+
+    def header(self, lines, name, kind):
+        _, text = self.help.get(name, (kind, ''))
+        if text:
+            lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    def render(self):
+        lines = []
+        seen = set()
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(((key, histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)
+                                 for key, histogram in self.histograms.items()), key=lambda item: item[0])
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                self.header(lines, name, 'counter')
+            lines.append(f'{name}{self.labels(labels)} {value}')
+        for (name, labels), buckets, counts, histogramSum, histogramCount in histograms:
+            if name not in seen:
+                seen.add(name)
+                self.header(lines, name, 'histogram')
+            total = 0
+            for bound, count in zip(buckets, counts):
+                total += count
+                lines.append(f'{name}_bucket{self.labels(labels, [("le", bound)])} {total}')
+            lines.append(f'{name}_bucket{self.labels(labels, [("le", "+Inf")])} {histogramCount}')
+            lines.append(f'{name}_sum{self.labels(labels)} {histogramSum}')
+            lines.append(f'{name}_count{self.labels(labels)} {histogramCount}')
+        for name, function in sorted(self.gauges.items()):
+            try:
+                value = function()
+            except Exception as e:
+                self.logger.warning(f'Gauge {name} failed: {e!r}')
+                continue
+            self.header(lines, name, 'gauge')
+            if isinstance(value, dict):
+                for labels, item in sorted(value.items()):
+                    lines.append(f'{name}{self.labels(labels)} {item}')
+            else:
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def quantile(self, name, q, **labels):
+        """An estimate of a histogram's ``q`` quantile (the upper bound of the bucket it falls in)."""
+        with self.lock:
+            histogram = self.histograms.get((name, tuple(sorted(labels.items()))))
+            if histogram is None or not histogram.count:
+                return None
+            target = q * histogram.count
+            counts = list(histogram.counts)
+        total = 0
+        for bound, count in zip(histogram.buckets, counts):
+            total += count
+            if total >= target:
+                return bound
+        return math.inf
+
+    async def watchLoop(self, interval=0.5):
+        """Measure how late the event loop wakes up from a sleep, i.e. how long something else held it."""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.observe('loop_lag_seconds', max(0.0, loop.time() - start - interval))
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # skip the headers, nothing in them matters here
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            if request.split(b' ')[1:2] in ([b'/metrics'], [b'/']):
+                body = self.render().encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+            else:
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, port=None, host='127.0.0.1'):
+        """Start measuring loop lag and, if given a port, serve ``/metrics`` on it for Prometheus to scrape."""
+        if self.lagTask is None:
+            self.lagTask = asyncio.get_running_loop().create_task(self.watchLoop())
+        if port is not None and self.server is None:
+            self.server = await asyncio.start_server(self.handle, host, port)
+            self.logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+
+registry = Metrics()
+registry.describe('loop_lag_seconds', 'histogram', 'How late the event loop woke up from a 0.5s sleep')
@@ -0,0 +1,215 @@
+import asyncio
+import itertools
+import logging
+import time
+import discord
+from utils.metrics import registry as metrics
+
+# Lower goes first. Turn-critical updates (the game message, colour prompts) beat the status log, which beats
+# announcements and one-off notices.
+TURN = 0
+STATUS = 1
+ANNOUNCE = 2
+
+
+def copyResult(source, target):
+    """Finish ``target`` the way ``source`` finished, unless it already has."""
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class TokenBucket:
+    """Allows ``capacity`` requests at once, refilling at ``rate`` per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """Take a token, returning how long to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class Job:
+    __slots__ = ('factory', 'future', 'priority', 'key', 'seq', 'attempts')
+
+    def __init__(self, factory, future, priority, key, seq):
+        self.factory = factory
+        self.future = future
+        self.priority = priority
+        self.key = key
+        self.seq = seq
+        self.attempts = 0
+
+
+class Route:
+    """The queued requests for one channel. Requests on a route run one at a time, in priority order."""
+
+    def __init__(self, rate, capacity):
+        self.jobs = []
+        self.bucket = TokenBucket(rate, capacity)
+        self.scheduled = False
+        self.blockedUntil = 0  # time.monotonic() before which Discord asked for nothing more on this channel
+
+    def next(self):
+        job = min(self.jobs, key=lambda job: (job.priority, job.seq))
+        self.jobs.remove(job)
+        return job
+
+
+class Outbound:
+    """Every message the bot sends or edits in a player's DMs goes through here as ``bot.outbound``.
+
+    Each channel has its own queue and token bucket, shaped like Discord's per-channel limit, and a global bucket
+    covers the bot-wide limit. A new edit of a message that still has an edit waiting replaces it (last write wins),
+    and higher priority requests jump the queue. A fixed number of workers send to different channels at the same
+    time, so one slow DM only holds up its own channel. A request that gets a 429 goes back on its channel's queue
+    until Retry-After has passed, up to ``retries`` times.
+    """
+
+    def __init__(self, workers=8, globalRate=50, routeRate=1, routeCapacity=5, retries=3):
+        self.workers = workers
+        self.retries = retries
+        self.globalBucket = TokenBucket(globalRate, globalRate)
+        self.routeRate = routeRate
+        self.routeCapacity = routeCapacity
+        self.logger = logging.getLogger('uno.outbound')
+        self.routes = {}  # channel key -> Route
+        self.ready = None  # PriorityQueue of (priority, seq, channel key)
+        self.tasks = []
+        self.seq = itertools.count()
+        self.stats = {'sent': 0, 'coalesced': 0, 'failed': 0, 'ratelimited': 0, 'retried': 0}
+        self.observers = []  # functions called with (route, exception or None) after every request
+
+    def submit(self, route, factory, priority=ANNOUNCE, key=None):
+        """Queue ``factory()`` (a coroutine function making one request) on a channel and return a future for it.
+
+        ``key`` names the message being written; a queued job with the same key on the same route is replaced by
+        this one and both callers get the result of the request that is actually made.
+        """
+        loop = asyncio.get_running_loop()
+        if not self.tasks:
+            self.ready = asyncio.PriorityQueue()
+            self.tasks = [loop.create_task(self.work()) for _ in range(self.workers)]
+        queue = self.routes.get(route)
+        if queue is None:
+            queue = self.routes[route] = Route(self.routeRate, self.routeCapacity)
+        if key is not None:
+            for job in queue.jobs:
+                if job.key == key:
+                    job.factory = factory
+                    job.priority = min(job.priority, priority)
+                    self.stats['coalesced'] += 1
+                    metrics.inc('discord_requests_coalesced_total', kind=key)
+                    return job.future
+        future = loop.create_future()
+        # callers often don't wait for the result, failures are logged by the worker instead
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        queue.jobs.append(Job(factory, future, priority, key, next(self.seq)))
+        if not queue.scheduled:
+            queue.scheduled = True
+            self.ready.put_nowait((priority, next(self.seq), route))
+        return future
+
+    def send(self, messageable, content=None, priority=ANNOUNCE, key=None, **kwargs):
+        """Queue ``messageable.send(...)`` on the messageable's channel."""
+        return self.submit(getattr(messageable, 'id', messageable),
+                           lambda: messageable.send(content, **kwargs), priority, key)
+
+    async def work(self):
+        while True:
+            _, _, route = await self.ready.get()
+            queue = self.routes[route]
+            job = queue.next()
+            delay = max(queue.bucket.delay(), self.globalBucket.delay(), queue.blockedUntil - time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind = job.key or 'message'
+            start = time.perf_counter()
+            try:
+                result = await job.factory()
+            except discord.errors.HTTPException as e:
+                error = e
+                if e.status == 429:
+                    self.stats['ratelimited'] += 1
+                if e.status == 429 and job.attempts < self.retries:
+                    job.attempts += 1
+                    self.stats['retried'] += 1
+                    metrics.inc('discord_requests_total', kind=kind, result='retried')
+                    queue.blockedUntil = time.monotonic() + self.retryAfter(e)
+                    newer = None if job.key is None else next(
+                        (queued for queued in queue.jobs if queued.key == job.key), None)
+                    if newer is None:
+                        # its seq puts it back at the front of its channel's queue
+                        queue.jobs.append(job)
+                    else:
+                        # a newer write of the same message is already queued, so that one answers both callers
+                        newer.priority = min(newer.priority, job.priority)
+                        newer.future.add_done_callback(lambda done, job=job: copyResult(done, job.future))
+                    self.reschedule(route, queue)
+                    continue
+                self.stats['failed'] += 1
+                metrics.inc('discord_requests_total', kind=kind, result='ratelimited' if e.status == 429 else 'failed')
+                self.logger.warning(f'Outbound request on {route} failed: {e}')
+                if not job.future.done():
+                    job.future.set_exception(e)
+            except Exception as e:
+                error = e
+                self.stats['failed'] += 1
+                metrics.inc('discord_requests_total', kind=kind, result='error')
+                self.logger.error(f'Outbound request on {route} raised {e!r}')
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                error = None
+                self.stats['sent'] += 1
+                metrics.inc('discord_requests_total', kind=kind, result='ok')
+                metrics.observe('discord_request_seconds', time.perf_counter() - start, kind=kind)
+                if not job.future.done():
+                    job.future.set_result(result)
+            for observer in self.observers:
+                observer(route, error)
+            self.reschedule(route, queue)
+
+    def reschedule(self, route, queue):
+        """Put a channel back in line after one of its requests, or let it go if nothing is left on it."""
+        if queue.jobs:
+            entry = (min(job.priority for job in queue.jobs), next(self.seq), route)
+            wait = queue.blockedUntil - time.monotonic()
+            if wait > 0:
+                # no worker sits out the Retry-After, the channel just rejoins the line once it's over
+                asyncio.get_running_loop().call_later(wait, self.ready.put_nowait, entry)
+            else:
+                self.ready.put_nowait(entry)
+        else:
+            queue.scheduled = False
+            # keep the bucket until it has refilled, so a burst straight after this can't skip the limit
+            asyncio.get_running_loop().call_later(self.routeCapacity / self.routeRate, self.forget, route)
+
+    def retryAfter(self, error):
+        """Seconds Discord asked to wait after a 429, or one request's worth of the channel's rate if it didn't say."""
+        headers = getattr(error.response, 'headers', None) or {}
+        try:
+            return float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return 1 / self.routeRate
+
+    def queued(self):
+        return sum(len(queue.jobs) for queue in self.routes.values())
+
+    def forget(self, route):
+        queue = self.routes.get(route)
+        if queue is not None and not queue.scheduled and not queue.jobs:
+            del self.routes[route]
@@ -0,0 +1,151 @@
+import array
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# the functions the event loop sits in while it has nothing to do
+IDLE = {('selectors.py', 'select'), ('selectors.py', 'poll')}
+
+
+def where(code):
+    return f'{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})'
+
+
+class Sampler:
+    """A sampling profiler for a thread of the live process, normally the one running the event loop.
+
+    A background thread looks at the target thread's stack every ``interval`` seconds and counts which function is
+    on top (own time) and every function on the stack (total time). Nothing is installed in the profiled thread, so
+    it runs at full speed between samples and it's safe to turn on in production.
+    """
+
+    def __init__(self, threadId=None, interval=0.005):
+        self.threadId = threading.main_thread().ident if threadId is None else threadId
+        self.interval = interval
+        self.own = Counter()
+        self.total = Counter()
+        self.samples = 0
+        self.idle = 0
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.threadId)
+        if frame is None:
+            return
+        self.samples += 1
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in IDLE:
+            self.idle += 1
+            return
+        self.own[where(code)] += 1
+        seen = set()
+        while frame is not None:
+            if frame.f_code not in seen:
+                seen.add(frame.f_code)
+                self.total[where(frame.f_code)] += 1
+            frame = frame.f_back
+
+    def run(self, seconds):
+        """Sample for ``seconds`` (or until ``stop``), blocking the calling thread. Only one run at a time."""
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError('The profiler is already running')
+        try:
+            self.stopping.clear()
+            end = time.monotonic() + seconds
+            while time.monotonic() < end and not self.stopping.wait(self.interval):
+                self.sample()
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        self.stopping.set()
+
+    @property
+    def running(self):
+        return self.lock.locked()
+
+    def reset(self):
+        self.own.clear()
+        self.total.clear()
+        self.samples = 0
+        self.idle = 0
+
+    def report(self, limit=25):
+        if not self.samples:
+            return 'No samples'
+        busy = self.samples - self.idle
+        lines = [f'{self.samples} samples, loop busy {busy / self.samples:.1%}',
+                 f'{"own":>6} {"total":>6}  function']
+        for function, total in self.total.most_common(limit):
+            lines.append(f'{self.own[function] / self.samples:6.1%} {total / self.samples:6.1%}  {function}')
+        lines.append('')
+        lines.append('hottest by own time:')
+        for function, own in self.own.most_common(limit // 2):
+            lines.append(f'{own / self.samples:6.1%}  {function}')
+        return '\n'.join(lines)
+
+
+def memoryTop(previous=None, limit=15):
+    """The lines that allocated the most memory still in use, or that grew the most since ``previous``.
+
+    Returns the report and the snapshot to compare against next time.
+    """
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f'traced {current / 1024 ** 2:.1f}MiB now, {peak / 1024 ** 2:.1f}MiB peak']
+    if previous is None:
+        for stat in snapshot.statistics('lineno')[:limit]:
+            frame = stat.traceback[0]
+            lines.append(f'{stat.size / 1024:9.1f}KiB {stat.count:7} {os.path.basename(frame.filename)}:{frame.lineno}')
+    else:
+        for stat in snapshot.compare_to(previous, 'lineno')[:limit]:
+            frame = stat.traceback[0]
+            lines.append(f'{stat.size_diff / 1024:+9.1f}KiB {stat.count_diff:+7} '
+                         f'{os.path.basename(frame.filename)}:{frame.lineno}')
+    return '\n'.join(lines), snapshot
+
+
+# containers followed when sizing a table; anything else it refers to is counted on its own but not walked into,
+# which keeps the bot, the loop and other tables reachable through futures and timers out of its total
+WALK = (dict, list, tuple, set, frozenset, array.array)
+
+
+def retainedSize(root, stop):
+    """Roughly the bytes held by ``root``: it, its ``__dict__`` and the containers inside, ids in ``stop`` excluded."""
+    seen = set(stop)
+    pending = [root]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, WALK):
+            if isinstance(obj, dict):
+                pending.extend(obj.keys())
+                pending.extend(obj.values())
+            elif not isinstance(obj, array.array):
+                pending.extend(obj)
+        elif obj is root or getattr(obj, '__module__', None) in ('utils.game', 'utils.engine', 'utils.cards',
+                                                                    'utils.strategy'):
+            attributes = getattr(obj, '__dict__', None)
+            if attributes is not None:
+                pending.append(attributes)
+    return size
+
+
+def tableSizes(tables, shared=()):
+    """``(table, bytes)`` for every table, largest first."""
+    tables = list(tables)
+    stop = {id(obj) for obj in shared} | {id(table) for table in tables}
+    sizes = [(table, retainedSize(table, stop - {id(table)})) for table in tables]
+    return sorted(sizes, key=lambda item: item[1], reverse=True)
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+from utils.metrics import registry as metrics
+
+DEFAULT_RATING = 1000.0
+BOT_RATING = 1000.0  # bots are rated opponents but their own rating never moves
+K = 32
+
+
+def rate(placings):
+    """Multiplayer Elo. ``placings`` is ``[(player id, rating), ...]`` best first; returns ``{player id: change}``.
+
+    Every pair of players at the table counts as one game won by whoever placed higher, and each player's change is
+    averaged over their opponents so a 7 player table moves ratings about as much as a 1v1.
+    """
+    changes = {}
+    n = len(placings)
+    if n < 2:
+        return {playerID: 0.0 for playerID, _ in placings}
+    for i, (playerID, rating) in enumerate(placings):
+        total = 0.0
+        for j, (_, other) in enumerate(placings):
+            if i == j:
+                continue
+            expected = 1 / (1 + 10 ** ((other - rating) / 400))
+            total += (1.0 if i < j else 0.0) - expected
+        changes[playerID] = K * total / (n - 1)
+    return changes
+
+
+class Rating:
+    __slots__ = ('playerID', 'wins', 'losses', 'rating')
+
+    def __init__(self, playerID, wins=0, losses=0, rating=DEFAULT_RATING):
+        self.playerID = playerID
+        self.wins = wins
+        self.losses = losses
+        self.rating = rating
+
+    @property
+    def played(self):
+        return self.wins + self.losses
+
+
+class RankIndex:
+    """How many stored players have each rating, in a Fenwick tree over ``resolution`` wide buckets.
+
+    A player's rank is one more than the number of players in higher buckets, a prefix sum, so looking it up or
+    moving a player after a game is O(log n) however many players there are. Players within ``resolution`` of each
+    other share a rank, and ratings outside ``low``-``high`` are counted in the end buckets.
+    """
+
+    def __init__(self, low=0, high=4000, resolution=0.1):
+        self.low = low
+        self.resolution = resolution
+        self.size = int((high - low) / resolution)
+        self.tree = [0] * (self.size + 1)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def bucket(self, rating):
+        return min(max(int((rating - self.low) / self.resolution), 0), self.size - 1)
+
+    def update(self, rating, delta):
+        i = self.bucket(rating) + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+        self.count += delta
+
+    def add(self, rating):
+        self.update(rating, 1)
+
+    def move(self, old, new):
+        if self.bucket(old) != self.bucket(new):
+            self.update(old, -1)
+            self.update(new, 1)
+
+    def atMost(self, rating):
+        """Players in the rating's bucket or below."""
+        i = self.bucket(rating) + 1
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def rank(self, rating):
+        return self.count - self.atMost(rating) + 1
+
+
+class Ratings:
+    """Player ratings and records cached in memory as ``bot.ratings``.
+
+    Players are loaded from ``playerData`` the first time they're asked for and after that only change when one of
+    their games ends, so matchmaking, ``/stats`` and ``/leaderboard`` never query or aggregate per request. The top
+    of the leaderboard is cached too and only thrown away when a game changes a rating that could appear on it.
+    Further pages are read from the ``(rating, playerID)`` index a page at a time, and ranks come from a RankIndex
+    built on first use and kept up to date by ``apply``. Games are stored as rating changes rather than new ratings,
+    and in cluster mode every worker applies every game's changes, so workers' caches don't drift apart.
+    """
+
+    def __init__(self, db, leaderboardSize=10):
+        self.db = db
+        self.leaderboardSize = leaderboardSize
+        self.logger = logging.getLogger('uno.ratings')
+        self.players = {}  # player id -> Rating
+        self.top = None  # cached leaderboard, best first
+        self.ranks = None  # RankIndex of every stored rating, once something has asked for a rank
+        self.loadingRanks = None
+
+    async def get(self, playerID):
+        """The player's Rating. Players who have never finished a game get a default one that isn't stored."""
+        rating = self.players.get(playerID)
+        metrics.inc('ratings_cache_total', result='miss' if rating is None else 'hit')
+        if rating is None:
+            fa = await self.db.fetchone('SELECT wins,losses,rating FROM playerData WHERE playerID = ?', (playerID,))
+            rating = Rating(playerID, *fa) if fa else Rating(playerID)
+            self.players[playerID] = rating
+        return rating
+
+    async def leaderboard(self):
+        """The top ``leaderboardSize`` players, plus the next one if there is one so callers can tell there's more."""
+        if self.top is None:
+            self.top = await self.page(None, self.leaderboardSize + 1)
+        return self.top
+
+    async def page(self, after, size):
+        """Up to ``size`` players in leaderboard order, starting after the ``(rating, player id)`` cursor ``after``.
+
+        Seeks straight to the cursor on the index instead of counting past an offset, so every page is as quick as
+        the first.
+        """
+        if after is None:
+            rows = await self.db.fetchall('SELECT playerID,wins,losses,rating FROM playerData '
+                                          'ORDER BY rating DESC, playerID DESC LIMIT ?', (size,))
+        else:
+            rows = await self.db.fetchall('SELECT playerID,wins,losses,rating FROM playerData '
+                                          'WHERE (rating, playerID) < (?, ?) '
+                                          'ORDER BY rating DESC, playerID DESC LIMIT ?', (*after, size))
+        # share entries with the per-player cache so both always agree
+        return [self.players.setdefault(row[0], Rating(*row)) for row in rows]
+
+    async def rankIndex(self):
+        if self.ranks is None:
+            if self.loadingRanks is None:
+                self.loadingRanks = asyncio.ensure_future(self.db.fetchall('SELECT rating FROM playerData'))
+            rows = await asyncio.shield(self.loadingRanks)
+            if self.ranks is None:
+                ranks = RankIndex()
+                for rating, in rows:
+                    ranks.add(rating)
+                self.ranks = ranks
+                self.logger.info(f'Indexed {len(ranks)} ratings')
+        return self.ranks
+
+    async def rank(self, playerID):
+        """``(rank, ranked players)`` for a player who has finished a game, None for one who hasn't."""
+        rating = await self.get(playerID)
+        if not rating.played:
+            return None
+        ranks = await self.rankIndex()
+        return ranks.rank(rating.rating), len(ranks)
+
+    async def results(self, placings):
+        """Work out a finished game's rating changes. ``placings`` is ``[(player id, is bot), ...]`` best first.
+
+        Returns ``{player id: (new rating, change)}`` for the humans; nothing is changed until ``apply``.
+        """
+        rated = [(playerID, BOT_RATING if isBot else (await self.get(playerID)).rating) for playerID, isBot in placings]
+        changes = rate(rated)
+        return {playerID: (self.players[playerID].rating + changes[playerID], changes[playerID])
+                for playerID, isBot in placings if not isBot}
+
+    async def apply(self, changes, winnerID):
+        """Update the cache once a game's rating changes, ``{player id: change}``, have been committed.
+
+        The game may have been recorded by another cluster worker, so players who aren't cached here are only read
+        back if the rank index needs to move them.
+        """
+        for playerID, change in changes.items():
+            entry = self.players.get(playerID)
+            if entry is None:
+                if self.ranks is None:
+                    self.top = None
+                    continue
+                # read back after the commit, so the change is already in it
+                entry = await self.get(playerID)
+                old, played = entry.rating - change, entry.played > 1
+            else:
+                old, played = entry.rating, entry.played
+                entry.rating += change
+                if playerID == winnerID:
+                    entry.wins += 1
+                else:
+                    entry.losses += 1
+            rating = entry.rating
+            if self.ranks is not None:
+                if played:
+                    self.ranks.move(old, rating)
+                else:
+                    self.ranks.add(rating)
+            if self.top is not None and (entry in self.top or len(self.top) <= self.leaderboardSize
+                                         or rating >= self.top[-1].rating):
+                self.top = None
@@ -0,0 +1,74 @@
+import logging
+import time
+from collections import OrderedDict
+import discord
+from utils.metrics import registry as metrics
+
+
+class Reachability:
+    """Which users the bot has recently managed to DM, kept as ``bot.reachability``.
+
+    Every DM the outbound scheduler delivers marks its user as reachable and a 403 clears them, so ``/search`` only
+    has to send a test message to users it hasn't reached within ``ttl`` seconds. Entries are written behind to the
+    ``dmReachable`` table so they survive a restart and are shared by cluster workers, at most twice per ``ttl``
+    per user. Only the ``size`` most recently seen users are kept in memory; the rest are read back when needed.
+    """
+
+    def __init__(self, db, ttl=7 * 24 * 3600, size=100000):
+        self.db = db
+        self.ttl = ttl
+        self.size = size
+        self.logger = logging.getLogger('uno.reachability')
+        # user id -> when a DM to them last worked, or None if it hasn't within the ttl, least recently used first
+        self.checked = OrderedDict()
+
+    def remember(self, userId, checkedAt):
+        self.checked[userId] = checkedAt
+        self.checked.move_to_end(userId)
+        if len(self.checked) > self.size:
+            self.checked.popitem(last=False)
+
+    async def reachable(self, userId):
+        """Whether a DM to the user worked within the ttl. False means unknown, not unreachable."""
+        if userId in self.checked:
+            self.checked.move_to_end(userId)
+            checkedAt = self.checked[userId]
+        else:
+            row = await self.db.fetchone('SELECT checkedAt FROM dmReachable WHERE userID = ?', (userId,))
+            checkedAt = row[0] if row else None
+            self.remember(userId, checkedAt)
+        return checkedAt is not None and time.time() - checkedAt < self.ttl
+
+    def mark(self, userId):
+        """A DM to the user just worked."""
+        now = time.time()
+        checkedAt = self.checked.get(userId)
+        if checkedAt is not None and now - checkedAt < self.ttl / 2:
+            return
+        self.remember(userId, now)
+        self.persist([('INSERT OR REPLACE INTO dmReachable (userID, checkedAt) VALUES (?, ?)', (userId, int(now)))])
+
+    def clear(self, userId):
+        """The user has stopped accepting DMs from the bot."""
+        if self.checked.get(userId, 0) is None:
+            return
+        self.remember(userId, None)
+        self.persist([('DELETE FROM dmReachable WHERE userID = ?', (userId,))])
+
+    def observe(self, route, error):
+        """Outbound observer: DM routes are keyed by user id."""
+        if error is None:
+            self.mark(route)
+        elif isinstance(error, discord.errors.Forbidden):
+            self.clear(route)
+
+    def persist(self, statements):
+        future = self.db.transaction(statements)
+        future.add_done_callback(self.persisted)
+
+    def persisted(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error(f'Failed to save DM reachability: {future.exception()}')
+
+
+metrics.describe('dm_checks_total', 'counter', 'DM checks on /search, by whether a test message had to be sent')
@@ -0,0 +1,76 @@
+import asyncio
+import itertools
+import logging
+import time
+
+# table ids double as match ids in the database, so they count up from the clock in milliseconds to stay unique across
+# restarts, and in cluster mode the worker's id goes in the bits above the clock so two workers never hand out the
+# same one. 2**44 milliseconds is over 500 years.
+WORKER_SHIFT = 44
+
+
+class GameRegistry:
+    """Every table that hasn't finished yet, kept as ``bot.games``.
+
+    Tables are indexed by their id and by the id of every human seated at them, so routing a click or checking
+    whether someone is already playing is a dict lookup however many games are running. Tables report back here
+    when a player leaves and when they end or are cancelled; the table is dropped straight away and each of the
+    ``listeners`` (coroutine functions taking the table) is run for it. In cluster mode every change is also passed
+    on to the coordinator, which keeps the cluster-wide view of who is playing where.
+    """
+
+    def __init__(self, worker=None):
+        self.logger = logging.getLogger('uno.game')
+        self.ids = itertools.count((worker or 0) << WORKER_SHIFT | int(time.time() * 1000))
+        self.tables = {}  # table id -> Table
+        self.players = {}  # user id -> Table they're seated at
+        self.listeners = []
+        self.cluster = None
+
+    def __len__(self):
+        return len(self.tables)
+
+    def __iter__(self):
+        return iter(list(self.tables.values()))
+
+    def __contains__(self, userId):
+        return userId in self.players
+
+    def newId(self):
+        """An id for a new table, unique across restarts and cluster workers."""
+        return next(self.ids)
+
+    def add(self, table):
+        self.tables[table.id] = table
+        users = [player.id for player in table.players if not player.isBot]
+        for userId in users:
+            self.players[userId] = table
+        if self.cluster is not None:
+            self.cluster.send('started', game=table.id, users=users)
+
+    def get(self, tableId):
+        return self.tables.get(tableId)
+
+    def tableOf(self, userId):
+        """The table a user is playing at, or None."""
+        return self.players.get(userId)
+
+    def leave(self, table, userId):
+        """A player was removed from a table that is still going."""
+        if self.players.get(userId) is table:
+            del self.players[userId]
+            if self.cluster is not None:
+                self.cluster.send('left', game=table.id, user=userId)
+
+    def ended(self, table):
+        """Drop a table that has ended or been cancelled and let the listeners know."""
+        if self.tables.pop(table.id, None) is None:
+            return
+        for player in table.seats or table.players:
+            if self.players.get(player.id) is table:
+                del self.players[player.id]
+        if self.cluster is not None:
+            self.cluster.send('ended', game=table.id)
+        self.logger.info(f'Removed game {table.id} from the active games ({table.status})')
+        for listener in self.listeners:
+            asyncio.get_running_loop().create_task(listener(table))
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from utils.metrics import registry as metrics
+from utils.outbound import ANNOUNCE
+
+
+class Resolver:
+    """Users and their DM channels by user id, kept as ``bot.resolver``.
+
+    ``bot.get_user`` only knows users in the gateway cache, so it returns None for players the bot shares no cached
+    guild with (e.g. ones on another worker's shards), and every DM has to find the user's channel first. This keeps
+    the most recently used ``size`` users and channels, fetches misses from the API once however many callers are
+    waiting for them, and ``prewarm`` opens a table's DM channels together before its first turn.
+    """
+
+    def __init__(self, bot, size=10000):
+        self.bot = bot
+        self.size = size
+        self.logger = logging.getLogger('uno.resolver')
+        self.users = OrderedDict()  # user id -> User, least recently used first
+        self.channels = OrderedDict()  # user id -> DMChannel, least recently used first
+        self.pending = {}  # user id -> task resolving their DM channel
+
+    def remember(self, cache, userId, value):
+        cache[userId] = value
+        cache.move_to_end(userId)
+        if len(cache) > self.size:
+            cache.popitem(last=False)
+        return value
+
+    def user(self, userId):
+        """The user if they're cached here or by the gateway, without waiting. None otherwise."""
+        user = self.users.get(userId)
+        if user is not None:
+            self.users.move_to_end(userId)
+            return user
+        user = self.bot.get_user(userId)
+        if user is not None:
+            self.remember(self.users, userId, user)
+        return user
+
+    def name(self, userId, default='Unknown User'):
+        user = self.user(userId)
+        return default if user is None else user.name
+
+    async def fetchUser(self, userId):
+        user = self.user(userId)
+        metrics.inc('resolver_total', kind='user', result='miss' if user is None else 'hit')
+        if user is None:
+            user = self.remember(self.users, userId, await self.bot.fetch_user(userId))
+        return user
+
+    async def channel(self, userId):
+        """The user's DM channel, opening it if needed."""
+        channel = self.channels.get(userId)
+        if channel is not None:
+            self.channels.move_to_end(userId)
+            metrics.inc('resolver_total', kind='channel', result='hit')
+            return channel
+        task = self.pending.get(userId)
+        if task is None:
+            metrics.inc('resolver_total', kind='channel', result='miss')
+            task = self.pending[userId] = asyncio.get_running_loop().create_task(self.openChannel(userId))
+            task.add_done_callback(lambda task: self.pending.pop(userId, None))
+        return await asyncio.shield(task)
+
+    async def openChannel(self, userId):
+        user = await self.fetchUser(userId)
+        channel = user.dm_channel or await user.create_dm()
+        return self.remember(self.channels, userId, channel)
+
+    async def prewarm(self, userIds):
+        """Resolve several users' DM channels at once, e.g. everyone at a table that's about to start."""
+        results = await asyncio.gather(*[self.channel(userId) for userId in userIds], return_exceptions=True)
+        for userId, result in zip(userIds, results):
+            if isinstance(result, BaseException):
+                self.logger.warning(f'Could not open a DM channel with {userId}: {result!r}')
+
+    def dm(self, userId, content=None, priority=ANNOUNCE, key=None, delete_after=None, **kwargs):
+        """Queue a DM to a user on the outbound scheduler; their channel is resolved when it's sent.
+
+        ``delete_after`` deletes it through the scheduler too, so the cleanup counts against the channel's limit.
+        """
+        async def send():
+            message = await (await self.channel(userId)).send(content, **kwargs)
+            if delete_after is not None:
+                self.bot.timers.call_later(delete_after, self.bot.outbound.submit, userId, message.delete, ANNOUNCE)
+            return message
+        return self.bot.outbound.submit(userId, send, priority, key)
+
+
+metrics.describe('resolver_total', 'counter', 'User and DM channel lookups, by whether they were cached')
@@ -0,0 +1,198 @@
+# Bot strategies. A strategy picks the card a bot plays (or None to draw) and the colour it names for a wild card.
+# The cheap ones run inline; MonteCarlo is too slow for the event loop, so tables run it in a shared process pool
+# with a hard time budget and fall back to Greedy if the pool doesn't answer in time.
+import os
+import random
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from utils.cards import COLOR, TYPE, BLACK, SKIP, REVERSE, DRAW2, WILD, DECK_SIZE, PLAYABLE, Hand, topState, lowest
+from utils.engine import Game, Seat, AWAITING_INPUT
+
+ALL_CARDS = (1 << DECK_SIZE) - 1
+
+
+def colorCounts(mask):
+    counts = [0, 0, 0, 0]
+    for card in Hand(mask):
+        if COLOR[card] != BLACK:
+            counts[COLOR[card]] += 1
+    return counts
+
+
+class Strategy:
+    """Play the first card that fits and name a random colour. This is how bots have always played."""
+    name = 'normal'
+    budgeted = False  # whether the strategy needs to run off the event loop
+
+    def __init__(self, rng=random):
+        self.rng = rng
+
+    def chooseCard(self, game, player, playable):
+        return lowest(playable)
+
+    def chooseColor(self, game, player):
+        return self.rng.randrange(4)
+
+
+class Easy(Strategy):
+    """Play any card that fits at random."""
+    name = 'easy'
+
+    def chooseCard(self, game, player, playable):
+        cards = list(Hand(playable))
+        return self.rng.choice(cards) if cards else None
+
+
+class Greedy(Strategy):
+    """Hold on to wild cards, attack a player that is close to winning and name the colour we hold most of."""
+    name = 'hard'
+
+    def chooseCard(self, game, player, playable):
+        if not playable:
+            return None
+        nextPlayer = game.players[(game.currentPlayerIndex + 1) % len(game.players)]
+        best, bestScore = None, None
+        counts = colorCounts(player.hand.mask)
+        for card in Hand(playable):
+            if COLOR[card] == BLACK:
+                # a wild is the last resort, +4 only if it stops someone winning
+                score = -10 if TYPE[card] == WILD else (-5 if len(nextPlayer.hand) <= 2 else -20)
+            else:
+                score = counts[COLOR[card]]
+                if TYPE[card] in (SKIP, REVERSE, DRAW2):
+                    score += 5 if len(nextPlayer.hand) <= 2 else 1
+            if bestScore is None or score > bestScore:
+                best, bestScore = card, score
+        return best
+
+    def chooseColor(self, game, player):
+        counts = colorCounts(player.hand.mask)
+        return counts.index(max(counts))
+
+
+class MonteCarlo(Greedy):
+    """Sample the hands we can't see, play every candidate move out a few turns and pick the one that scores best.
+
+    ``chooseCard``/``chooseColor`` run the search inline, which is what the offline benchmark uses. Tables call
+    ``snapshot`` and hand it to ``search`` in the process pool instead.
+    """
+    name = 'expert'
+    budgeted = True
+
+    def __init__(self, rng=random, budget=0.25, horizon=30):
+        super().__init__(rng)
+        self.budget = budget
+        self.horizon = horizon
+        self.color = None
+
+    def snapshot(self, game, player):
+        """Everything the bot is allowed to know, as plain data that can be sent to a worker process."""
+        return (game.players.index(player), tuple(len(p.hand) for p in game.players), player.hand.mask,
+                bytes(game.discard), game.wildColor, len(game.deck), self.horizon)
+
+    def chooseCard(self, game, player, playable):
+        if not playable:
+            return None
+        card, self.color = search(self.snapshot(game, player), self.budget, self.rng.random())
+        return card
+
+    def chooseColor(self, game, player):
+        if self.color is not None:
+            color, self.color = self.color, None
+            return color
+        return super().chooseColor(game, player)
+
+
+def rollout(snapshot, hands, deck, move, rng):
+    """Play ``move`` for the searching player in one sampled deal, let everyone play on and score the result."""
+    me, sizes, mask, discard, wildColor, deckSize, horizon = snapshot
+    seats = []
+    for i, hand in enumerate(hands):
+        seat = Seat(i, isBot=True)
+        seat.hand.mask = hand
+        seats.append(seat)
+    game = Game(seats)
+    game.rng = rng
+    game.deck = array('B', deck)
+    game.discard = array('B', discard)
+    game.wildColor = wildColor
+    game.currentPlayerIndex = me
+    game.status = 'started'
+    game.phase = AWAITING_INPUT
+    player = seats[me]
+    card, color = move
+    if card is None:
+        game.apply({'type': 'draw_card', 'data': {'player': me}})
+    else:
+        game.apply({'type': 'play_card', 'data': {'player': me, 'card': card, 'color': color}})
+    turns = 0
+    while game.status == 'started' and turns < horizon:
+        game.step()
+        turns += 1
+    if game.status == 'ended':
+        return 1.0 if game.winner is player else -1.0
+    mine = len(player.hand)
+    others = min(len(seat.hand) for seat in game.players if seat is not player)
+    return max(-1.0, min(1.0, (others - mine) / 10))
+
+
+def search(snapshot, budget, seed=None, maxRollouts=None):
+    """Return the ``(card, color)`` with the best average rollout score found within ``budget`` seconds.
+
+    Every sampled deal is shared by all candidate moves so they are compared on the same cards. ``card`` is None
+    to draw.
+    """
+    deadline = time.perf_counter() + budget
+    rng = random.Random(seed)
+    me, sizes, mask, discard, wildColor, deckSize, horizon = snapshot
+    playable = mask & PLAYABLE[topState(discard[-1], wildColor)]
+    moves = []
+    for card in Hand(playable):
+        if COLOR[card] == BLACK:
+            moves.extend((card, color) for color in range(4))
+        else:
+            moves.append((card, None))
+    if not moves:
+        return None, None
+    if len(moves) == 1:
+        return moves[0]
+    moves.append((None, None))
+    unseen = ALL_CARDS & ~mask
+    for card in discard:
+        unseen &= ~(1 << card)
+    unseen = list(Hand(unseen))
+    totals = [0.0] * len(moves)
+    rollouts = 0
+    while time.perf_counter() < deadline and (maxRollouts is None or rollouts < maxRollouts):
+        rng.shuffle(unseen)
+        hands = []
+        dealt = 0
+        for i, size in enumerate(sizes):
+            if i == me:
+                hands.append(mask)
+                continue
+            hand = 0
+            for card in unseen[dealt:dealt + size]:
+                hand |= 1 << card
+            hands.append(hand)
+            dealt += size
+        deck = unseen[dealt:]
+        for i, move in enumerate(moves):
+            totals[i] += rollout(snapshot, hands, deck, move, rng)
+        rollouts += 1
+    best = max(range(len(moves)), key=lambda i: totals[i])
+    return moves[best]
+
+
+STRATEGIES = {strategy.name: strategy for strategy in (Easy, Strategy, Greedy, MonteCarlo)}
+
+_pool = None
+
+
+def pool():
+    """The process pool shared by every table for budgeted strategies."""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=int(os.getenv('BOT_WORKERS', max(1, (os.cpu_count() or 2) - 1))))
+    return _pool
@@ -0,0 +1,93 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from utils.metrics import registry as metrics
+
+
+class Timer:
+    __slots__ = ('when', 'callback', 'args', 'owner', 'done')
+
+    def __init__(self, when, callback, args, owner):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.owner = owner
+        self.done = False
+
+    def cancel(self):
+        if not self.done:
+            self.done = True
+            self.owner.cancelled(self)
+
+
+class Timers:
+    """One deadline heap for every table in the process, kept as ``bot.timers``.
+
+    Only the earliest deadline is registered with the event loop (with ``loop.call_at``, on the loop's monotonic
+    clock), so the loop wakes once per deadline that is actually due rather than once per table per interval.
+    Cancelled timers stay in the heap until they reach the top or the heap is compacted. Callbacks are plain
+    functions run on the loop and should start a task for anything that needs awaiting.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('uno.timers')
+        self.heap = []  # (when, seq, Timer)
+        self.seq = itertools.count()
+        self.handle = None
+        self.armedAt = None
+        self.stale = 0  # cancelled timers still in the heap
+        self.stats = {'scheduled': 0, 'fired': 0, 'cancelled': 0, 'wakeups': 0}
+
+    def __len__(self):
+        return len(self.heap) - self.stale
+
+    def call_later(self, delay, callback, *args):
+        """Run ``callback(*args)`` in ``delay`` seconds. Returns a Timer that can be cancelled."""
+        loop = asyncio.get_running_loop()
+        return self.call_at(loop.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args, self)
+        heapq.heappush(self.heap, (when, next(self.seq), timer))
+        self.stats['scheduled'] += 1
+        if self.handle is None or when < self.armedAt:
+            self.arm()
+        return timer
+
+    def cancelled(self, timer):
+        self.stale += 1
+        self.stats['cancelled'] += 1
+        if self.stale > 64 and self.stale > len(self.heap) // 2:
+            self.heap = [entry for entry in self.heap if not entry[2].done]
+            heapq.heapify(self.heap)
+            self.stale = 0
+
+    def arm(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        while self.heap and self.heap[0][2].done:
+            heapq.heappop(self.heap)
+            self.stale -= 1
+        if self.heap:
+            self.armedAt = self.heap[0][0]
+            self.handle = asyncio.get_running_loop().call_at(self.armedAt, self.fire)
+
+    def fire(self):
+        self.handle = None
+        self.stats['wakeups'] += 1
+        metrics.inc('timer_wakeups_total')
+        now = asyncio.get_running_loop().time()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, timer = heapq.heappop(self.heap)
+            if timer.done:
+                self.stale -= 1
+                continue
+            timer.done = True
+            self.stats['fired'] += 1
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                self.logger.error(f'Timer callback {timer.callback!r} raised {e!r}')
+        self.arm()